@@ -0,0 +1,36 @@
+"""
+Скорость встроенных функций для чисел питона: прежний вызов функции numpy (LazyFunction) против ScalarFunction (math, cmath и
+целая степень там, где результат совпадает с numpy до бита, numpy -- в остальных случаях). Для каждого случая
+проверяется, что результаты совпадают вместе с типом (скаляром numpy).
+
+Запуск: python -m bench.builtins_bench [число вызовов]
+"""
+import sys
+import timeit
+
+from src import calc
+
+CASES = [('sin', (2,)), ('sin', (0.5,)), ('cos', (0.5,)), ('tan', (0.5,)), ('ln', (3.7,)), ('lg', (3.7,)),
+         ('log2', (3.7,)), ('sqrt', (2,)), ('sqrt', (-1,)), ('sqrt', (2.5,)), ('sqrt', (3 + 4j,)), ('sin', (1j,)),
+         ('pow', (3, 7)), ('pow', (2.5, 3)), ('pow', (2, 0.5))]
+
+
+def main(number=100000):
+    print("{:16} {:>12} {:>12} {:>9}".format('call', 'numpy, ns', 'scalar, ns', 'speedup'))
+
+    for (name, args) in CASES:
+        (_, fn) = calc.BUILTINS.functions[name][1]
+        old = calc.LazyFunction(fn.module, fn.name)
+
+        (res, expected) = (fn(*args), old(*args))
+        assert type(res) is type(expected) and repr(complex(res)) == repr(complex(expected)), (name, args)
+
+        t_old = min(timeit.repeat(lambda: old(*args), number=number, repeat=3)) / number
+        t_new = min(timeit.repeat(lambda: fn(*args), number=number, repeat=3)) / number
+
+        call = '{}({})'.format(name, ', '.join(map(repr, args)))
+        print("{:16} {:12.1f} {:12.1f} {:8.1f}x".format(call, t_old * 1e9, t_new * 1e9, t_old / t_new))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,50 @@
+"""
+Размер записи и время сохранения и загрузки данных окружения: прежний формат (pickle самих объектов) против
+codec.py на окружениях разного вида. Для каждого случая проверяется, что загруженное окружение вычисляет то же.
+
+Запуск: python -m bench.codec_bench [число повторов]
+"""
+import pickle
+import sys
+import timeit
+
+from src import calc
+from src import codec
+
+CASES = [('small', ['x = 2', 'def f(a, b) = a * b + x'], 'f(x, 3)'),
+         ('numbers', ['v{} = {} * 1.5 + 2j'.format(i, i) for i in range(50)], 'v7 + v49'),
+         ('units', ['d{} = {} {{km}}'.format(i, i) for i in range(20)] + ['t = 2 {hour}'], 'd3 / t'),
+         ('functions', ['def f{}(x, y) = x * {} + sin(y) * pow(x, 2) - y / 3'.format(i, i) for i in range(30)],
+          'f29(2, 3)'),
+         ('matrix', ['M = [' + ', '.join('[' + ', '.join(str((i * 7 + j) % 10) for j in range(100)) + ']'
+                                         for i in range(100)) + ']'], 'D(M)'),
+         ('long body', ['def f(x) = ' + ' + '.join('{} * x'.format(i) for i in range(2000))], 'f(2)')]
+
+
+def main(number=200):
+    print("{:10} {:>11} {:>11} {:>13} {:>13} {:>13} {:>13}".format(
+        'case', 'pickle, B', 'codec, B', 'pickle enc,us', 'codec enc,us', 'pickle dec,us', 'codec dec,us'))
+
+    for (name, lines, check) in CASES:
+        env = calc.Environment(root=calc.BUILTINS)
+        for line in lines:
+            calc.calculate(line, env)
+        data = env.get_data()
+
+        old = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        new = codec.encode(data)
+
+        copy = calc.Environment(root=calc.BUILTINS)
+        copy.set_data(codec.decode(new))
+        assert str(calc.calculate(check, copy)) == str(calc.calculate(check, env)), name
+
+        n = max(1, number // 10) if name in ('matrix', 'long body') else number
+        times = [min(timeit.repeat(fn, number=n, repeat=3)) / n * 1e6
+                 for fn in (lambda: pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL), lambda: codec.encode(data),
+                            lambda: pickle.loads(old), lambda: codec.decode(new))]
+
+        print("{:10} {:11} {:11} {:13.1f} {:13.1f} {:13.1f} {:13.1f}".format(name, len(old), len(new), *times))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,75 @@
+"""
+Пропускная способность и задержка ответа при разных размерах пула ChatDispatcher. Сообщения отправляются
+пачкой в поддельный объект бота, который только запоминает время ответа. В нагрузке есть медленные сообщения
+(обращение матрицы 300x300), которые раньше задерживали ответы во всех остальных чатах.
+
+Запуск: python -m bench.dispatch_bench [число чатов] [сообщений на чат]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from src import calc
+from src import dispatch
+from src import storage
+
+
+class FakeBot(object):
+    """Заменитель telegram.Bot: запоминает отправленные сообщения"""
+
+    def __init__(self):
+        self.sent = []
+
+    def sendMessage(self, chat_id, text):
+        self.sent.append((chat_id, text, time.perf_counter()))
+
+
+def big_matrix(n=300):
+    rows = ', '.join('[{}]'.format(', '.join(str((i * 7 + j * 3) % 11 + (n if i == j else 0)) for j in range(n)))
+                     for i in range(n))
+    return '[{}]'.format(rows)
+
+
+def run(workers, chats, per_chat, store):
+    envs = storage.EnvironmentCache(store)
+    bot = FakeBot()
+    dispatcher = dispatch.ChatDispatcher(workers=workers, envs=envs)
+    submitted = {}
+
+    def reply(chat_id, text, key):
+        bot.sendMessage(chat_id=chat_id, text=dispatch.evaluate(envs, chat_id, text))
+        submitted[key] = time.perf_counter() - submitted[key]
+
+    start = time.perf_counter()
+    for i in range(per_chat):
+        for chat_id in range(chats):
+            text = 'D(inv(M))' if chat_id % 4 == 0 and i % 2 == 0 else 'x * {} + sin({})'.format(i, chat_id)
+            key = (chat_id, i)
+            submitted[key] = time.perf_counter()
+            dispatcher.submit(chat_id, reply, chat_id, text, key)
+    dispatcher.shutdown()
+    total = time.perf_counter() - start
+
+    latencies = sorted(submitted.values())
+    n = len(latencies)
+    return n / total, latencies[n // 2], latencies[int(n * 0.95)], latencies[-1]
+
+
+def main(chats=16, per_chat=8):
+    with tempfile.TemporaryDirectory() as tmp:
+        with storage.SQLiteStore(os.path.join(tmp, 'state.sqlite')) as store:
+            env = calc.Environment(root=calc.BUILTINS)
+            calc.calculate('x = 2', env)
+            calc.calculate('M = ' + big_matrix(), env)
+            store.save_many((chat_id, env.get_data()) for chat_id in range(chats))
+
+            print("{:>7} {:>12} {:>10} {:>10} {:>10}".format('workers', 'msg/s', 'p50 ms', 'p95 ms', 'max ms'))
+            for workers in (1, 2, 4, 8):
+                (rate, p50, p95, worst) = run(workers, chats, per_chat, store)
+                print("{:>7} {:>12.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(workers, rate, p50 * 1e3, p95 * 1e3,
+                                                                              worst * 1e3))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
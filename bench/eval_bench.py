@@ -0,0 +1,144 @@
+"""
+Сравнение скорости вычисления: прежний интерпретатор (рекурсивный обход дерева цепочкой сравнений строк) против
+компиляции дерева в функции (calc.compiled), без мемоизации и с ней. Разбор выражений в замер не входит.
+
+Запуск: python -m bench.eval_bench [число повторов]
+"""
+import sys
+import timeit
+from numbers import Number
+
+import numpy as np
+
+from src import calc
+from src import parser
+
+
+def interpret(expr, env):
+    """Вычисление выражения прежним интерпретатором (копия evl/apply до перехода на компиляцию)"""
+
+    def evl(expr, env):
+        if isinstance(expr, Number):
+            return expr
+
+        if isinstance(expr, str):
+            if expr not in ["set", "apply", "unset", "def", "undef", "matrix", "with_units", "convert"]:
+                return env.get_var(expr)
+
+        (expr_type, *expr_body) = expr
+
+        if expr_type == "matrix":
+            return np.matrix(calc.make_matrix(expr))
+
+        if expr_type == "with_units":
+            val, units = expr_body
+            return evl(val, env) * calc.ureg(calc.make_units(units))
+
+        if expr_type == "convert":
+            val, units = expr_body
+            return evl(val, env).to(calc.ureg(calc.make_units(units)))
+
+        if expr_type == "set":
+            (variable, value_expr) = expr_body
+            env.set_var(variable, evl(value_expr, env))
+            return
+
+        if expr_type == "unset":
+            env.del_var(expr_body[0])
+            return
+
+        if expr_type == "def":
+            (f_name, f_args, f_body) = expr_body
+
+            arity = len(f_args)
+            if arity != len(set(f_args)):
+                raise RuntimeError("All args. must be uniq.")
+
+            env.set_function(f_name, arity, (f_args, f_body))
+            return
+
+        if expr_type == "undef":
+            env.del_function(expr_body[0])
+            return
+
+        if expr_type == "apply":
+            (f_name, f_args) = expr_body
+            return apply(f_name, f_args, env)
+
+    def apply(f, f_args, env):
+        (builtin, (arity, fn)) = env.get_function(f)
+
+        if builtin:
+            if arity == len(f_args):
+                f_args = map(lambda x: evl(x, env), f_args)
+                return fn(*f_args)
+            else:
+                raise RuntimeError("Function {} has arity {}, but called with {} args.".format(f, arity, len(f_args)))
+
+        function_env = calc.Environment(root=env)
+
+        (f_vars, body) = fn
+
+        if arity != len(f_args):
+            raise RuntimeError("Function {} has arity {}, but called with {} args.".format(f, arity, len(f_args)))
+
+        for i in range(len(f_vars)):
+            function_env.set_var(f_vars[i], evl(f_args[i], env))
+
+        return evl(body, function_env)
+
+    return evl(expr, env)
+
+
+def deep_arithmetic(n=120):
+    """Длинное выражение со всеми арифметическими операциями и вызовами встроенных функций"""
+    ops = ['+', '*', '-', '/']
+    s = 'x'
+    for i in range(1, n):
+        s += ' {} {}'.format(ops[i % 4], 'sin(x)' if i % 7 == 0 else i)
+    return s
+
+
+PROGRAM = ['x = 1.5',
+           'def f(x) = x * 2 + 1',
+           'def g(x) = f(x) + f(x + 1) * f(x - 1)',
+           'def h(x, y) = g(x) * g(y) - g(x + y)',
+           'def k(x) = h(x, x + 1) + h(x - 1, x) / 2']
+
+CASES = [('deep arithmetic', deep_arithmetic()),
+         ('nested user functions', 'k(3) + k(x)')]
+
+
+def prepare():
+    env = calc.Environment()
+    for s in PROGRAM:
+        calc.calculate(s, env)
+    return env
+
+
+def main(number=2000):
+    env = prepare()
+
+    for name, s in CASES:
+        expr = parser.cached_parse(s)
+        code = calc.compiled(expr)
+
+        env.memo = None
+        assert interpret(expr, env) == code(env), name
+
+        old = min(timeit.repeat(lambda: interpret(expr, env), number=number, repeat=3))
+        new = min(timeit.repeat(lambda: code(env), number=number, repeat=3))
+
+        # Мемоизация чистых функций
+        env.memo = calc.Memo()
+        memo = min(timeit.repeat(lambda: code(env), number=number, repeat=3))
+
+        print("{}:".format(name))
+        print("  interpreter:     {:8.2f} us/expr".format(old / number * 1e6))
+        print("  compiled:        {:8.2f} us/expr  ({:.2f}x)".format(new / number * 1e6, old / new))
+        print("  compiled + memo: {:8.2f} us/expr  ({:.2f}x), hit rate {:.2f}".format(
+            memo / number * 1e6, old / memo, env.memo.stats()['hit_rate']))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
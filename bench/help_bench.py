@@ -0,0 +1,48 @@
+"""
+Время ответа на /help: прежний вариант (разбор demo.xml через minidom и перебор разделов при каждой команде)
+против индекса HelpIndex (файл разобран заранее, проверяется только время его изменения).
+
+Запуск: python -m bench.help_bench [число повторов]
+"""
+import os
+import sys
+import timeit
+import xml.dom.minidom
+
+from src.helpdoc import HelpIndex
+
+DEMO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'demo.xml')
+
+
+def old_help(args):
+    """Прежний helpFn без отправки сообщений"""
+    dom = xml.dom.minidom.parse(DEMO)
+    dom.normalize()
+    res = []
+    if not args:
+        for node in dom.getElementsByTagName('title'):
+            res.append(node.childNodes[0].nodeValue)
+    else:
+        for node in dom.getElementsByTagName('help'):
+            if args[0] == node.getAttribute('id'):
+                res.append(node.childNodes[0].nodeValue)
+    return res
+
+
+def main(number=200):
+    index = HelpIndex(DEMO)
+
+    for args in ([], ['5.5'], ['matrix'], ['matrix', 'rank']):
+        new = min(timeit.repeat(lambda: index.answer(args), number=number, repeat=3)) / number
+
+        if len(args) < 2 and (not args or args[0][0].isdigit()):
+            assert old_help(args) == index.answer(args)
+            old = min(timeit.repeat(lambda: old_help(args), number=number, repeat=3)) / number
+            print("/help {:15} {:9.1f} us -> {:7.1f} us ({:.0f}x)".format(' '.join(args), old * 1e6, new * 1e6,
+                                                                        old / new))
+        else:
+            print("/help {:15} {:>9}    -> {:7.1f} us".format(' '.join(args), 'n/a', new * 1e6))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
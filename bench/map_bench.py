@@ -0,0 +1,41 @@
+"""
+Вычисление пользовательской функции в N точках: одно выражение map(f, range(...)) (тело вычисляется один раз
+над массивом numpy) против N отдельных вызовов calculate, как пользователи делали раньше.
+
+Запуск: python -m bench.map_bench [число точек]
+"""
+import sys
+import time
+
+import numpy as np
+
+from src import calc
+
+FUNCTION = 'def f(x) = x * x * sin(x) + cos(x) / 2 - pow(x, 3) * pi'
+
+
+def main(points=1000):
+    env = calc.Environment(root=calc.BUILTINS)
+    calc.calculate(FUNCTION, env)
+
+    step = 0.01
+    texts = ['f({!r})'.format(i * step) for i in range(points)]
+
+    start = time.perf_counter()
+    one_by_one = [calc.calculate(s, env) for s in texts]
+    old = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectorized = calc.calculate('map(f, range(0, {!r}, {!r}))'.format(points * step - step / 2, step), env)
+    new = time.perf_counter() - start
+
+    assert np.allclose(one_by_one, vectorized)
+
+    print("points: {}".format(points))
+    print("per-element calculate: {:10.2f} ms".format(old * 1e3))
+    print("map (vectorized):      {:10.2f} ms".format(new * 1e3))
+    print("speedup:               {:10.1f}x".format(old / new))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
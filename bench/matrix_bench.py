@@ -0,0 +1,59 @@
+"""
+Матрицы, введённые литералами: прежний вариант (вложенные списки make_matrix превращаются в np.matrix при каждом
+вычислении) против текущего (постоянный литерал -- массив numpy, построенный один раз при компиляции). Замеряется
+вычисление уже разобранного выражения; время первого вычисления (разбор и компиляция) выводится отдельно.
+
+Запуск: python -m bench.matrix_bench [число повторов] [размеры через запятую]
+"""
+import random
+import sys
+import time
+import timeit
+
+import numpy as np
+
+from src import calc
+from src import parser
+
+OPERATIONS = {'inv': lambda a, b: np.linalg.inv(a),
+              'D': lambda a, b: np.linalg.det(a),
+              'rk': lambda a, b: np.linalg.matrix_rank(a),
+              '*': lambda a, b: a * b}
+
+
+def literal(n, seed):
+    rnd = random.Random(seed)
+    return '[' + ', '.join('[' + ', '.join(str(rnd.randint(-9, 9)) for _ in range(n)) + ']'
+                           for _ in range(n)) + ']'
+
+
+def main(number=20, sizes='100,200'):
+    number = int(number)
+    env = calc.Environment(root=calc.BUILTINS)
+
+    for n in map(int, str(sizes).split(',')):
+        a = literal(n, 1)
+        b = literal(n, 2)
+        (a_expr, b_expr) = (parser.cached_parse(a), parser.cached_parse(b))
+
+        for (name, op) in OPERATIONS.items():
+            s = '{} * {}'.format(a, b) if name == '*' else '{}({})'.format(name, a)
+
+            def before():
+                return op(np.matrix(calc.make_matrix(a_expr)), np.matrix(calc.make_matrix(b_expr)))
+
+            start = time.perf_counter()
+            res = calc.calculate(s, env)
+            first = time.perf_counter() - start
+
+            assert np.allclose(before(), res)
+
+            old = min(timeit.repeat(before, number=number, repeat=3)) / number
+            new = min(timeit.repeat(lambda: calc.calculate(s, env), number=number, repeat=3)) / number
+
+            print("{:4}x{:<4} {:4} {:9.3f} ms -> {:9.3f} ms ({:5.1f}x), first evaluation {:8.1f} ms".format(
+                n, n, name, old * 1e3, new * 1e3, old / new, first * 1e3))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,160 @@
+"""
+Отправка ответов: прежняя схема (обработчик сам вызывает sendMessage и при 429 ждёт retry_after) против очереди
+Outbox. Локальная замена Bot API по HTTP соблюдает ограничения Telegram (1 сообщение в секунду в чат с пачкой до 3,
+30 в секунду всего) и отвечает 429 на сообщения сверх них, каждая передача по сети задерживается на delay.
+Нагрузка -- пачка ответов: replies ответов в каждый из chats чатов, как при рассылке или всплеске сообщений.
+Измеряется время, которое обработчик ждёт отправки, число запросов к API и ответов 429 и время до доставки всех
+ответов.
+
+Запуск: python -m bench.outbox_bench [чатов] [ответов в чат] [задержка сети, мс]
+"""
+import http.client
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.outbox import Outbox, TokenBucket
+
+
+class RetryAfter(Exception):
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class FakeBotAPI(object):
+    """Замена Bot API: sendMessage с ограничениями частоты"""
+
+    def __init__(self, delay, chat_rate=1.0, burst=3, global_rate=30.0):
+        self.delay = delay
+        self.chat_rate = chat_rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.bucket = TokenBucket(global_rate, global_rate, time.monotonic())
+        self.buckets = dict()
+        self.delivered = dict()
+        self.calls = 0
+        self.rejected = 0
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                args = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                body = json.dumps(api.send_message(**args)).encode('utf-8')
+                time.sleep(api.delay)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def send_message(self, chat_id, text):
+        with self.lock:
+            now = time.monotonic()
+            self.calls += 1
+            bucket = self.buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.burst, now))
+            wait = max(bucket.wait(now), self.bucket.wait(now))
+
+            if wait > 1e-3:
+                self.rejected += 1
+                return {'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                        'parameters': {'retry_after': max(1, round(wait))}}
+
+            bucket.take(now)
+            self.bucket.take(now)
+            self.delivered[chat_id] = self.delivered.get(chat_id, 0) + text.count('\n') + 1
+            return {'ok': True, 'result': {'chat': {'id': chat_id}, 'text': text}}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Client(object):
+    """sendMessage по HTTP (соединение на поток), 429 -- RetryAfter"""
+
+    def __init__(self, api):
+        self.api = api
+        self.local = threading.local()
+
+    def send(self, chat_id, text):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection('127.0.0.1', self.api.port)
+
+        time.sleep(self.api.delay)
+        conn.request('POST', '/botTOKEN/sendMessage', body=json.dumps({'chat_id': chat_id, 'text': text}),
+                     headers={'Content-Type': 'application/json'})
+        res = json.loads(conn.getresponse().read())
+
+        if not res['ok']:
+            raise RetryAfter(res['parameters']['retry_after'])
+
+
+def blocking(client, chat_id, text):
+    """Прежняя схема: отправка в обработчике, после 429 -- ожидание и повтор"""
+    while True:
+        try:
+            return client.send(chat_id, text)
+        except RetryAfter as e:
+            time.sleep(e.retry_after)
+
+
+def run(mode, chats, replies, delay, workers=4):
+    """(среднее время ожидания обработчика, с; время до доставки всех ответов, с; запросов; ответов 429)"""
+    api = FakeBotAPI(delay)
+    client = Client(api)
+    outbox = Outbox(client.send, workers=workers) if mode == 'outbox' else None
+    waits = []
+
+    def handler(chat_id, i):
+        start = time.perf_counter()
+        if outbox is None:
+            blocking(client, chat_id, str(i))
+        else:
+            outbox.submit(chat_id, str(i))
+        waits.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+
+    # Обработчики выполняются в пуле потоков, как в ChatDispatcher
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for i in range(replies):
+            for chat_id in range(1, chats + 1):
+                pool.submit(handler, chat_id, i)
+
+    if outbox is not None:
+        outbox.shutdown()
+
+    total = time.perf_counter() - start
+    api.close()
+
+    assert all(api.delivered[chat_id] == replies for chat_id in range(1, chats + 1))
+    return sum(waits) / len(waits), total, api.calls, api.rejected
+
+
+def main(chats=20, replies=5, delay_ms=25):
+    print("{} chats x {} replies, network delay {} ms each way".format(chats, replies, delay_ms))
+    print("{:9} {:>18} {:>12} {:>10} {:>8}".format('mode', 'handler wait, ms', 'total, s', 'requests', '429'))
+
+    for mode in ['blocking', 'outbox']:
+        (wait, total, calls, rejected) = run(mode, chats, replies, delay_ms / 1000)
+        print("{:9} {:18.2f} {:12.2f} {:10} {:8}".format(mode, wait * 1000, total, calls, rejected))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,68 @@
+"""
+Сравнение пропускной способности парсера: прежний вариант (Earley + отдельный проход TreeTransformer)
+против текущего (LALR с трансформером, применяемым во время разбора). Корпус -- выражения из tests/test_pars.py.
+
+Запуск: python -m bench.parser_bench [число повторов]
+"""
+import os
+import re
+import sys
+import timeit
+
+from lark import Lark
+
+from src import parser
+
+TESTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'test_pars.py')
+
+
+def load_corpus(path=TESTS):
+    """Выражения, которые разбираются в тестах парсера"""
+    with open(path, encoding='utf-8') as f:
+        corpus = re.findall(r"parse\('([^']*)'\)", f.read())
+
+    # Оставляем только то, что разбирается текущей грамматикой, без программ: их parse делит на выражения
+    # до разбора, а прежний парсер разбирал строку целиком
+    res = []
+    for s in corpus:
+        if parser.split(s) != [s.strip()]:
+            continue
+        try:
+            parser.parse(s)
+        except Exception:
+            continue
+        res.append(s)
+    return res
+
+
+def old_parse_fn():
+    """Парсер в прежнем виде: Earley, дерево, затем трансформация"""
+    earley = Lark(parser.GRAMMAR, start='toplevel')
+    transformer = parser.TreeTransformer()
+    return lambda s: transformer.transform(earley.parse(s))
+
+
+def throughput(fn, corpus, number):
+    """Количество разобранных выражений в секунду"""
+    t = min(timeit.repeat(lambda: [fn(s) for s in corpus], number=number, repeat=3))
+    return len(corpus) * number / t
+
+
+def main(number=200):
+    corpus = load_corpus()
+    old_parse = old_parse_fn()
+
+    for s in corpus:
+        assert old_parse(s) == parser.parse(s), s
+
+    old = throughput(old_parse, corpus, number)
+    new = throughput(parser.parse, corpus, number)
+
+    print("corpus: {} expressions".format(len(corpus)))
+    print("earley + transform: {:10.0f} expr/s".format(old))
+    print("lalr inline:        {:10.0f} expr/s".format(new))
+    print("speedup:            {:10.2f}x".format(new / old))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
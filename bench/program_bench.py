@@ -0,0 +1,51 @@
+"""
+Скрипт из нескольких строк: по одному сообщению на строку (загрузка, вычисление и сохранение окружения для
+каждой) против одного сообщения-программы (одна загрузка и одно сохранение). Окружения не держатся в памяти
+(max_entries=0), как при первом сообщении чата после вытеснения из кэша.
+
+Запуск: python -m bench.program_bench [число чатов]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from src.dispatch import evaluate
+from src.storage import EnvironmentCache, SQLiteStore
+
+SCRIPT = ['def f(x) = x * 2 + 1',
+          'def g(x, y) = f(x) * f(y)',
+          'a = 3',
+          'b = g(a, 4)',
+          'c = b / a',
+          'g(b, c) + f(a)']
+
+
+def run(messages, chats):
+    with tempfile.TemporaryDirectory() as tmp:
+        with SQLiteStore(os.path.join(tmp, 'state.sqlite')) as store:
+            envs = EnvironmentCache(store, max_entries=0)
+
+            start = time.perf_counter()
+            for chat_id in range(chats):
+                for text in messages:
+                    res = evaluate(envs, chat_id, text)
+            elapsed = time.perf_counter() - start
+
+    return elapsed / chats, res
+
+
+def main(chats=2000):
+    chats = int(chats)
+    (lines, res_lines) = run(SCRIPT, chats)
+    (program, res_program) = run(['\n'.join(SCRIPT)], chats)
+
+    assert res_program == res_lines
+
+    print("script of {} lines, {} chats".format(len(SCRIPT), chats))
+    print("message per line: {:8.1f} us per script".format(lines * 1e6))
+    print("one program:      {:8.1f} us per script ({:.1f}x)".format(program * 1e6, lines / program))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,90 @@
+"""
+Пропускная способность и задержка ответа на синтетической нагрузке из многих чатов: пул потоков ChatDispatcher
+(вычисления в одном процессе, под GIL), ChatDispatcher с пулом процессов ProcessPool (окружение чата каждый раз
+передаётся в процесс и обратно) и процессы Supervisor, каждый из которых владеет своими чатами. Сообщения --
+длинные выражения, разбор и вычисление которых идут в интерпретаторе питона (разные в каждом сообщении, чтобы
+не помогал кэш разбора). Выигрыш от процессов возможен только на машине с несколькими ядрами.
+
+Запуск: python -m bench.shard_bench [число чатов] [сообщений на чат] [процессов или потоков]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from src import dispatch
+from src import sandbox
+from src import shard
+from src import storage
+
+
+def message(chat_id, i, terms=300):
+    """Выражение из terms слагаемых с переменной окружения чата"""
+    return 'x = x + ' + ' + '.join('{} * sin({})'.format(chat_id * 1000 + i, k) for k in range(terms))
+
+
+def run(mode, chats, per_chat, workers, path):
+    submitted = dict()
+    latencies = []
+    lock = threading.Lock()
+
+    def reply(chat_id, key):
+        with lock:
+            latencies.append(time.perf_counter() - submitted.pop(key))
+
+    with storage.SQLiteStore(path) as store:
+        store.save_many((chat_id, [{'x': 0}, {}]) for chat_id in range(chats))
+
+    if mode == 'shards':
+        supervisor = shard.Supervisor(path, lambda chat_id, text: None, workers=workers)
+        # Ответ считается полученным, когда процесс вернул результат; порядок сообщений чата сохраняется
+        supervisor.reply = lambda chat_id, text: reply(chat_id, (chat_id, done[chat_id].pop(0)))
+        done = {chat_id: list(range(per_chat)) for chat_id in range(chats)}
+        submit = lambda chat_id, i: supervisor.submit(chat_id, message(chat_id, i))
+    else:
+        store = storage.SQLiteStore(path)
+        envs = storage.EnvironmentCache(store)
+        pool = sandbox.ProcessPool(workers=workers) if mode == 'sandbox' else None
+        dispatcher = dispatch.ChatDispatcher(workers=workers, envs=envs)
+
+        def evaluate(chat_id, i):
+            dispatch.evaluate(envs, chat_id, message(chat_id, i), pool)
+            reply(chat_id, (chat_id, i))
+
+        submit = lambda chat_id, i: dispatcher.submit(chat_id, evaluate, chat_id, i)
+
+    start = time.perf_counter()
+    for i in range(per_chat):
+        for chat_id in range(chats):
+            submitted[(chat_id, i)] = time.perf_counter()
+            submit(chat_id, i)
+
+    if mode == 'shards':
+        supervisor.shutdown()
+    else:
+        dispatcher.shutdown()
+        if pool is not None:
+            pool.close()
+        store.close()
+
+    total = time.perf_counter() - start
+
+    latencies.sort()
+    n = len(latencies)
+    assert n == chats * per_chat
+    return n / total, latencies[n // 2], latencies[int(n * 0.95)]
+
+
+def main(chats=16, per_chat=4, workers=4):
+    print("{} chats x {} messages, {} workers, {} CPUs".format(chats, per_chat, workers, os.cpu_count()))
+    print("{:8} {:>10} {:>10} {:>10}".format('mode', 'msg/s', 'p50 ms', 'p95 ms'))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ['threads', 'sandbox', 'shards']:
+            (rate, p50, p95) = run(mode, chats, per_chat, workers, os.path.join(tmp, mode + '.sqlite'))
+            print("{:8} {:>10.1f} {:>10.1f} {:>10.1f}".format(mode, rate, p50 * 1e3, p95 * 1e3))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,56 @@
+"""
+Время запуска бота: импорт модулей (без telegram) и задержка первого ответа в свежем процессе. Для сравнения
+приводятся прежний запуск (numpy и реестр pint загружаются сразу) и построение парсера из текста грамматики
+без заранее построенного файла (python -m src.parser build).
+
+Запуск: python -m bench.startup_bench [число запусков]
+"""
+import subprocess
+import sys
+
+IMPORT = "import src.calc, src.dispatch, src.sandbox, src.storage"
+
+EAGER = IMPORT + "; import numpy, numpy.linalg; src.calc.get_ureg()"
+
+GRAMMAR = ("import src.parser; from lark import Lark; "
+           "Lark(src.parser.GRAMMAR, start='toplevel', parser='lalr', transformer=src.parser.TreeTransformer())")
+
+FIRST = IMPORT + ("; from src.storage import EnvironmentCache, SQLiteStore; "
+                  "envs = EnvironmentCache(SQLiteStore(':memory:')); src.dispatch.evaluate(envs, 1, {!r})")
+
+EXPRESSIONS = ['2 + 2', 'sin(1) + sqrt(-1)', 'inv([[1, 2], [3, 4]])', '10{km/h} -> {m/s}']
+
+TIMER = r"""
+import time
+start = time.perf_counter()
+{}
+print(time.perf_counter() - start)
+"""
+
+
+def measure(code, runs):
+    """Минимальное по runs запускам время выполнения code в новом процессе (с импортами)"""
+    res = []
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', TIMER.format(code)])
+        res.append(float(out))
+    return min(res)
+
+
+def main(runs=5):
+    # Файл с парсером должен существовать до измерений
+    subprocess.check_call([sys.executable, '-c', 'import src.parser'])
+
+    print("imports:")
+    print("  lazy (current):              {:8.1f} ms".format(measure(IMPORT, runs) * 1e3))
+    print("  eager numpy + pint (before): {:8.1f} ms".format(measure(EAGER, runs) * 1e3))
+    print("  parser from artifact:        {:8.1f} ms".format(measure("import src.parser", runs) * 1e3))
+    print("  + parser from grammar text:  {:8.1f} ms".format(measure(GRAMMAR, runs) * 1e3))
+
+    print("import + first response:")
+    for s in EXPRESSIONS:
+        print("  {:30} {:8.1f} ms".format(s, measure(FIRST.format(s), runs) * 1e3))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,87 @@
+"""
+Стоимость сохранения состояния на одно сообщение при большом числе чатов: прежняя схема (shelve с
+writeback=True и sync() после каждого сообщения, все чаты уже загружены в кэш shelve) против SQLiteStore
+(одна строка на чат, запись только при изменении окружения).
+
+Запуск: python -m bench.storage_bench [число чатов] [число сообщений]
+"""
+import os
+import random
+import shelve
+import sys
+import tempfile
+import time
+
+from src import calc
+from src import storage
+
+MESSAGES = ['x = {}', 'x * 2 + {}', 'def f(a, b) = a * b + {}', 'f(x, {})', 'sin(x) + {}']
+
+
+def populate(envs, chats):
+    """Начальное состояние: у каждого чата есть переменная и функция"""
+    env = calc.Environment(root=calc.BUILTINS)
+    calc.calculate('x = 1', env)
+    calc.calculate('def f(a, b) = a + b', env)
+    for chat_id in range(chats):
+        envs(chat_id, env.get_data())
+
+
+def shelve_cost(path, chats, messages):
+    with shelve.open(path, writeback=True) as db:
+        populate(lambda chat_id, data: db.__setitem__(str(chat_id), data), chats)
+        db.sync()
+
+        # Долго работающий процесс: все чаты уже побывали в кэше writeback
+        for chat_id in range(chats):
+            db[str(chat_id)]
+
+        rnd = random.Random(1)
+        t = 0.0
+        for i in range(messages):
+            chat_id = str(rnd.randrange(chats))
+            env = calc.Environment(root=calc.BUILTINS)
+            env.set_data(db[chat_id])
+            calc.calculate(rnd.choice(MESSAGES).format(i), env)
+
+            start = time.perf_counter()
+            db[chat_id] = env.get_data()
+            db.sync()
+            t += time.perf_counter() - start
+
+    return t / messages
+
+
+def sqlite_cost(path, chats, messages):
+    with storage.SQLiteStore(path) as store:
+        items = []
+        populate(lambda chat_id, data: items.append((chat_id, data)), chats)
+        store.save_many(items)
+
+        rnd = random.Random(1)
+        t = 0.0
+        for i in range(messages):
+            chat_id = rnd.randrange(chats)
+            env = store.environment(chat_id)
+            calc.calculate(rnd.choice(MESSAGES).format(i), env)
+
+            start = time.perf_counter()
+            store.commit(chat_id, env)
+            t += time.perf_counter() - start
+
+    return t / messages
+
+
+def main(chats=10000, messages=50):
+    with tempfile.TemporaryDirectory() as tmp:
+        old = shelve_cost(os.path.join(tmp, 'shelve'), chats, messages)
+        new = sqlite_cost(os.path.join(tmp, 'state.sqlite'), chats, messages * 20)
+
+    print("chats: {}".format(chats))
+    print("shelve writeback + sync: {:10.3f} ms/message".format(old * 1e3))
+    print("sqlite (WAL, dirty only): {:9.3f} ms/message".format(new * 1e3))
+    print("speedup: {:.0f}x".format(old / new))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,273 @@
+"""
+Набор микробенчмарков для отслеживания производительности: парсер, вычисление, единицы измерения, матрицы и
+сохранение состояния чата. Корпуса фиксированы (выражения взяты из tests/test_pars.py и tests/test_calc.py,
+плюс синтетические глубокие и широкие выражения), поэтому результаты разных версий сравнимы. Сеть не нужна.
+
+Результат -- JSON со временем одной итерации каждого случая (минимум и медиана по повторам). При сравнении с
+сохранённым базовым результатом случаи, ставшие медленнее больше чем на порог, отмечаются как регрессии, и
+скрипт завершается с кодом 1. Базовый результат имеет смысл только для той машины, на которой он записан.
+
+Запуск:
+    python -m bench.suite                           -- замер и сравнение с bench/baseline.json
+    python -m bench.suite --save-baseline           -- замер и сохранение его как базового
+    python -m bench.suite --output res.json -k calc -- только случаи, в имени которых есть "calc"
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+from src import calc
+from src import parser
+from src.storage import EnvironmentCache, ShelveStore, SQLiteStore
+from src.dispatch import evaluate
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+"""Выражения из tests/test_pars.py, которые разбираются текущей грамматикой"""
+PARSE_CORPUS = ['1.1', '-2', '2 - 1j', 'sin(2)', 'z = x + y^3', 'unset x', 'def f(x, y) = (2 + x) * y', 'undef f',
+                '(1 + 2) / 3', 'x {(kg * m) / s}', 'x {kg} -> {mg}', '<ff>16 + <101>2', 'sin(2)**2 + cos(3)^3',
+                '  sin(2)**2   +  cos(3)^3', 'f(x, 2, 1)', 'f(x, 2) + 1', 'x = 2 ^ 3']
+
+"""Определения, в контексте которых вычисляются выражения из tests/test_calc.py"""
+CALC_SETUP = ['x = 4294967296', 'y = 2', 'def f(x, y) = x * (2 * pi + sqrt(2))', 'def g(x) = x * 2 + 1',
+              'def h(x, y) = g(x) + g(y) / 4', 'def k(xx) = xx * xx + sin(xx)']
+
+CALC_CORPUS = ['e', 'cos(0)', 'x * x', 'x * x * x', 'f(1, 0)', 'g(2)', 'h(1, g(2))', 'sin(2)**2 + cos(3)^3',
+               '(1 + 2) / 3', '<ff>16 + <101>2', '2 - 1j', 'y + y^3', 'map(k, range(1, 3, 1))']
+
+UNITS_CORPUS = ['3.6{kg} -> {mg}', '3.6 {(kg * m) / s}->{(mg * m)/s}', '10{km/h} -> {m/s}', '3.6{kg} * 4{m}']
+
+MATRIX_CORPUS = ['T([1, 2]) * [1, 2]', 'inv([[2, 1], [4, 3]])', 'D([[2, 4], [1, 2]])', 'rk([[3, 4], [4, 5]])',
+                 'tr([[2, 4], [1, 2]])', '[[2, 1], [1, 1]] + [[3, 1], [2, 3]]', 'sin([1, 2])']
+
+
+def deep(n=40):
+    """Глубоко вложенное выражение: (((y + 1) * 2 + 1) * 2 ...)"""
+    s = 'y'
+    for i in range(n):
+        s = '({} + {}) * 2'.format(s, i)
+    return s
+
+
+def wide(n=100):
+    """Длинная сумма: y + 1 * y + 2 * y + ..."""
+    return ' + '.join('{} * y'.format(i) for i in range(n))
+
+
+def long(n=10000):
+    """Сумма из n слагаемых: y + y + ... (дерево высотой около 2n, вычисляется стековой машиной)"""
+    return ' + '.join(['y'] * n)
+
+
+def nested_calls(n=30):
+    """Вложенные вызовы встроенных функций: sin(cos(sin(...)))"""
+    return ''.join('sin(' if i % 2 else 'cos(' for i in range(n)) + 'y' + ')' * n
+
+
+def environment(setup=()):
+    env = calc.Environment(root=calc.BUILTINS)
+    for s in setup:
+        calc.calculate(s, env)
+    return env
+
+
+def evaluator(corpus, setup=CALC_SETUP):
+    """Вычисление всех выражений корпуса в одном окружении (как последовательные сообщения одного чата)"""
+    env = environment(setup)
+    return lambda: [calc.calculate(s, env) for s in corpus]
+
+
+def persistence(store):
+    """Цикл обработки сообщения без кэша окружений: загрузка окружения, вычисление, сохранение"""
+    counter = iter(range(10 ** 9))
+
+    def run():
+        i = next(counter)
+        chat_id = i % 100
+        env = store.environment(chat_id)
+        calc.calculate('x = {}'.format(i), env)
+        calc.calculate('def f(a) = a * x', env)
+        store.commit(chat_id, env)
+
+    return run
+
+
+def cached_evaluate(store):
+    """Обработка сообщения так, как это делает бот (dispatch.evaluate с кэшем окружений)"""
+    envs = EnvironmentCache(store)
+    counter = iter(range(10 ** 9))
+
+    def run():
+        i = next(counter)
+        evaluate(envs, i % 100, 'x = x / 2 + {}'.format(i) if i >= 100 else 'x = {}'.format(i))
+
+    return run
+
+
+def cases(tmp, stores):
+    """Имя случая -> (функция одной итерации, число элементов в итерации); открытые хранилища добавляются в stores"""
+    parse_deep, parse_wide, parse_calls = deep(), wide(), nested_calls()
+    stores.extend([SQLiteStore(os.path.join(tmp, 'state.sqlite')), ShelveStore(os.path.join(tmp, 'state.shelve')),
+                   SQLiteStore(os.path.join(tmp, 'cached.sqlite'))])
+
+    return {
+        'parse.corpus': (lambda: [parser.parse(s) for s in PARSE_CORPUS], len(PARSE_CORPUS)),
+        'parse.cached': (lambda: [parser.cached_parse(s) for s in PARSE_CORPUS], len(PARSE_CORPUS)),
+        'parse.deep': (lambda: parser.parse(parse_deep), 1),
+        'parse.wide': (lambda: parser.parse(parse_wide), 1),
+        'parse.calls': (lambda: parser.parse(parse_calls), 1),
+        'calc.corpus': (evaluator(CALC_CORPUS), len(CALC_CORPUS)),
+        'calc.deep': (evaluator([parse_deep]), 1),
+        'calc.wide': (evaluator([parse_wide]), 1),
+        'calc.calls': (evaluator([parse_calls]), 1),
+        'calc.long': (evaluator([long()]), 1),
+        'units.corpus': (evaluator(UNITS_CORPUS), len(UNITS_CORPUS)),
+        'matrix.corpus': (evaluator(MATRIX_CORPUS), len(MATRIX_CORPUS)),
+        'storage.sqlite': (persistence(stores[0]), 1),
+        'storage.shelve': (persistence(stores[1]), 1),
+        'storage.evaluate': (cached_evaluate(stores[2]), 1),
+    }
+
+
+def measure(fn, min_time, repeat):
+    """Время одной итерации: число итераций подбирается так, чтобы замер длился не меньше min_time.
+    Сборщик мусора на время замера отключается (как в timeit)"""
+    fn()
+
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return timings(fn, min_time, repeat)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def timings(fn, min_time, repeat):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed) + 1))
+
+    times = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+
+    return {'min': min(times), 'median': statistics.median(times), 'number': number, 'repeat': repeat}
+
+
+def run(selected=None, min_time=0.2, repeat=7):
+    """Замер всех (или выбранных) случаев, результат -- словарь для JSON"""
+    with tempfile.TemporaryDirectory() as tmp:
+        results = dict()
+        stores = []
+
+        try:
+            for (name, (fn, items)) in cases(tmp, stores).items():
+                if selected and not any(s in name for s in selected):
+                    continue
+
+                res = measure(fn, min_time, repeat)
+                res['items'] = items
+                results[name] = res
+        finally:
+            for store in stores:
+                store.close()
+
+        return {'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results}
+
+
+def compare(current, baseline, threshold):
+    """Сравнение с базовым замером по минимальному времени: имя -> (отношение или None, регрессия ли)"""
+    res = dict()
+
+    for (name, value) in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            res[name] = (None, False)
+            continue
+
+        ratio = value['min'] / base['min']
+        res[name] = (ratio, ratio > 1 + threshold)
+
+    return res
+
+
+def report(current, comparison=None):
+    print("{:20} {:>12} {:>12} {:>12} {:>9}".format('case', 'min, us', 'median, us', 'per item', 'vs base'))
+
+    for (name, value) in current['results'].items():
+        line = "{:20} {:12.2f} {:12.2f} {:12.2f}".format(name, value['min'] * 1e6, value['median'] * 1e6,
+                                                         value['min'] / value['items'] * 1e6)
+
+        if comparison is not None:
+            (ratio, regression) = comparison[name]
+            if ratio is None:
+                line += " {:>9}".format('new')
+            else:
+                line += " {:8.2f}x".format(ratio) + ("  REGRESSION" if regression else "")
+
+        print(line)
+
+
+def main(args):
+    arg_parser = argparse.ArgumentParser(prog='python -m bench.suite', description="Microbenchmark suite")
+    arg_parser.add_argument('-k', dest='selected', action='append', help="run only cases containing this string")
+    arg_parser.add_argument('--output', help="write results as JSON to this file")
+    arg_parser.add_argument('--baseline', default=BASELINE, help="baseline JSON file")
+    arg_parser.add_argument('--save-baseline', action='store_true', help="store results as the new baseline")
+    arg_parser.add_argument('--threshold', type=float, default=0.25, help="allowed slowdown (0.25 = 25%%)")
+    arg_parser.add_argument('--min-time', type=float, default=0.2, help="minimal duration of one repeat, s")
+    arg_parser.add_argument('--repeat', type=int, default=7)
+    options = arg_parser.parse_args(args)
+
+    current = run(options.selected, options.min_time, options.repeat)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+
+    if options.save_baseline:
+        with open(options.baseline, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+        report(current)
+        return 0
+
+    if not os.path.exists(options.baseline):
+        report(current)
+        print("No baseline at {} (use --save-baseline)".format(options.baseline))
+        return 0
+
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+
+    comparison = compare(current, baseline, options.threshold)
+    report(current, comparison)
+
+    regressions = [name for (name, (_, regression)) in comparison.items() if regression]
+    if regressions:
+        print("Regressions above {:.0%}: {}".format(options.threshold, ', '.join(regressions)))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
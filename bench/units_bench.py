@@ -0,0 +1,66 @@
+"""
+Время холодного старта и одного перевода единиц. Холодный старт измеряется в отдельных процессах: импорт
+calc без обращения к единицам против импорта с немедленным созданием реестра pint (как было раньше).
+Перевод: разбор строки единиц pint при каждом вычислении (как было раньше) против кэша resolve_units.
+
+Запуск: python -m bench.units_bench [число повторов]
+"""
+import subprocess
+import sys
+import timeit
+
+from src import calc
+from src import parser
+
+EXPRESSIONS = ['10{km/h} -> {m/s}', '3.6 {(kg * m) / s} -> {(mg * m) / s}', '5{mile} -> {km}']
+
+COLD = r"""
+import time
+start = time.perf_counter()
+import src.calc
+{}
+print(time.perf_counter() - start)
+"""
+
+
+def cold_start(code, runs=3):
+    """Минимальное время запуска процесса, выполняющего code после импорта calc"""
+    res = []
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', COLD.format(code)])
+        res.append(float(out))
+    return min(res)
+
+
+def main(number=2000):
+    lazy = cold_start('')
+    eager = cold_start('src.calc.get_ureg()')
+    first = cold_start("src.calc.calculate('10{km/h} -> {m/s}', src.calc.Environment())")
+
+    print("cold start:")
+    print("  import with registry (before): {:8.1f} ms".format(eager * 1e3))
+    print("  import, lazy registry (after): {:8.1f} ms".format(lazy * 1e3))
+    print("  import + first conversion:     {:8.1f} ms".format(first * 1e3))
+
+    env = calc.Environment(root=calc.BUILTINS)
+    ureg = calc.get_ureg()
+
+    print("per conversion:")
+    for s in EXPRESSIONS:
+        (_, (_, val, units_from), units_to) = parser.cached_parse(s)
+
+        def before():
+            return (val * ureg(calc.make_units(units_from))).to(ureg(calc.make_units(units_to)))
+
+        def after():
+            return (val * calc.resolve_units(units_from)).to(calc.resolve_units(units_to))
+
+        assert before() == after() == calc.calculate(s, env)
+
+        old = min(timeit.repeat(before, number=number, repeat=3)) / number
+        new = min(timeit.repeat(after, number=number, repeat=3)) / number
+        print("  {:40} {:8.1f} us -> {:8.1f} us ({:.1f}x)".format(s, old * 1e6, new * 1e6, old / new))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
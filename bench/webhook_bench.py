@@ -0,0 +1,188 @@
+"""
+Доставка обновлений: long polling (цикл getUpdates, как в Updater.start_polling) против webhook (WebhookServer)
+на локальной замене Bot API с задержкой сети delay в каждую сторону. Измеряется время от появления обновления
+на стороне API до передачи его обработчику: при равномерном потоке обновлений (задержка, мс) и при пачке
+обновлений, появившихся сразу (пропускная способность, обновлений в секунду). Webhook-отправитель, как и
+Telegram, держит до connections соединений и отправляет следующее обновление по соединению только после ответа.
+
+При постоянном потоке webhook не ждёт повторного запроса getUpdates, поэтому задержка -- одна передача по сети;
+пачку же polling забирает по 100 обновлений за запрос, а webhook -- не быстрее connections за круговую задержку.
+
+Запуск: python -m bench.webhook_bench [число обновлений] [задержка сети, мс] [обновлений в секунду]
+"""
+import http.client
+import json
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.webhook import SECRET_HEADER, WebhookServer
+
+SECRET = 'bench-secret'
+
+
+class BotAPI(object):
+    """Замена Bot API: обновления отдаются getUpdates (long polling) или отправляются на webhook"""
+
+    def __init__(self, delay, webhook=None, connections=40):
+        self.delay = delay
+        self.cond = threading.Condition()
+        self.pending = []
+        self.created = dict()
+        self.next_id = 1
+
+        self.hooks = queue.Queue()
+        self.senders = [threading.Thread(target=self.push, args=(webhook,), daemon=True)
+                        for _ in range(connections if webhook is not None else 0)]
+        for sender in self.senders:
+            sender.start()
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Заголовки и тело ответа пишутся отдельно: без этого ответ задерживается алгоритмом Нейгла
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                args = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                body = json.dumps({'ok': True, 'result': api.get_updates(**args)}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def inject(self):
+        """Новое обновление (сообщение пользователя)"""
+        with self.cond:
+            update = {'update_id': self.next_id,
+                      'message': {'message_id': self.next_id, 'date': int(time.time()), 'text': '2 + 2',
+                                  'chat': {'id': self.next_id % 100, 'type': 'private'}}}
+            self.created[self.next_id] = time.perf_counter()
+            self.next_id += 1
+
+            if self.senders:
+                self.hooks.put(update)
+            else:
+                self.pending.append(update)
+                self.cond.notify_all()
+
+    def get_updates(self, offset, timeout, limit=100):
+        """getUpdates: обновления с номера offset (предыдущие считаются подтверждёнными), ожидание до timeout секунд"""
+        with self.cond:
+            self.pending = [u for u in self.pending if u['update_id'] >= offset]
+            self.cond.wait_for(lambda: self.pending, timeout)
+            res = self.pending[:limit]
+
+        time.sleep(self.delay)
+        return res
+
+    def push(self, url):
+        """Отправитель webhook: одно соединение, следующее обновление -- после ответа на предыдущее"""
+        (host, port, path) = url
+        conn = http.client.HTTPConnection(host, port)
+
+        while True:
+            update = self.hooks.get()
+            if update is None:
+                break
+
+            time.sleep(self.delay)
+            conn.request('POST', path, body=json.dumps(update),
+                         headers={'Content-Type': 'application/json', SECRET_HEADER: SECRET})
+            conn.getresponse().read()
+            time.sleep(self.delay)
+
+        conn.close()
+
+    def close(self):
+        for _ in self.senders:
+            self.hooks.put(None)
+        for sender in self.senders:
+            sender.join()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def poll(api, handle, stop):
+    """Клиент long polling: getUpdates с offset последнего полученного обновления + 1"""
+    conn = http.client.HTTPConnection('127.0.0.1', api.port)
+    offset = 0
+
+    while not stop.is_set():
+        time.sleep(api.delay)
+        conn.request('POST', '/botTOKEN/getUpdates', body=json.dumps({'offset': offset, 'timeout': 0.5}),
+                     headers={'Content-Type': 'application/json'})
+        for update in json.loads(conn.getresponse().read())['result']:
+            handle(update)
+            offset = update['update_id'] + 1
+
+    conn.close()
+
+
+def run(mode, n, delay, rate):
+    """Задержки доставки n обновлений (секунды) и общее время; rate=None -- все обновления сразу"""
+    latencies = []
+    done = threading.Event()
+    stop = threading.Event()
+
+    def handle(update):
+        latencies.append(time.perf_counter() - api.created[update['update_id']])
+        if len(latencies) == n:
+            done.set()
+
+    if mode == 'webhook':
+        server = WebhookServer(handle, SECRET, port=0, path='/hook').start()
+        api = BotAPI(delay, webhook=('127.0.0.1', server.port, '/hook'))
+    else:
+        api = BotAPI(delay)
+        client = threading.Thread(target=poll, args=(api, handle, stop), daemon=True)
+        client.start()
+        # Клиент уже ждёт ответа на getUpdates, как это и бывает в работающем боте
+        time.sleep(3 * delay)
+
+    start = time.perf_counter()
+    for i in range(n):
+        if rate is not None:
+            time.sleep(max(0.0, start + i / rate - time.perf_counter()))
+        api.inject()
+
+    assert done.wait(60)
+    total = time.perf_counter() - start
+
+    if mode == 'webhook':
+        api.close()
+        server.stop()
+    else:
+        stop.set()
+        client.join()
+        api.close()
+
+    return sorted(latencies), total
+
+
+def main(n=500, delay_ms=25, rate=100):
+    delay = delay_ms / 1000
+    print("{} updates, network delay {} ms each way".format(n, delay_ms))
+    print("{:8} {:>12} {:>12} {:>12} {:>16}".format('mode', 'p50, ms', 'p90, ms', 'p99, ms', 'burst, upd/s'))
+
+    for mode in ['polling', 'webhook']:
+        (latencies, _) = run(mode, n, delay, rate)
+        (_, total) = run(mode, n, delay, None)
+
+        (p50, p90, p99) = (latencies[int(len(latencies) * q)] * 1000 for q in (0.5, 0.9, 0.99))
+        print("{:8} {:12.1f} {:12.1f} {:12.1f} {:16.0f}".format(mode, p50, p90, p99, n / total))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
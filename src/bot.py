@@ -1,13 +1,26 @@
 """
-Связь бота непосредственно с Телеграм посредством Telegram API. Используется Shelve -- "словареобразная" база данных  
-для данных каждого пользователя.
+Связь бота непосредственно с Телеграм посредством Telegram API. Данные каждого пользователя хранятся в SQLite
+(см. storage.py; старую базу Shelve можно перенести командой python -m src.storage migrate), справка -- в demo.xml
+(см. helpdoc.py).
 """
 import logging
-import shelve
+import os
+import secrets
+import threading
+from urllib.parse import urlsplit
 
-from telegram.ext import Updater, MessageHandler, Filters
+from telegram import Update
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
 
-from src.calc import *
+from src.calc import Limits
+from src.dispatch import ChatDispatcher, ChatLimits, evaluate
+from src.helpdoc import HelpIndex
+from src.metrics import metrics
+from src.outbox import Outbox
+from src.sandbox import ProcessPool
+from src.shard import Supervisor
+from src.storage import EnvironmentCache, open_store
+from src.webhook import WebhookServer
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -18,49 +31,125 @@ if __name__ == '__main__':
 
     fo.close()
     
-    def helpFn(bot, update,args):
-        dom = xml.dom.minidom.parse('demo.xml')
-        dom.normalize()
-        node1 = dom.getElementsByTagName('help')
-        title = dom.getElementsByTagName('title')
-        if args==[]:
-            for node in title:
-                bot.sendMessage(chat_id=update.message.chat_id, text=node.childNodes[0].nodeValue)
-
-         else:
-           for node in node1:
-            if args[0] == node.getAttribute('id'):
-                bot.sendMessage(chat_id=update.message.chat_id, text=node.childNodes[0].nodeValue)
-
-    with shelve.open("MySuperCoolDataBase", writeback=True) as envs:
+    # Сбор метрик включается переменной окружения BOT_METRICS (без неё на горячем пути остаются только проверки
+    # флага), порог журнала медленных выражений -- BOT_SLOW_THRESHOLD (секунды); отчёт -- команда /stats и файл
+    # metrics.txt, обновляемый раз в минуту
+    metrics.enabled = bool(os.environ.get("BOT_METRICS"))
+    metrics.slow_threshold = float(os.environ.get("BOT_SLOW_THRESHOLD", metrics.slow_threshold))
+
+    # Идентификаторы пользователей, которым доступна команда /stats, -- по одному в строке
+    admins = set()
+    if os.path.exists("admins"):
+        with open("admins") as f:
+            admins = {int(line) for line in f if line.strip()}
+
+    # Ограничения вычислений для отдельных чатов -- строки "chat_id steps depth bits", остальным -- DEFAULT_LIMITS
+    limits = ChatLimits()
+    if os.path.exists("limits"):
+        with open("limits") as f:
+            for line in f:
+                if line.strip():
+                    (chat_id, steps, depth, bits) = map(int, line.split())
+                    limits.set(chat_id, Limits(steps=steps, depth=depth, bits=bits))
+
+    # Справка разбирается при первом /help и заново -- только после изменения файла
+    help_index = HelpIndex('demo.xml')
+
+    # Ответы отправляются потоками очереди с учётом ограничений Telegram (1 сообщение в секунду в чат,
+    # 30 в секунду всего), обработчики не ждут сети
+    outbox = Outbox(lambda chat_id, text: updater.bot.sendMessage(chat_id=chat_id, text=text))
+
+    def helpFn(bot, update, args):
+        for text in help_index.answer(args):
+            outbox.submit(update.message.chat_id, text)
+
+    with open_store("MySuperCoolDataBase.sqlite") as store:
+        # В памяти держатся окружения только недавно активных чатов
+        envs = EnvironmentCache(store, max_entries=10000)
+
+        # Вычисления выполняются в пуле потоков, сообщения одного чата -- по порядку; окружение чата
+        # не вытесняется из памяти, пока его сообщение обрабатывается
+        dispatcher = ChatDispatcher(workers=4, envs=envs)
+
+        # По умолчанию каждое выражение вычисляется в свободном процессе пула с ограничением времени и памяти;
+        # окружение передаётся в процесс заново для каждого сообщения, поэтому результаты мемоизации функций
+        # между сообщениями не сохраняются. С переменной BOT_SHARDS чаты распределяются между BOT_SHARDS
+        # процессами, каждый из которых сам вычисляет выражения своих чатов и хранит их окружения вместе
+        # с результатами мемоизации (см. shard.py)
+        shards = int(os.environ.get("BOT_SHARDS", 0))
+        supervisor = None
+        sandbox = None
+
+        if shards:
+            supervisor = Supervisor("MySuperCoolDataBase.sqlite", outbox.submit, workers=shards, limits=limits)
+        else:
+            sandbox = ProcessPool(workers=4, timeout=5.0, memory=1 << 30)
+
+        def reply(bot, chat_id, text):
+            outbox.submit(chat_id, evaluate(envs, chat_id, text, sandbox, limits))
+
         def text_handler(bot, update):
             """Обработчик сообщений"""
             chat_id = update.message.chat_id
-            s_chat_id = str(chat_id)
 
-            if s_chat_id not in envs:
-                data = Environment().get_data()
-                envs[s_chat_id] = data
+            if supervisor is not None:
+                supervisor.submit(chat_id, update.message.text)
+            else:
+                dispatcher.submit(chat_id, reply, bot, chat_id, update.message.text)
 
-            text = update.message.text
+        def statsFn(bot, update):
+            """Отчёт о метриках (только для администраторов)"""
+            if update.message.from_user.id not in admins:
+                return
 
-            try:
-                data = envs[s_chat_id]
-                env_calc = Environment()
-                env_calc.set_data(data)
+            outbox.submit(update.message.chat_id, metrics.report()[:4096])
 
-                res = str(calculate(text, env_calc))
+        updater.dispatcher.add_handler(CommandHandler('help', helpFn, pass_args=True))
 
-                envs[s_chat_id] = env_calc.get_data()
-            except RuntimeError as e:
-                res = str(e.args)
+        updater.dispatcher.add_handler(CommandHandler('stats', statsFn))
 
-            bot.sendMessage(chat_id=chat_id, text=res)
-            envs.sync()
-            
-        updater.dispatcher.add_handler(CommandHandler('help', helpFn, pass_args=True))
-        
         updater.dispatcher.add_handler(MessageHandler(Filters.text, text_handler))
 
-        updater.start_polling()
+        if metrics.enabled:
+            updater.job_queue.run_repeating(lambda bot, job: metrics.dump("metrics.txt"), interval=60)
+
+        # Режим webhook включается переменной BOT_WEBHOOK_URL (публичный адрес, TLS завершает обратный прокси,
+        # который передаёт запросы на BOT_WEBHOOK_HOST:BOT_WEBHOOK_PORT); без неё -- long polling
+        webhook_url = os.environ.get("BOT_WEBHOOK_URL")
+        server = None
+
+        if webhook_url:
+            secret = os.environ.get("BOT_WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+
+            # Принятые обновления передаются тем же обработчикам через очередь диспетчера telegram.ext
+            server = WebhookServer(lambda data: updater.update_queue.put(Update.de_json(data, updater.bot)), secret,
+                                   host=os.environ.get("BOT_WEBHOOK_HOST", "127.0.0.1"),
+                                   port=int(os.environ.get("BOT_WEBHOOK_PORT", 8443)),
+                                   path=urlsplit(webhook_url).path or '/')
+            server.start()
+
+            updater.bot.set_webhook(url=webhook_url, secret_token=secret)
+
+            threading.Thread(target=updater.dispatcher.start, name='dispatcher', daemon=True).start()
+            updater.job_queue.start()
+
+            # idle() останавливает диспетчер и очередь задач по сигналу, только если updater считается запущенным
+            updater.running = True
+        else:
+            updater.start_polling()
+
         updater.idle()
+
+        if server is not None:
+            server.stop()
+
+        dispatcher.shutdown()
+        if supervisor is not None:
+            supervisor.shutdown()
+        else:
+            sandbox.close()
+        outbox.shutdown()
+        envs.flush()
+
+        if metrics.enabled:
+            metrics.dump("metrics.txt")
@@ -0,0 +1,94 @@
+"""
+Вспомогательный модуль с ограниченным по размеру LRU-кэшем, который используется для хранения результатов
+разбора выражений и других повторно используемых вычислений. Кэш ведёт счётчики попаданий, промахов и вытеснений,
+по которым можно подобрать его размер под реальную нагрузку. Кэш можно использовать из нескольких потоков
+(общие кэши модулей, например parser.parse_cache и calc.units_cache, используются всеми потоками пула
+ChatDispatcher): операции выполняются под блокировкой.
+"""
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Словарь ограниченного размера, вытесняющий давно не использовавшиеся элементы"""
+
+    def __init__(self, maxsize=1024):
+        if maxsize < 0:
+            raise ValueError("Cache size must be non-negative")
+
+        self.lock = threading.Lock()
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Получение значения с обновлением порядка использования"""
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Добавление значения, при переполнении вытесняется самый старый элемент"""
+        if self.maxsize == 0:
+            return
+
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            self.__shrink()
+
+    def pop(self, key, default=None):
+        """Удаление значения из кэша"""
+        with self.lock:
+            return self.data.pop(key, default)
+
+    def keys(self):
+        """Ключи в порядке от давно использованных к недавним"""
+        with self.lock:
+            return list(self.data.keys())
+
+    def resize(self, maxsize):
+        """Изменение размера кэша (лишние элементы вытесняются)"""
+        if maxsize < 0:
+            raise ValueError("Cache size must be non-negative")
+
+        with self.lock:
+            self.maxsize = maxsize
+            self.__shrink()
+
+    def __shrink(self):
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Очистка кэша вместе со статистикой"""
+        with self.lock:
+            self.data.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """Статистика использования кэша"""
+        with self.lock:
+            return {'size': len(self.data),
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
@@ -8,74 +8,288 @@
 осуществлена работа с тригонометрическими функциями(sin, cos, tan), логарифмическими(ln, lg, log2), sqrt, pow, основными 
 арифметическими операциями и любыми сложными пользовательскими функциями на основе перечисленных.
 """
+import contextlib
+import importlib
 import math
 import operator
+import sys
+import threading
+import time
 from numbers import Number
 
-import numpy as np
-import pint
-
 from src import parser
+from src.cache import LRUCache
+from src.metrics import metrics
+
+"""Реестр единиц pint создаётся при первом обращении к единицам измерения (см. get_ureg)"""
+_ureg = None
+_ureg_lock = threading.Lock()
+
+"""Кэш разрешённых единиц: дерево единиц -> величина pint"""
+units_cache = LRUCache(1024)
+
+
+def get_ureg():
+    """Реестр единиц измерения (создание реестра -- самая долгая часть запуска, поэтому оно отложено)"""
+    global _ureg
+
+    if _ureg is None:
+        with _ureg_lock:
+            if _ureg is None:
+                import pint
+                _ureg = pint.UnitRegistry()
+
+    return _ureg
+
+
+def __getattr__(name):
+    # calc.ureg по-прежнему доступен, но реестр создаётся только при обращении
+    if name == 'ureg':
+        return get_ureg()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def resolve_units(units):
+    """Units-tree -> Quantity
+    Единицы измерения по дереву разбора; строка разбирается pint только при первом обращении"""
+    key = parser.freeze(units)
+
+    res = units_cache.get(key)
+    if res is None:
+        res = get_ureg()(make_units(units))
+        units_cache.put(key, res)
+
+    return res
+
+
+def numpy():
+    """Модуль numpy; импортируется при первом выражении, которому он нужен (простая арифметика обходится без него)"""
+    import numpy
+    return numpy
+
+
+def numpy_errors_ignored():
+    """Контекст, в котором numpy не выдаёт предупреждений (если numpy ещё не загружен, их и так не будет)"""
+    np = sys.modules.get('numpy')
+    if np is None:
+        return contextlib.nullcontext()
+    return np.errstate(all='ignore')
+
+
+class LazyFunction(object):
+    """Встроенная функция из модуля, который импортируется при первом её вызове. Если задана стадия stage,
+    время вызовов учитывается в метриках (при включённом сборе)"""
+
+    def __init__(self, module, name, stage=None):
+        self.module = module
+        self.name = name
+        self.stage = stage
+        self.function = None
+
+    def load(self):
+        if self.function is None:
+            self.function = getattr(importlib.import_module(self.module), self.name)
+        return self.function
+
+    def __call__(self, *args):
+        if self.stage is not None and metrics.enabled:
+            return metrics.timed(self.stage, self.function or self.load(), *args)
+        return (self.function or self.load())(*args)
+
+    def __reduce__(self):
+        return LazyFunction, (self.module, self.name, self.stage)
+
+    def __repr__(self):
+        return '{}.{}'.format(self.module, self.name)
+
+
+def resolve(fn):
+    """Сама функция вместо отложенной (ScalarFunction -- она же: быстрые реализации для чисел питона)"""
+    return fn.load() if type(fn) is LazyFunction else fn
+
+
+"""Скалярные типы, произведение с которыми всегда поэлементное"""
+SCALARS = frozenset([int, float, complex, bool])
+
+"""Граница int64: большие по модулю целые numpy обрабатывает как объекты питона, а не как числа"""
+INT64 = 2 ** 63
+
+"""Тип результата быстрой реализации -> скаляр numpy, который для тех же аргументов возвращает numpy
+(заполняется при первом вызове numpy_scalar, чтобы не импортировать numpy заранее)"""
+NUMPY_SCALARS = dict()
+
+
+def numpy_scalar(x):
+    """Число питона -> тот же скаляр numpy (int64, float64, complex128)"""
+    if not NUMPY_SCALARS:
+        np = numpy()
+        NUMPY_SCALARS.update({int: np.int64, float: np.float64, complex: np.complex128})
+    return NUMPY_SCALARS[type(x)](x)
+
+
+class ScalarFunction(LazyFunction):
+    """Встроенная функция numpy с быстрыми реализациями для чисел питона: scalar -- таблица тип первого аргумента ->
+    реализация. Реализация возвращает NotImplemented (или выбрасывает ValueError, OverflowError), если аргументы --
+    не её случай, тогда значение вычисляет numpy. Результат быстрой реализации приводится к тому же скаляру numpy
+    (int64, float64, complex128), который вернул бы numpy, поэтому дальнейшая арифметика не меняется: целые
+    переполняются по модулю 2 ** 64, деление на ноль даёт inf. Быстрые реализации есть только там, где их
+    результат совпадает с результатом numpy до бита: на процессорах с AVX-512 numpy вычисляет tan, логарифмы,
+    вещественную степень и функции комплексного аргумента своими векторными реализациями, которые отличаются
+    от math и cmath в последнем знаке. Целые больше int64 numpy обрабатывает как объекты питона и для sin, cos
+    и sqrt выдаёт ошибку; math вычисляет и их. Функции без быстрых реализаций (tan, логарифмы) остаются
+    LazyFunction: поиск по таблице только замедлил бы их"""
+
+    def __init__(self, module, name, scalar=None):
+        super().__init__(module, name)
+        self.scalar = scalar or dict()
+
+    def __call__(self, *args):
+        fast = self.scalar.get(type(args[0]))
+
+        if fast is not None:
+            try:
+                res = fast(*args)
+                if res is not NotImplemented:
+                    return numpy_scalar(res)
+            except (ValueError, OverflowError):
+                pass
+
+        return (self.function or self.load())(*args)
+
+    def __reduce__(self):
+        return ScalarFunction, (self.module, self.name, self.scalar)
+
+
+def real_sqrt(x):
+    """Квадратный корень как у numpy.lib.scimath.sqrt: из отрицательного числа -- комплексный"""
+    if x < 0:
+        return complex(0.0, math.sqrt(-x))
+    return math.sqrt(x)
+
+
+def int_power(x, y):
+    """Целая степень целого числа, если результат помещается в int64 (иначе numpy.power переполняется или
+    выдаёт ошибку, и это поведение сохраняется)"""
+    if type(y) is int and -INT64 <= x < INT64 and 0 <= y < INT64 and x.bit_length() * y <= 128:
+        res = x ** y
+        if -INT64 <= res < INT64:
+            return res
+    return NotImplemented
+
 
-ureg = pint.UnitRegistry()
+def multiply(x, y):
+    """Умножение: для двух матриц (двумерных массивов) -- матричное, в остальных случаях -- поэлементное"""
+    if type(x) in SCALARS or type(y) in SCALARS:
+        return x * y
+    if getattr(x, 'ndim', 0) == 2 and getattr(y, 'ndim', 0) == 2:
+        return x @ y
+    return x * y
+
+
+def map_function(f, xs):
+    """Встроенная функция map(f, xs): вычисление функции f сразу для всех элементов массива xs.
+    Первым аргументом передаётся имя функции, поэтому вызов обрабатывается при вычислении (см. apply_map)"""
+    raise RuntimeError("Function map must be called as map(function_name, array)")
+
+
+class Deleted(object):
+    """Метка имени, удалённого пользователем, но определённого в неизменяемом корневом окружении"""
+
+    def __reduce__(self):
+        return 'DELETED'
+
+    def __repr__(self):
+        return 'DELETED'
+
+
+DELETED = Deleted()
 
 
 class Environment(object):
     """Класс окружений, сохраняет функции и переменные, множество окружений имеет древовидную иерархию"""
 
+    readonly = False
+    budget = None
+    memo = None
+
     def __make(self):
         """Встроенные переменные и функции"""
         self.variables = {'e': math.e, 'pi': math.pi}
         self.functions = {'+': (2, operator.add),
                           '-': (2, operator.sub),
                           'neg': (1, operator.neg),
-                          '*': (2, operator.mul),
+                          '*': (2, multiply),
                           '/': (2, operator.truediv),
-                          'pow': (2, np.power),
-                          'sin': (1, np.sin),
-                          'cos': (1, np.cos),
-                          'tan': (1, np.tan),
-                          'ln': (1, np.log),
-                          'lg': (1, np.log10),
-                          'log2': (1, np.log2),
-                          'sqrt': (1, np.lib.emath.sqrt),
-                          'T': (1, np.transpose),
-                          'tr': (1, np.trace),
-                          'D': (1, np.linalg.det),
-                          'rk': (1, np.linalg.matrix_rank),
-                          'inv': (1, np.linalg.inv)}
+                          'pow': (2, ScalarFunction('numpy', 'power', {int: int_power})),
+                          'sin': (1, ScalarFunction('numpy', 'sin', {float: math.sin, int: math.sin})),
+                          'cos': (1, ScalarFunction('numpy', 'cos', {float: math.cos, int: math.cos})),
+                          'tan': (1, LazyFunction('numpy', 'tan')),
+                          'ln': (1, LazyFunction('numpy', 'log')),
+                          'lg': (1, LazyFunction('numpy', 'log10')),
+                          'log2': (1, LazyFunction('numpy', 'log2')),
+                          'sqrt': (1, ScalarFunction('numpy.lib.scimath', 'sqrt', {float: real_sqrt, int: real_sqrt})),
+                          'T': (1, LazyFunction('numpy', 'transpose')),
+                          'tr': (1, LazyFunction('numpy', 'trace')),
+                          'D': (1, LazyFunction('numpy.linalg', 'det', 'linalg')),
+                          'rk': (1, LazyFunction('numpy.linalg', 'matrix_rank', 'linalg')),
+                          'inv': (1, LazyFunction('numpy.linalg', 'inv', 'linalg')),
+                          'range': (3, LazyFunction('numpy', 'arange')),
+                          'map': (2, map_function)}
 
         for (key, val) in self.functions.items():
             self.functions[key] = True, val
 
     def __init__(self, root=None):
+        self.changed = False
+
         if root is None:
             self.root = None
             self.__make()
         else:
             self.root = root
+            self.budget = root.budget
+            self.memo = root.memo
             self.variables = dict()
             self.functions = dict()
 
     def set_var(self, variable, value):
         """Установка переменной"""
         self.variables[variable] = value
+        self.changed = True
 
     def del_var(self, variable):
-        """Рекурсивное удаление переменной"""
+        """Рекурсивное удаление переменной (имя из неизменяемого корня скрывается меткой DELETED)"""
         if variable in self.variables:
+            if self.variables[variable] is DELETED:
+                return
+
             del self.variables[variable]
+            self.changed = True
+
+            if self.root is not None and self.root.readonly and variable in self.root.variables:
+                self.variables[variable] = DELETED
             return
 
         if self.root is None:
             return
 
+        if self.root.readonly:
+            if variable in self.root.variables:
+                self.variables[variable] = DELETED
+                self.changed = True
+            return
+
         self.root.del_var(variable)
 
     def get_var(self, variable):
         """Рекурсивное получение значения переменной"""
         if variable in self.variables:
-            return self.variables[variable]
+            value = self.variables[variable]
+
+            if value is DELETED:
+                raise RuntimeError("Variable {} not found".format(variable))
+
+            return value
 
         if self.root is None:
             raise RuntimeError("Variable {} not found".format(variable))
@@ -84,26 +298,50 @@ class Environment(object):
 
     def set_function(self, function, arity, body):
         """Установка функции"""
-        if function in self.functions and self.functions[function][0]:
+        entry = self.functions.get(function)
+
+        if entry is None and self.root is not None and self.root.readonly:
+            entry = self.root.functions.get(function)
+
+        if entry is not None and entry is not DELETED and entry[0]:
             raise RuntimeError('Trying overwrite a built-in function')
 
         self.functions[function] = (False, (arity, body))
+        self.changed = True
 
     def del_function(self, function):
-        """Рекурсивное удаление функции"""
+        """Рекурсивное удаление функции (имя из неизменяемого корня скрывается меткой DELETED)"""
         if function in self.functions:
+            if self.functions[function] is DELETED:
+                return
+
             del self.functions[function]
+            self.changed = True
+
+            if self.root is not None and self.root.readonly and function in self.root.functions:
+                self.functions[function] = DELETED
             return
 
         if self.root is None:
             return
 
+        if self.root.readonly:
+            if function in self.root.functions:
+                self.functions[function] = DELETED
+                self.changed = True
+            return
+
         self.root.del_function(function)
 
     def get_function(self, function):
         """Рекурсивное получение функции"""
         if function in self.functions:
-            return self.functions[function]
+            entry = self.functions[function]
+
+            if entry is DELETED:
+                raise RuntimeError("Function {} not found".format(function))
+
+            return entry
 
         if self.root is None:
             raise RuntimeError("Function {} not found".format(function))
@@ -127,113 +365,1108 @@ class Environment(object):
         return [self.variables, self.functions]
 
     def set_data(self, data):
+        """Загрузка сохранённых данных; флаг changed показывает, отличаются ли данные от загруженных"""
+        if self.root is not None and self.root.readonly:
+            overlay = self.root.overlay_data(data)
+            self.changed = overlay is not data
+            data = overlay
+        else:
+            self.changed = False
+
         self.variables = data[0]
         self.functions = data[1]
 
+    def snapshot(self):
+        """Состояние собственных определений окружения (для отката)"""
+        return dict(self.variables), dict(self.functions), self.changed
 
-def calculate(s, env):
-    """String, Environment -> Complex
-        Выполнение вычисления в контексте окружения"""
+    def restore(self, state):
+        """Откат к состоянию snapshot; мемоизация функций, зависящих от изменённых имён, сбрасывается"""
+        (variables, functions, changed) = state
+
+        names = {name for (old, new) in ((variables, self.variables), (functions, self.functions))
+                 for name in old.keys() | new.keys() if old.get(name, MISSING) is not new.get(name, MISSING)}
+
+        self.variables = variables
+        self.functions = functions
+        self.changed = changed
+
+        for name in names:
+            invalidate(self, name)
+
+
+"""Встроенные имена в данных старого формата (полных копиях таблиц корневого окружения)"""
+LEGACY_VARIABLES = ('e', 'pi')
+LEGACY_FUNCTIONS = ('+', '-', 'neg', '*', '/', 'pow', 'sin', 'cos', 'tan', 'ln', 'lg', 'log2', 'sqrt', 'T', 'tr', 'D',
+                    'rk', 'inv')
+
+
+class BuiltinEnvironment(Environment):
+    """Неизменяемое корневое окружение со встроенными переменными и функциями. Создаётся один раз на процесс,
+    пользовательские окружения ссылаются на него как на корень и хранят только собственные определения"""
+
+    readonly = True
+
+    def __init__(self):
+        super().__init__()
+
+    def __read_only(self, *args):
+        raise RuntimeError("Built-in environment is read-only")
+
+    set_var = del_var = set_function = del_function = set_data = __read_only
+
+    def overlay_data(self, data):
+        """Приведение данных пользователя к виду надстройки над этим окружением. Данные старого формата
+        (полная копия таблиц вместе со встроенными функциями; в них всегда есть "+", который нельзя удалить)
+        заменяются разницей с корнем: совпадающие встроенные имена отбрасываются, удалённые помечаются DELETED.
+        Удалёнными считаются только имена, которые были в таблицах старого формата: встроенных функций, добавленных
+        позже (range, map), в старых данных нет, но пользователь их не удалял"""
+        (variables, functions) = data
+
+        if '+' not in functions:
+            return data
+
+        overlay_variables = dict()
+        for (key, val) in variables.items():
+            if key not in self.variables or type(val) is not type(self.variables[key]) or val != self.variables[key]:
+                overlay_variables[key] = val
+
+        overlay_functions = {key: val for (key, val) in functions.items() if not val[0]}
+
+        for key in LEGACY_VARIABLES:
+            if key not in variables:
+                overlay_variables[key] = DELETED
+
+        for key in LEGACY_FUNCTIONS:
+            if key not in functions:
+                overlay_functions[key] = DELETED
+
+        return [overlay_variables, overlay_functions]
+
+
+"""Общее для всех пользователей корневое окружение"""
+BUILTINS = BuiltinEnvironment()
+
+
+class Limits(object):
+    """Ограничения на вычисление одного выражения: число шагов (применений функций), глубина вызовов
+    пользовательских функций и размер целочисленного результата в битах"""
+
+    def __init__(self, steps=100000, depth=100, bits=100000):
+        self.steps = steps
+        self.depth = depth
+        self.bits = bits
+
+    def __repr__(self):
+        return "Limits(steps={}, depth={}, bits={})".format(self.steps, self.depth, self.bits)
+
+
+DEFAULT_LIMITS = Limits()
+
+
+class BudgetExceeded(RuntimeError):
+    """Превышено одно из ограничений Limits"""
+
+    def __init__(self, limit, value):
+        super().__init__("Evaluation budget exceeded: {} limit is {}".format(limit, value))
+        self.limit = limit
+
+
+class Budget(object):
+    """Расход ограничений при вычислении одного выражения (доступен вычислению через env.budget)"""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.steps = 0
+        self.depth = 0
+
+    def step(self):
+        self.steps += 1
+        if self.steps > self.limits.steps:
+            raise BudgetExceeded('steps', self.limits.steps)
+
+    def check_bits(self, bits):
+        """Проверка размера целого результата до его вычисления"""
+        if bits > self.limits.bits:
+            raise BudgetExceeded('bits', self.limits.bits)
+
+    def charge(self, steps, bits):
+        """Расход ограничений вычисления, выполненного заранее (свёрнутой константы)"""
+        self.steps += steps
+        if self.steps > self.limits.steps:
+            raise BudgetExceeded('steps', self.limits.steps)
+        self.check_bits(bits)
+
+    def check_power(self, x, y):
+        """Проверка размера целой степени x ^ y до её вычисления (оценка сверху -- x.bit_length() * y)"""
+        if type(x) is int and type(y) is int and y > 0 and not -1 <= x <= 1:
+            self.check_bits(x.bit_length() * y)
+
+
+"""Отсутствие значения в таблице мемоизации"""
+MISSING = object()
+
+
+class Memo(object):
+    """Таблица результатов чистых пользовательских функций окружения. Функция чистая, если её тело зависит
+    только от параметров, встроенных переменных и функций и других чистых функций. Ключ -- имя функции,
+    значения аргументов (только числа) и текущие значения встроенных переменных, от которых зависит тело.
+    Записи функции удаляются при def, undef, set или unset любого имени, от которого она зависит"""
+
+    def __init__(self, maxsize=4096):
+        self.results = LRUCache(maxsize)
+        self.purity = dict()
+
+    def analyze(self, f, fn, env):
+        """Анализ чистоты функции: (чистая ли, свободные переменные); результат кэшируется до изменения
+        зависимостей"""
+        (f_vars, body) = fn
+
+        info = self.purity.get(f)
+        if info is not None and info[0] is body:
+            return info[1], info[2]
+
+        # Рекурсивный вызов анализируемой функции считается чистым
+        self.purity[f] = (body, True, (), frozenset([f]))
+
+        try:
+            (pure, variables, deps) = purity(body, frozenset(f_vars), self, env)
+        except RuntimeError:
+            (pure, variables, deps) = (False, (), frozenset())
+
+        self.purity[f] = (body, pure, tuple(sorted(variables)), deps | {f})
+        return pure, self.purity[f][2]
+
+    def invalidate(self, name):
+        """Удаление записей функций, зависящих от имени name"""
+        stale = {f for (f, (_, _, _, deps)) in self.purity.items() if name in deps}
+        stale.add(name)
+
+        for f in stale:
+            self.purity.pop(f, None)
+
+        for key in self.results.keys():
+            if key[0] in stale:
+                self.results.pop(key)
+
+    def stats(self):
+        """Статистика попаданий"""
+        res = self.results.stats()
+        total = res['hits'] + res['misses']
+        res['hit_rate'] = res['hits'] / total if total else 0.0
+        return res
+
+
+def purity(expr, params, memo, env):
+    """Labeled-value, Set(String), Memo, Environment -> (Bool, Set(String), Set(String))
+    Чистота выражения, встроенные переменные, от которых оно зависит, и все имена, от которых оно зависит
+    (обход с явным стеком, прекращается на первом нечистом узле)"""
+    variables = set()
+    deps = set()
+    stack = [expr]
+
+    while stack:
+        x = stack.pop()
 
-    def make_matrix(x):
-        """Построение массива для создания матрицы"""
         if isinstance(x, Number):
-            return x
-        if x[0] == "matrix":
-            return [make_matrix(y) for y in x[1]]
+            continue
 
-    def make_units(x):
         if isinstance(x, str):
-            return x
-        if x[0] == "unit_mul":
-            a = make_units(x[1])
-            b = make_units(x[2])
-            return '({} * {})'.format(a, b)
-        if x[0] == "unit_div":
-            a = make_units(x[1])
-            b = make_units(x[2])
-            return '({} / {})'.format(a, b)
-
-    def evl(expr, env):
-        """Вычислене выражения в окружении"""
-        if isinstance(expr, Number):
-            return expr
-
-        if isinstance(expr, str):
-            if expr not in ["set", "apply", "unset", "def", "undef", "matrix", "with_units", "convert"]:
-                return env.get_var(expr)
-
-        (expr_type, *expr_body) = expr
+            if x in params or x in KEYWORDS:
+                continue
+            if x in BUILTINS.variables:
+                variables.add(x)
+                deps.add(x)
+                continue
+            return False, variables, frozenset(deps)
+
+        (expr_type, *expr_body) = x
 
         if expr_type == "matrix":
-            return np.matrix(make_matrix(expr))
+            stack.extend(reversed(expr_body[0]))
+            continue
 
-        if expr_type == "with_units":
-            val, units = expr_body
-            return evl(val, env) * ureg(make_units(units))
+        if expr_type in ("with_units", "convert"):
+            stack.append(expr_body[0])
+            continue
 
-        if expr_type == "convert":
-            val, units = expr_body
-            return evl(val, env).to(ureg(make_units(units)))
+        if expr_type == "folded":
+            stack.append(expr_body[3])
+            continue
 
-        if expr_type == "set":
-            (variable, value_expr) = expr_body
-            env.set_var(variable, evl(value_expr, env))
-            return
+        if expr_type != "apply":
+            return False, variables, frozenset(deps)
 
-        if expr_type == "unset":
-            env.del_var(expr_body[0])
-            return
+        (f, f_args) = expr_body
+        stack.extend(reversed(f_args))
 
-        if expr_type == "def":
-            (f_name, f_args, f_body) = expr_body
+        if f in OPERATORS:
+            continue
 
-            arity = len(f_args)
-            if arity != len(set(f_args)):
-                raise RuntimeError("All args. must be uniq.")
+        deps.add(f)
+        (builtin, (_, fn)) = env.get_function(f)
 
-            env.set_function(f_name, arity, (f_args, f_body))
+        if builtin:
+            continue
 
-            return
+        (pure, _) = memo.analyze(f, fn, env)
+        variables.update(memo.purity[f][2])
+        deps.update(memo.purity[f][3])
 
-        if expr_type == "undef":
-            env.del_function(expr_body[0])
-            return
+        if not pure:
+            return False, variables, frozenset(deps)
+
+    return True, variables, frozenset(deps)
+
+
+def memo_key(value):
+    """Ключ значения аргумента для таблицы мемоизации (None, если значение нельзя использовать как ключ).
+    Тип входит в ключ, так как 1, 1.0 и True равны, но дают разные результаты; знак нуля -- по той же причине"""
+    if isinstance(value, float):
+        return type(value), value, math.copysign(1.0, value)
+    if isinstance(value, complex):
+        return type(value), value, math.copysign(1.0, value.real), math.copysign(1.0, value.imag)
+    if isinstance(value, Number):
+        return type(value), value
+    return None
+
+
+def invalidate(env, name):
+    """Сброс мемоизации функций, зависящих от изменённого имени"""
+    if env.memo is not None:
+        env.memo.invalidate(name)
+
+
+def make_matrix(x):
+    """Построение вложенных списков для постоянного литерала матрицы (None, если в литерале есть не только числа)"""
+    if isinstance(x, Number):
+        return x
+    if x[0] == "matrix":
+        res = [make_matrix(y) for y in x[1]]
+        if any(y is None for y in res):
+            return None
+        return res
+
+
+def make_array(data):
+    """Матрица из вложенных списков: двумерный (не меньше) массив numpy, тип элементов -- наименьший общий
+    для литерала (целые не превращаются в вещественные, вещественные -- в комплексные)"""
+    try:
+        return numpy().array(data, ndmin=2)
+    except ValueError:
+        raise RuntimeError("Matrix rows must have the same length")
+
+
+def make_units(x):
+    """Построение строки с единицами измерения для pint"""
+    if isinstance(x, str):
+        return x
+    if x[0] == "unit_mul":
+        a = make_units(x[1])
+        b = make_units(x[2])
+        return '({} * {})'.format(a, b)
+    if x[0] == "unit_div":
+        a = make_units(x[1])
+        b = make_units(x[2])
+        return '({} / {})'.format(a, b)
+
+
+"""Служебные слова дерева разбора; переменная с таким именем, как и раньше, вычисляется в None"""
+KEYWORDS = frozenset(["set", "apply", "unset", "def", "undef", "matrix", "with_units", "convert"])
+
+"""Арифметические операторы: пользователь не может ни переопределить, ни удалить их (это не имена),
+поэтому они связываются с реализацией при компиляции"""
+OPERATORS = {'+': operator.add,
+             '-': operator.sub,
+             '*': multiply,
+             '/': operator.truediv}
+
+
+def optimize(expr):
+    """Labeled-value -> Labeled-value
+    Свёртка констант в выражении верхнего уровня (результат сохраняется в неизменяемом узле)"""
+    try:
+        return expr.optimized
+    except AttributeError:
+        pass
+
+    res = fold(expr)
+
+    if isinstance(expr, parser.FrozenAST):
+        expr.optimized = res
+
+    return res
+
+
+def fold(expr, bound=frozenset()):
+    """Labeled-value, Set(String) -> Labeled-value
+    Свёртка поддеревьев, состоящих только из литералов, встроенных констант и чистых встроенных функций.
+    bound -- имена параметров функции, они не сворачиваются. Так как встроенные имена пользователь может
+    переопределить или удалить (а из-за динамической области видимости их могут перекрыть и параметры
+    вызывающих функций), свёрнутое значение с такими зависимостями сохраняется в узле "folded" вместе с
+    исходным поддеревом и используется только если при вычислении имена по-прежнему встроенные.
+
+    Свёрнутое значение вычисляется без ограничений Limits, поэтому в узле "folded" сохраняется и расход: число
+    шагов и наибольшая оценка размера целого результата, они учитываются при каждом использовании значения.
+    Целые произведения, оценка которых не больше FREE_BITS, сворачиваются в число без узла "folded", а то,
+    что превысило бы DEFAULT_LIMITS, не сворачивается и вычисляется при выполнении"""
+    (res, _) = fold_constant(expr, bound)
+    return res
+
+
+def fold_constant(expr, bound):
+    """Labeled-value, Set(String) -> (Labeled-value, Constant or None)
+    Свёрнутое поддерево и, если оно постоянно, (значение, переменные, функции, шаги, биты).
+    Неглубокие деревья сворачиваются рекурсивно, глубокие -- обходом с явным стеком: узел сворачивается после
+    своих детей, результаты детей лежат на вершине results"""
+    if parser.height(expr) <= parser.DEEP:
+        return fold_shallow(expr, bound)
+
+    results = []
+    stack = [(expr, bound, False)]
+
+    while stack:
+        (x, names, visited) = stack.pop()
+        children = fold_children(x, names)
+
+        if children and not visited:
+            stack.append((x, names, True))
+            stack.extend((y, y_names, False) for (y, y_names) in reversed(children))
+            continue
+
+        folded = results[len(results) - len(children):]
+        del results[len(results) - len(children):]
+        results.append(fold_node(x, names, folded))
+
+    return results[0]
+
+
+def fold_shallow(expr, bound):
+    """Рекурсивная свёртка дерева, высота которого не больше parser.DEEP"""
+    if not isinstance(expr, list):
+        return fold_node(expr, bound, ())
+    return fold_node(expr, bound, [fold_shallow(x, names) for (x, names) in fold_children(expr, bound)])
+
+
+def fold_children(expr, bound):
+    """Поддеревья узла, которые сворачиваются до него, вместе с именами параметров в их области видимости"""
+    if isinstance(expr, Number) or isinstance(expr, str):
+        return []
+
+    expr_type = expr[0]
+
+    if expr_type == "apply":
+        return [(x, bound) for x in expr[2]]
+
+    if expr_type == "set":
+        return [(expr[2], bound)]
+
+    if expr_type == "def":
+        return [(expr[3], bound | frozenset(expr[2]))]
+
+    if expr_type in ("with_units", "convert"):
+        return [(expr[1], bound)]
+
+    return []
+
+
+def fold_node(expr, bound, folded):
+    """Свёртка узла по уже свёрнутым поддеревьям folded (результатам fold_constant для fold_children)"""
+    if isinstance(expr, Number):
+        return expr, (expr, (), (), 0, 0)
+
+    if isinstance(expr, str):
+        if expr not in bound and expr in BUILTINS.variables:
+            return expr, (BUILTINS.variables[expr], (expr,), (), 0, 0)
+        return expr, None
+
+    (expr_type, *expr_body) = expr
 
-        if expr_type == "apply":
-            (f_name, f_args) = expr_body
+    if expr_type == "apply":
+        return fold_apply(expr, folded)
 
-            return apply(f_name, f_args, env)
+    if expr_type == "set":
+        (variable, value_expr) = expr_body
+        value = folded[0][0]
+        return (expr if value is value_expr else parser.FrozenAST(["set", variable, value])), None
 
-    def apply(f, f_args, env):
-        """Применение функции к аргументам (создаётся под-окружение для вычисления)"""
-        (builtin, (arity, fn)) = env.get_function(f)
+    if expr_type == "def":
+        (f_name, f_args, f_body) = expr_body
+        body = folded[0][0]
+        return (expr if body is f_body else parser.FrozenAST(["def", f_name, f_args, body])), None
+
+    if expr_type in ("with_units", "convert"):
+        (val, units) = expr_body
+        res = folded[0][0]
+        return (expr if res is val else parser.FrozenAST([expr_type, res, units])), None
+
+    if expr_type == "program":
+        statements = [optimize(x) for x in expr_body[0]]
+        if all(x is y for (x, y) in zip(statements, expr_body[0])):
+            return expr, None
+        return parser.FrozenAST(["program", parser.FrozenAST(statements)]), None
+
+    return expr, None
+
+
+def fold_apply(expr, folded):
+    """Свёртка применения функции"""
+    (_, f, f_args) = expr
+
+    if all(const is not None for (_, const) in folded):
+        values = [value for (_, (value, _, _, _, _)) in folded]
+        variables = unique(name for (_, (_, names, _, _, _)) in folded for name in names)
+        functions = unique(name for (_, (_, _, names, _, _)) in folded for name in names)
+        steps = sum(const[3] for (_, const) in folded)
+        bits = max([const[4] for (_, const) in folded] + [int_bits(f, values)])
+
+        if f in OPERATORS and len(values) == 2:
+            fn = OPERATORS[f]
+        elif f in BUILTINS.functions and BUILTINS.functions[f][1][0] == len(values):
+            fn = resolve(BUILTINS.functions[f][1][1])
+            functions = unique(functions + [f])
+            steps += 1
+        else:
+            fn = None
+
+        if bits > DEFAULT_LIMITS.bits:
+            fn = None
+
+        if fn is not None:
+            try:
+                with numpy_errors_ignored():
+                    value = fn(*values)
+            except Exception:
+                value = None
+
+            if isinstance(value, Number):
+                if not variables and not functions and bits <= FREE_BITS:
+                    return value, (value, (), (), 0, 0)
+
+                res = parser.FrozenAST(["folded", value, parser.FrozenAST(variables),
+                                        parser.FrozenAST(functions), expr, steps, bits])
+                return res, (value, variables, functions, steps, bits)
+
+    args = [x for (x, _) in folded]
+    if all(x is y for (x, y) in zip(args, f_args)):
+        return expr, None
+
+    return parser.FrozenAST(["apply", f, parser.FrozenAST(args)]), None
+
+
+"""Размер целых произведений, который не учитывается в расходе свёрнутых констант (в пределах int64)"""
+FREE_BITS = 64
+
+
+def int_bits(f, values):
+    """Оценка размера целого результата оператора или функции f (0, если проверка размера к ним не относится);
+    та же, что и при вычислении (см. Budget.check_bits и Budget.check_power)"""
+    if len(values) != 2 or type(values[0]) is not int or type(values[1]) is not int:
+        return 0
+
+    (x, y) = values
+
+    if f == '*':
+        return x.bit_length() + y.bit_length()
+
+    if f == 'pow' and y > 0 and not -1 <= x <= 1:
+        return x.bit_length() * y
+
+    return 0
+
+
+def unique(names):
+    """Список имён без повторов (порядок сохраняется)"""
+    return list(dict.fromkeys(names))
+
+
+def compiled(expr):
+    """Labeled-value -> Code
+    Скомпилированное выражение; для неизменяемых деревьев результат компиляции сохраняется в самом узле,
+    поэтому тела пользовательских функций компилируются один раз. Высокие деревья компилируются для
+    стековой машины (compile_stack), остальные -- в дерево функций. При включённом сборе метрик используется
+    вариант кода, который учитывает вычисленные узлы (counted)"""
+    if metrics.enabled:
+        return counted(expr)
+
+    try:
+        return expr.code
+    except AttributeError:
+        pass
+
+    code = compile_stack(expr) if on_stack(expr) else compile_expr(expr)
+
+    if isinstance(expr, parser.FrozenAST):
+        expr.code = code
+
+    return code
+
+
+def counted(expr):
+    """Labeled-value -> Code
+    Скомпилированное выражение, которое при вычислении учитывает типы своих узлов в метриках
+    (metrics.evaluated); сохраняется в узле отдельно от обычного, поэтому без сбора метрик код не меняется"""
+    try:
+        return expr.counted_code
+    except AttributeError:
+        pass
+
+    if on_stack(expr):
+        code = compile_stack(expr, metrics.evaluated)
+    else:
+        code = count_node(node_kind(expr), compile_expr(expr), metrics.evaluated)
+
+    if isinstance(expr, parser.FrozenAST):
+        expr.counted_code = code
+
+    return code
+
+
+def node_kind(expr):
+    """Тип узла в метриках: число, имя или метка узла"""
+    if isinstance(expr, Number):
+        return "number"
+    if isinstance(expr, str):
+        return "name"
+    return expr[0]
+
+
+def count_node(kind, code, evaluated):
+    """Код узла типа kind, который перед вычислением учитывается в evaluated"""
+    def run(env):
+        evaluated.nodes[kind] += 1
+        return code(env)
+
+    return run
+
+
+def compile_expr(expr):
+    """Labeled-value -> Code
+    Компиляция выражения в дерево функций вида Environment -> Complex"""
+    if isinstance(expr, Number):
+        return lambda env: expr
+
+    if isinstance(expr, str):
+        if expr in KEYWORDS:
+            return lambda env: None
+
+        return lambda env: env.get_var(expr)
+
+    (expr_type, *expr_body) = expr
+
+    if expr_type == "matrix":
+        return compile_matrix(expr)
+
+    if expr_type == "with_units":
+        val, units = expr_body
+        val = compiled(val)
+
+        return lambda env: attach_units(val(env), units)
+
+    if expr_type == "convert":
+        val, units = expr_body
+        val = compiled(val)
+
+        return lambda env: convert_units(val(env), units)
+
+    if expr_type == "set":
+        return compile_set(*expr_body)
+
+    if expr_type == "unset":
+        return compile_unset(*expr_body)
+
+    if expr_type == "def":
+        return compile_def(*expr_body)
+
+    if expr_type == "undef":
+        return compile_undef(*expr_body)
+
+    if expr_type == "apply":
+        return compile_apply(*expr_body)
+
+    if expr_type == "folded":
+        return compile_folded(*expr_body)
+
+    if expr_type == "program":
+        return compile_program(*expr_body)
+
+    return lambda env: None
+
+
+def attach_units(value, units):
+    """Величина value с единицами измерения units"""
+    if metrics.enabled:
+        return metrics.timed('units', lambda: value * resolve_units(units))
+    return value * resolve_units(units)
+
+
+def convert_units(value, units):
+    """Величина value, переведённая в единицы units"""
+    if metrics.enabled:
+        return metrics.timed('units', lambda: value.to(resolve_units(units)))
+    return value.to(resolve_units(units))
+
+
+def compile_matrix(expr):
+    """Литерал матрицы. Постоянный литерал строится один раз при компиляции (и хранится вместе со скомпилированным
+    деревом, поэтому массив доступен только для чтения), в остальных случаях элементы вычисляются каждый раз"""
+    data = make_matrix(expr)
+
+    if data is not None:
+        value = make_array(data)
+        value.flags.writeable = False
+        return lambda env: value
+
+    def elements(x):
+        if not isinstance(x, list) or x[0] != "matrix":
+            return compiled(x)
+
+        rows = [elements(y) for y in x[1]]
+        return lambda env: [row(env) for row in rows]
+
+    code = elements(expr)
+    return lambda env: make_array(code(env))
+
+
+class ProgramResult(list):
+    """Результаты выражений программы; текст -- результаты, отличные от None, по одному в строке"""
+
+    def __str__(self):
+        res = [str(x) for x in self if x is not None]
+        return '\n'.join(res) if res else 'None'
+
+
+def compile_program(statements):
+    """Программа из нескольких выражений: выполняется целиком или (при ошибке в любом выражении) не выполняется,
+    изменения окружения, сделанные предыдущими выражениями, откатываются"""
+    statements = [compiled(x) for x in statements]
+
+    def run(env):
+        state = env.snapshot()
+
+        try:
+            return ProgramResult([x(env) for x in statements])
+        except BaseException:
+            env.restore(state)
+            raise
+
+    return run
+
+
+def compile_set(variable, value_expr):
+    value = compiled(value_expr)
+
+    def run(env):
+        env.set_var(variable, value(env))
+        invalidate(env, variable)
+
+    return run
+
+
+def compile_unset(variable):
+    def run(env):
+        env.del_var(variable)
+        invalidate(env, variable)
+
+    return run
+
+
+def compile_def(f_name, f_args, f_body):
+    arity = len(f_args)
+    f_body = fold(f_body, frozenset(f_args))
+
+    def run(env):
+        if arity != len(set(f_args)):
+            raise RuntimeError("All args. must be uniq.")
+
+        env.set_function(f_name, arity, (f_args, f_body))
+        invalidate(env, f_name)
+
+    return run
+
+
+def compile_undef(f_name):
+    def run(env):
+        env.del_function(f_name)
+        invalidate(env, f_name)
+
+    return run
+
+
+def compile_apply(f, f_args):
+    """Компиляция применения функции к аргументам"""
+    args = [compiled(x) for x in f_args]
+    n = len(args)
+
+    if f == '*' and n == 2:
+        (a, b) = args
+
+        def mul(env):
+            x = a(env)
+            y = b(env)
+
+            if type(x) is int and type(y) is int and env.budget is not None:
+                env.budget.check_bits(x.bit_length() + y.bit_length())
+
+            return multiply(x, y)
+
+        return mul
+
+    if f in OPERATORS and n == 2:
+        op = OPERATORS[f]
+        (a, b) = args
+        return lambda env: op(a(env), b(env))
+
+    def run(env):
+        (builtin, (arity, fn)) = lookup(f, n, env)
 
         # Встроенная функция (обычная функция из питона)
         if builtin:
-            if arity == len(f_args):
+            if fn is map_function:
+                return apply_map(f_args[0], args[1](env), env)
 
-                f_args = map(lambda x: evl(x, env), f_args)
+            values = [x(env) for x in args]
 
-                return fn(*f_args)
-            else:
-                raise RuntimeError("Function {} has arity {}, but called with {} args.".format(f, arity, len(f_args)))
+            if f == 'pow' and env.budget is not None:
+                env.budget.check_power(*values)
+
+            return fn(*values)
 
         # Пользователькая функция
+        return call(f, arity, fn, [x(env) for x in args], env)
 
-        function_env = Environment(root=env)
+    return run
 
-        (f_vars, body) = fn
 
-        if arity != len(f_args):
-            raise RuntimeError("Function {} has arity {}, but called with {} args.".format(f, arity, len(f_args)))
+def lookup(f, n, env):
+    """Функция f, применяемая к n аргументам (шаг бюджета расходуется до вычисления аргументов)"""
+    entry = env.get_function(f)
+
+    if env.budget is not None:
+        env.budget.step()
+
+    arity = entry[1][0]
+    if arity != n:
+        raise RuntimeError("Function {} has arity {}, but called with {} args.".format(f, arity, n))
+
+    return entry
+
+
+"""Узлы, через которые проходит путь от корня высокого дерева к глубоким поддеревьям: они становятся
+командами стековой машины"""
+SPINE = frozenset(["apply", "set", "with_units", "convert"])
+
+"""Команды стековой машины"""
+(CODE, OPERATOR, MUL, FUNCTION, CALL, UNITS, CONVERT, SET) = range(8)
+
+"""Команда -> тип узла, вычисление которого она начинает (в метриках; CODE учитывает свои узлы сама)"""
+COMMAND_NODES = {OPERATOR: "apply", MUL: "apply", FUNCTION: "apply", UNITS: "with_units", CONVERT: "convert",
+                 SET: "set"}
+
+
+def on_stack(expr):
+    """Компилируется ли выражение для стековой машины (дерево из функций было бы слишком глубоким)"""
+    return isinstance(expr, list) and expr[0] in SPINE and parser.height(expr) > parser.DEEP
+
+
+def compile_stack(expr, evaluated=None):
+    """Labeled-value, metrics.Evaluated -> Code
+    Компиляция высокого дерева в последовательность команд (обратная польская запись), которая выполняется
+    циклом с явным стеком значений, поэтому длинные суммы и глубоко вложенные вызовы не упираются в ограничение
+    глубины рекурсии. Поддеревья небольшой высоты компилируются в функции (compiled) и выполняются одной командой.
+    Порядок вычисления тот же, что у дерева функций: функция ищется до вычисления аргументов, аргументы
+    вычисляются слева направо. Если задан evaluated, выполненные команды учитываются в нём как узлы"""
+    program = []
+    calls = []
+    stack = [(expr, False)]
+
+    while stack:
+        (x, visited) = stack.pop()
+
+        if not visited:
+            if x is not expr and not on_stack(x):
+                program.append((CODE, compiled(x), None))
+                continue
+
+            stack.append((x, True))
+
+            if x[0] == "apply":
+                (_, f, f_args) = x
+                if not (f in OPERATORS and len(f_args) == 2):
+                    # Адрес перехода (для map) известен только после компиляции аргументов
+                    calls.append(len(program))
+                    program.append(None)
+
+                stack.extend((y, False) for y in reversed(f_args))
+            elif x[0] == "set":
+                stack.append((x[2], False))
+            else:
+                stack.append((x[1], False))
+            continue
+
+        if x[0] == "apply":
+            (_, f, f_args) = x
+            n = len(f_args)
+
+            if f == '*' and n == 2:
+                program.append((MUL, None, None))
+            elif f in OPERATORS and n == 2:
+                program.append((OPERATOR, OPERATORS[f], None))
+            else:
+                program[calls.pop()] = (FUNCTION, (f, n, f_args), len(program) + 1)
+                program.append((CALL, f, n))
+        elif x[0] == "set":
+            program.append((SET, x[1], None))
+        elif x[0] == "with_units":
+            program.append((UNITS, x[2], None))
+        else:
+            program.append((CONVERT, x[2], None))
+
+    size = len(program)
+
+    def run(env):
+        values = []
+        pc = 0
+        nodes = evaluated.nodes if evaluated is not None else None
+
+        while pc < size:
+            (op, a, b) = program[pc]
+            pc += 1
+
+            if nodes is not None and op in COMMAND_NODES:
+                nodes[COMMAND_NODES[op]] += 1
+
+            if op == CODE:
+                values.append(a(env))
+            elif op == OPERATOR:
+                y = values.pop()
+                values[-1] = a(values[-1], y)
+            elif op == MUL:
+                y = values.pop()
+                x = values[-1]
+
+                if type(x) is int and type(y) is int and env.budget is not None:
+                    env.budget.check_bits(x.bit_length() + y.bit_length())
+
+                values[-1] = multiply(x, y)
+            elif op == FUNCTION:
+                (f, n, f_args) = a
+                entry = lookup(f, n, env)
+
+                if entry[0] and entry[1][1] is map_function:
+                    # Первый аргумент map -- имя функции, он не вычисляется
+                    values.append(apply_map(f_args[0], compiled(f_args[1])(env), env))
+                    pc = b
+                else:
+                    values.append(entry)
+            elif op == CALL:
+                args = values[len(values) - b:]
+                del values[len(values) - b:]
+                (builtin, (arity, fn)) = values.pop()
+
+                if builtin and a == 'pow' and env.budget is not None:
+                    env.budget.check_power(*args)
+
+                values.append(fn(*args) if builtin else call(a, arity, fn, args, env))
+            elif op == UNITS:
+                values[-1] = attach_units(values[-1], a)
+            elif op == CONVERT:
+                values[-1] = convert_units(values[-1], a)
+            else:
+                env.set_var(a, values.pop())
+                invalidate(env, a)
+                values.append(None)
+
+        return values.pop()
+
+    return run
+
+
+def builtin_calls(expr):
+    """Число применений функций (не операторов) в дереве"""
+    res = 0
+    stack = [expr]
+
+    while stack:
+        x = stack.pop()
+
+        if isinstance(x, list) and x[0] == "apply":
+            (_, f, f_args) = x
+            res += not (f in OPERATORS and len(f_args) == 2)
+            stack.extend(f_args)
+        elif isinstance(x, list) and x[0] in ("with_units", "convert"):
+            stack.append(x[1])
+
+    return res
+
+
+def compile_folded(value, variables, functions, original, steps=None, bits=None):
+    """Свёрнутая константа: используется, пока все её зависимости разрешаются во встроенные значения; при
+    использовании расходуются шаги и проверяется размер, как если бы исходное поддерево вычислялось.
+    В узлах, сохранённых до учёта расхода, его нет: шаги -- число вызовов встроенных функций в поддереве,
+    размер -- размер самого значения"""
+    if steps is None:
+        (steps, bits) = (builtin_calls(original), value.bit_length() if type(value) is int else 0)
+
+    variables = [(name, BUILTINS.variables[name]) for name in variables]
+    functions = [(name, BUILTINS.functions[name]) for name in functions]
+    fallback = compiled(original)
+
+    def run(env):
+        try:
+            for (name, expected) in variables:
+                actual = env.get_var(name)
+                if type(actual) is not type(expected) or actual != expected:
+                    return fallback(env)
+
+            for (name, expected) in functions:
+                if env.get_function(name) != expected:
+                    return fallback(env)
+        except RuntimeError:
+            return fallback(env)
+
+        if env.budget is not None:
+            env.budget.charge(steps, bits)
+
+        return value
+
+    return run
+
+
+def call(f, arity, fn, values, env):
+    """Применение пользовательской функции к вычисленным аргументам values (создаётся под-окружение для
+    вычисления)"""
+    function_env = Environment(root=env)
+
+    (f_vars, body) = fn
+
+    for i in range(len(f_vars)):
+        function_env.set_var(f_vars[i], values[i])
+
+    # Результат чистой функции может быть уже известен
+    memo = env.memo
+    key = None
+    if memo is not None:
+        (pure, variables) = memo.analyze(f, fn, env)
+        if pure:
+            key = call_key(f, values, variables, env)
+            if key is not None:
+                res = memo.results.get(key, MISSING)
+                if res is not MISSING:
+                    return res
+
+    budget = env.budget
+    if budget is None:
+        res = compiled(body)(function_env)
+    else:
+        # При исключении счётчик глубины не восстанавливается: оно прерывает всё вычисление вместе с бюджетом
+        budget.depth += 1
+        if budget.depth > budget.limits.depth:
+            raise BudgetExceeded('depth', budget.limits.depth)
+
+        res = compiled(body)(function_env)
+        budget.depth -= 1
+
+    if key is not None:
+        memo.results.put(key, res)
+
+    return res
+
+
+def apply_map(f, xs, env):
+    """Вычисление функции f (имя) для всех элементов массива xs. Тело функции вычисляется один раз с массивом
+    в качестве аргумента (всю работу делает numpy); если тело нельзя так вычислить или результат -- не массив
+    той же формы, что и аргумент (например, число, вычисленное по всему массиву), функция вычисляется
+    для каждого элемента отдельно. Из попытки вычисления по всему массиву выходят только ошибки превышения
+    ограничений (BudgetExceeded)"""
+    if not isinstance(f, str):
+        raise RuntimeError("Function map must be called as map(function_name, array)")
+
+    (builtin, (arity, fn)) = env.get_function(f)
+
+    if arity != 1:
+        raise RuntimeError("Function {} has arity {}, but called with {} args.".format(f, arity, 1))
+
+    np = numpy()
+    xs = np.asarray(xs)
+
+    if builtin:
+        apply_one = fn
+    else:
+        apply_one = lambda x: call(f, arity, fn, [x], env)
+
+    try:
+        # Аргумент передаётся одномерным: произведение двух матриц было бы матричным, а не поэлементным
+        res = apply_one(xs.reshape(-1))
+
+        if type(res) is np.ndarray and res.shape == (xs.size,):
+            return res.reshape(xs.shape)
+    except BudgetExceeded:
+        raise
+    except Exception:
+        # Тело, которое нельзя вычислить для массива (литерал матрицы из аргумента, D, tr), вычисляется
+        # поэлементно
+        pass
+
+    res = np.array([apply_one(x) for x in xs.flat])
+    return res.reshape(xs.shape + res.shape[1:])
+
+
+def call_key(f, values, variables, env):
+    """Ключ вызова чистой функции (None, если вызов нельзя мемоизировать)"""
+    key = [f]
+
+    for value in values:
+        k = memo_key(value)
+        if k is None:
+            return None
+        key.append(k)
+
+    try:
+        for name in variables:
+            k = memo_key(env.get_var(name))
+            if k is None:
+                return None
+            key.append(k)
+    except RuntimeError:
+        return None
+
+    return tuple(key)
+
+
+def calculate(s, env, limits=None):
+    """String, Environment, Limits -> Complex
+        Выполнение вычисления в контексте окружения"""
+    if env.memo is None:
+        env.memo = Memo()
+
+    if metrics.enabled:
+        return timed_calculate(s, env, limits)
+
+    expr = parser.cached_parse(s)
+
+    env.budget = Budget(limits or DEFAULT_LIMITS)
+    try:
+        return compiled(optimize(expr))(env)
+    finally:
+        env.budget = None
 
-        # Вычисление аргументов
-        for i in range(len(f_vars)):
-            function_env.set_var(f_vars[i], evl(f_args[i], env))
 
-        return evl(body, function_env)
+def timed_calculate(s, env, limits):
+    """calculate с замером времени стадий разбора, компиляции и вычисления"""
+    start = time.perf_counter()
+    expr = parser.cached_parse(s)
 
-    expr = parser.parse(s)
+    parsed = time.perf_counter()
+    code = compiled(optimize(expr))
 
-    return evl(expr, env)
+    ready = time.perf_counter()
+    env.budget = Budget(limits or DEFAULT_LIMITS)
+    try:
+        return code(env)
+    finally:
+        env.budget = None
+        metrics.observe('parse', parsed - start)
+        metrics.observe('compile', ready - parsed)
+        metrics.observe('eval', time.perf_counter() - ready)
+        metrics.count_evaluated()
@@ -0,0 +1,155 @@
+"""
+Формат хранения данных пользовательского окружения (Environment.get_data). Вместо pickle самих объектов
+сохраняется их каноническое представление из чисел, строк, байтов и кортежей, не зависящее от классов numpy и pint:
+массивы -- тип элементов, форма и байты, величины -- значение и единицы, функции -- аргументы и дерево тела,
+записанное плоско (parser.flatten), поэтому запись компактнее, быстрее загружается и читается другими версиями
+библиотек. Величины при загрузке создаются в реестре единиц калькулятора (pint при распаковке pickle создаёт их в
+своём реестре по умолчанию, и с величинами калькулятора они не складываются).
+
+Запись начинается с заголовка формата и номера версии; записи без заголовка -- данные старого формата (pickle),
+они загружаются и приводятся к тем же объектам, что и записи нового формата (в том числе np.matrix -- к обычным
+массивам).
+"""
+import pickle
+import sys
+from array import array
+
+from src import calc
+from src import parser
+
+"""Заголовок записи; последний байт -- версия формата"""
+MAGIC = b'ENV'
+VERSION = 1
+HEADER = MAGIC + bytes([VERSION])
+
+"""Типы, которые сохраняются как есть"""
+PLAIN = frozenset([int, float, complex, bool, str, type(None)])
+
+"""Типы элементов массивов, сохраняемых байтами (логические, целые, вещественные и комплексные)"""
+RAW_KINDS = 'biufc'
+
+DELETED = ('d',)
+
+
+def encode_value(x):
+    """Значение переменной -> каноническое представление"""
+    if type(x) in PLAIN:
+        return x
+
+    if x is calc.DELETED:
+        return DELETED
+
+    np = sys.modules.get('numpy')
+    if np is not None:
+        if isinstance(x, np.matrix):
+            # Матрицы старого формата сохраняются обычными массивами
+            x = np.asarray(x)
+        if type(x) is np.ndarray and x.dtype.kind in RAW_KINDS:
+            return ('a', x.dtype.str, x.shape, x.tobytes())
+        if isinstance(x, np.generic) and x.dtype.kind in RAW_KINDS:
+            return ('g', x.dtype.str, x.tobytes())
+
+    pint = sys.modules.get('pint')
+    if pint is not None and isinstance(x, pint.Quantity):
+        return ('q', encode_value(x.magnitude), tuple(x.unit_items()))
+
+    return ('p', pickle.dumps(x, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def decode_value(code):
+    """Каноническое представление -> значение переменной"""
+    if type(code) is not tuple:
+        return code
+
+    tag = code[0]
+
+    if tag == 'd':
+        return calc.DELETED
+
+    if tag in 'am':
+        # 'm' -- np.matrix в записях первых версий формата, загружается обычным массивом
+        (_, dtype, shape, raw) = code
+        return calc.numpy().frombuffer(raw, dtype=dtype).reshape(shape).copy()
+
+    if tag == 'g':
+        return calc.numpy().frombuffer(code[2], dtype=code[1])[0]
+
+    if tag == 'q':
+        from pint.util import UnitsContainer
+        return calc.get_ureg().Quantity(decode_value(code[1]), UnitsContainer(dict(code[2])))
+
+    if tag == 'p':
+        return pickle.loads(code[1])
+
+    raise ValueError("Unknown value tag {!r}".format(tag))
+
+
+def encode_tree(expr):
+    """Дерево разбора -> (листья, код типа массива формы, байты формы) без рекурсии"""
+    (leaves, shape) = parser.flatten(expr)
+
+    leaves = [x if type(x) in PLAIN else encode_value(x) for x in leaves]
+    shape = array('b' if max(shape) < 128 else 'l', shape)
+
+    return leaves, shape.typecode, shape.tobytes()
+
+
+def decode_tree(leaves, typecode, shape):
+    leaves = [x if type(x) is not tuple else decode_value(x) for x in leaves]
+    return parser.thaw(leaves, array(typecode, shape))
+
+
+def encode_function(entry):
+    """Пользовательская функция (False, (арность, (аргументы, тело))) -> каноническое представление"""
+    if entry is calc.DELETED:
+        return DELETED
+
+    (builtin, value) = entry
+    if builtin:
+        return ('p', pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL))
+
+    (arity, (f_args, f_body)) = value
+    return ('f', arity, tuple(f_args)) + encode_tree(f_body)
+
+
+def decode_function(code):
+    tag = code[0]
+
+    if tag == 'f':
+        (_, arity, f_args, leaves, typecode, shape) = code
+        return False, (arity, (parser.FrozenAST(f_args), decode_tree(leaves, typecode, shape)))
+
+    return decode_value(code)
+
+
+def encode(data):
+    """Data -> Bytes
+    Данные окружения в формате текущей версии"""
+    (variables, functions) = data
+
+    payload = ({name: encode_value(value) for (name, value) in variables.items()},
+               {name: encode_function(entry) for (name, entry) in functions.items()})
+
+    return HEADER + pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decode(blob):
+    """Bytes -> Data
+    Загрузка данных окружения (текущего или старого формата)"""
+    if blob[:len(MAGIC)] != MAGIC:
+        return upgrade(pickle.loads(blob))
+
+    version = blob[len(MAGIC)]
+    if version != VERSION:
+        raise ValueError("Unsupported environment format version {}".format(version))
+
+    (variables, functions) = pickle.loads(memoryview(blob)[len(HEADER):])
+
+    return [{name: decode_value(code) for (name, code) in variables.items()},
+            {name: decode_function(code) for (name, code) in functions.items()}]
+
+
+def upgrade(data):
+    """Данные старого формата (pickle самих объектов): величины переносятся в реестр калькулятора,
+    деревья функций становятся неизменяемыми"""
+    return decode(encode(data))
@@ -0,0 +1,160 @@
+"""
+Параллельная обработка сообщений. Вычисления выполняются в пуле потоков заданного размера, поэтому долгое
+вычисление в одном чате не задерживает ответы в других. Сообщения одного чата обрабатываются строго в порядке
+поступления: в каждый момент времени для чата выполняется не больше одной задачи, так что его окружение
+используется только одним потоком.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from src.calc import DEFAULT_LIMITS, calculate
+from src.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ChatLimits(object):
+    """Ограничения вычислений отдельных чатов: chat_id -> Limits, остальным чатам -- default"""
+
+    def __init__(self, chats=None, default=DEFAULT_LIMITS):
+        self.chats = dict(chats or {})
+        self.default = default
+
+    def get(self, chat_id):
+        return self.chats.get(chat_id, self.default)
+
+    def set(self, chat_id, limits):
+        self.chats[chat_id] = limits
+
+
+def evaluate(envs, chat_id, text, sandbox=None, limits=None):
+    """EnvironmentCache, Int, String, ProcessPool, ChatLimits -> String
+    Вычисление сообщения в окружении чата с сохранением изменений, результат -- текст ответа.
+    Если передан пул sandbox, вычисление выполняется в отдельном процессе с ограничениями;
+    limits -- ограничения вычислений по чатам (по умолчанию calc.DEFAULT_LIMITS для всех)"""
+    if limits is not None:
+        limits = limits.get(chat_id)
+
+    if metrics.enabled:
+        return timed_evaluate(envs, chat_id, text, sandbox, limits)
+
+    try:
+        env = envs.get(chat_id)
+
+        if sandbox is None:
+            res = str(calculate(text, env, limits))
+        else:
+            (res, data) = sandbox.calculate(text, env.get_data(), limits=limits)
+
+            if data is not None:
+                env.set_data(data)
+                env.changed = True
+
+        envs.commit(chat_id, env)
+    except RuntimeError as e:
+        res = str(e.args)
+
+    return res
+
+
+def timed_evaluate(envs, chat_id, text, sandbox, limits):
+    """evaluate с замером времени загрузки и сохранения окружения и вычисления в отдельном процессе"""
+    start = time.perf_counter()
+
+    try:
+        env = metrics.timed('storage', envs.get, chat_id)
+
+        if sandbox is None:
+            res = str(calculate(text, env, limits))
+        else:
+            (res, data) = metrics.timed('sandbox', sandbox.calculate, text, env.get_data(), None, limits)
+
+            if data is not None:
+                env.set_data(data)
+                env.changed = True
+
+        metrics.timed('storage', envs.commit, chat_id, env)
+    except RuntimeError as e:
+        res = str(e.args)
+
+    elapsed = time.perf_counter() - start
+    metrics.observe('total', elapsed)
+    metrics.expression(chat_id, text, elapsed)
+
+    return res
+
+
+class ChatDispatcher(object):
+    """Пул потоков с очередью задач для каждого чата. Если передан кэш окружений envs, на время выполнения
+    задачи окружение её чата закрепляется в кэше (EnvironmentCache.pin) и не вытесняется другими потоками"""
+
+    def __init__(self, workers=4, envs=None):
+        self.envs = envs
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.queues = dict()
+
+    def submit(self, chat_id, fn, *args):
+        """Постановка задачи fn(*args) в очередь чата"""
+        with self.lock:
+            queue = self.queues.get(chat_id)
+
+            if queue is not None:
+                # Чат уже обрабатывается, задача будет выполнена после предыдущих
+                queue.append((fn, args))
+                return
+
+            self.queues[chat_id] = deque([(fn, args)])
+
+        self.executor.submit(self.__run, chat_id)
+
+    def __run(self, chat_id):
+        """Выполнение очередной задачи чата; следующая ставится в конец общей очереди пула,
+        чтобы чат с большим числом сообщений не занимал поток целиком"""
+        with self.lock:
+            (fn, args) = self.queues[chat_id][0]
+
+        if self.envs is not None:
+            self.envs.pin(chat_id)
+
+        try:
+            fn(*args)
+        except Exception:
+            logger.exception("Error while processing message from chat %s", chat_id)
+        finally:
+            if self.envs is not None:
+                self.envs.unpin(chat_id)
+
+        with self.lock:
+            queue = self.queues[chat_id]
+            queue.popleft()
+
+            if not queue:
+                del self.queues[chat_id]
+                if not self.queues:
+                    self.idle.notify_all()
+                return
+
+        self.executor.submit(self.__run, chat_id)
+
+    def pending(self):
+        """Число чатов, для которых есть невыполненные задачи"""
+        with self.lock:
+            return len(self.queues)
+
+    def join(self):
+        """Ожидание выполнения всех поставленных задач"""
+        with self.lock:
+            while self.queues:
+                self.idle.wait()
+
+    def shutdown(self, wait=True):
+        """Остановка пула (по умолчанию с ожиданием всех поставленных задач)"""
+        if wait:
+            self.join()
+
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,154 @@
+"""
+Справка бота (/help). Файл справки (demo.xml) разбирается один раз -- при первом обращении -- в таблицу
+раздел -> текст и обратный индекс слово -> разделы, поэтому ответ на /help не требует чтения файла. Если файл
+изменился (по времени изменения), он разбирается заново при следующем обращении.
+
+    /help              -- оглавление
+    /help 5.5          -- раздел по номеру
+    /help matrix rank  -- разделы, в которых встречаются все слова запроса
+
+Ответ делится на сообщения не длиннее outbox.MAX_LENGTH: найденные разделы собираются в сообщения целиком,
+слишком длинный раздел делится по строкам.
+"""
+import bisect
+import os
+import re
+import threading
+import xml.etree.ElementTree as ElementTree
+
+from src.outbox import MAX_LENGTH
+
+_words = re.compile(r'\w+')
+
+
+def words(text):
+    """Слова текста в нижнем регистре"""
+    return _words.findall(text.lower())
+
+
+def split_text(text, limit=MAX_LENGTH):
+    """Части текста не длиннее limit: по строкам, строка длиннее limit -- по limit символов"""
+    parts = []
+
+    for line in text.split('\n'):
+        while len(line) > limit:
+            parts.append(line[:limit])
+            line = line[limit:]
+        parts.append(line)
+
+    return pack(parts, limit)
+
+
+def pack(texts, limit=MAX_LENGTH):
+    """Тексты, собранные через перевод строки в сообщения не длиннее limit"""
+    res = []
+
+    for text in texts:
+        if len(text) > limit:
+            res.extend(split_text(text, limit))
+        elif res and len(res[-1]) + 1 + len(text) <= limit:
+            res[-1] += '\n' + text
+        else:
+            res.append(text)
+
+    return res
+
+
+class HelpSnapshot(object):
+    """Разобранный файл справки: оглавление, тексты разделов и обратный индекс"""
+
+    def __init__(self, path):
+        root = ElementTree.parse(path).getroot()
+
+        title = root.find('title')
+        self.title = title.text if title is not None else ''
+
+        self.sections = dict()
+        self.index = dict()
+
+        for node in root.iter('help'):
+            section = node.get('id')
+            text = node.text or ''
+            self.sections[section] = text
+
+            for word in words(text) + words(node.get('keywords', '')):
+                self.index.setdefault(word, []).append(section)
+
+        for (word, sections) in self.index.items():
+            self.index[word] = list(dict.fromkeys(sections))
+
+        self.terms = sorted(self.index)
+
+    def lookup(self, word):
+        """Разделы, содержащие слово; слова от трёх букв ищутся и как начало слова ("матриц" -> "матрицы")"""
+        if len(word) < 3:
+            return set(self.index.get(word, ()))
+
+        res = set()
+        for i in range(bisect.bisect_left(self.terms, word), len(self.terms)):
+            if not self.terms[i].startswith(word):
+                break
+            res.update(self.index[self.terms[i]])
+
+        return res
+
+    def search(self, query):
+        """Номера разделов, в которых встречаются все слова запроса (в порядке следования в файле)"""
+        query = words(query)
+        if not query:
+            return []
+
+        found = set.intersection(*[self.lookup(word) for word in query])
+        return [section for section in self.sections if section in found]
+
+
+class HelpIndex(object):
+    """Справка из файла path, разбираемого при первом обращении и после каждого его изменения"""
+
+    def __init__(self, path='demo.xml'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.snapshot = None
+        self.loads = 0
+
+    def get(self):
+        """Актуальный HelpSnapshot"""
+        mtime = os.stat(self.path).st_mtime_ns
+
+        if self.snapshot is None or mtime != self.mtime:
+            with self.lock:
+                if self.snapshot is None or mtime != self.mtime:
+                    self.snapshot = HelpSnapshot(self.path)
+                    self.mtime = mtime
+                    self.loads += 1
+
+        return self.snapshot
+
+    def title(self):
+        return self.get().title
+
+    def section(self, section):
+        """Текст раздела или None"""
+        return self.get().sections.get(section)
+
+    def search(self, query):
+        """Тексты разделов, подходящих под запрос"""
+        snapshot = self.get()
+        return [snapshot.sections[section] for section in snapshot.search(query)]
+
+    def answer(self, args):
+        """List(String) -> List(String)
+        Сообщения в ответ на /help с аргументами args (каждое не длиннее MAX_LENGTH)"""
+        if not args:
+            return pack([self.title()])
+
+        text = self.section(args[0]) if len(args) == 1 else None
+        if text is not None:
+            return pack([text])
+
+        found = self.search(' '.join(args))
+        if not found:
+            return ["По запросу \"{}\" ничего не найдено".format(' '.join(args))]
+
+        return pack(found)
@@ -0,0 +1,164 @@
+"""
+Метрики производительности: гистограммы времени по стадиям обработки сообщения (разбор, компиляция,
+вычисление, единицы измерения, linalg, хранилище, вычислительный процесс, отправка ответа), число вычислений
+узлов каждого типа (вместе с телами вызванных функций и каждым применением функции в map) и журнал медленных
+выражений. Стадии вложены: время "eval" включает "units" и "linalg".
+
+По умолчанию сбор выключен, и на горячем пути остаётся только проверка metrics.enabled. Процессы-вычислители
+(sandbox.py) собирают метрики своего запроса и возвращают их вместе с результатом, они добавляются к метрикам бота.
+"""
+import bisect
+import os
+import threading
+import time
+from collections import Counter, deque
+
+"""Границы интервалов гистограмм, секунды"""
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram(object):
+    """Гистограмма длительностей с фиксированными интервалами"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for (i, n) in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Верхняя граница интервала, в который попадает квантиль q (для последнего интервала -- максимум)"""
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for (i, n) in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class Evaluated(threading.local):
+    """Число вычислений узлов каждого типа в текущем потоке с начала вычисления выражения: счётчик свой у каждого
+    потока, поэтому вычисление увеличивает его без блокировки"""
+
+    def __init__(self):
+        self.nodes = Counter()
+
+
+class Metrics(object):
+    """Собранные метрики. Методы можно вызывать из разных потоков"""
+
+    def __init__(self, slow_threshold=1.0, slow_entries=100):
+        self.enabled = False
+        self.slow_threshold = slow_threshold
+        self.lock = threading.Lock()
+        self.stages = dict()
+        self.nodes = Counter()
+        self.evaluated = Evaluated()
+        self.slow = deque(maxlen=slow_entries)
+        self.started = time.time()
+
+    def reset(self):
+        with self.lock:
+            self.stages = dict()
+            self.nodes = Counter()
+            self.slow.clear()
+            self.started = time.time()
+
+    def observe(self, stage, seconds):
+        """Добавление длительности стадии"""
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.add(seconds)
+
+    def timed(self, stage, fn, *args):
+        """Вызов fn(*args) с замером времени стадии"""
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count_evaluated(self):
+        """Перенос числа вычисленных текущим потоком узлов (evaluated) в общие метрики"""
+        nodes = self.evaluated.nodes
+        with self.lock:
+            self.nodes.update(nodes)
+        nodes.clear()
+
+    def expression(self, chat_id, text, seconds):
+        """Учёт времени обработки выражения: медленные попадают в журнал"""
+        if seconds >= self.slow_threshold:
+            with self.lock:
+                self.slow.append((time.time(), chat_id, text, seconds))
+
+    def export(self):
+        """Метрики в виде, пригодном для передачи между процессами"""
+        with self.lock:
+            return {'stages': dict(self.stages), 'nodes': dict(self.nodes)}
+
+    def merge(self, exported):
+        """Добавление метрик, полученных export в другом процессе"""
+        with self.lock:
+            for (stage, other) in exported['stages'].items():
+                histogram = self.stages.get(stage)
+                if histogram is None:
+                    histogram = self.stages[stage] = Histogram()
+                histogram.merge(other)
+
+            self.nodes.update(exported['nodes'])
+
+    def report(self):
+        """Текстовый отчёт (ответ на /stats и содержимое файла метрик)"""
+        with self.lock:
+            lines = ["Metrics since {} ({})".format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+                                                    'enabled' if self.enabled else 'disabled'),
+                     "",
+                     "{:10} {:>8} {:>10} {:>10} {:>10} {:>10}".format('stage', 'count', 'mean, ms', 'p50, ms',
+                                                                     'p99, ms', 'max, ms')]
+
+            for (stage, h) in sorted(self.stages.items()):
+                lines.append("{:10} {:8d} {:10.3f} {:10.3f} {:10.3f} {:10.3f}".format(
+                    stage, h.count, h.mean() * 1e3, h.quantile(0.5) * 1e3, h.quantile(0.99) * 1e3, h.max * 1e3))
+
+            lines += ["", "evaluated node types: " + ', '.join('{} {}'.format(name, n) for (name, n) in self.nodes.most_common())]
+
+            lines += ["", "slow expressions (>= {} s):".format(self.slow_threshold)]
+            for (at, chat_id, text, seconds) in reversed(self.slow):
+                lines.append("{} chat {} {:.3f} s: {}".format(time.strftime('%H:%M:%S', time.localtime(at)),
+                                                              chat_id, seconds, text[:200]))
+
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        """Запись отчёта в файл (через временный файл, чтобы читатель не увидел его наполовину записанным)"""
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(self.report() + '\n')
+        os.replace(tmp, path)
+
+
+"""Метрики процесса"""
+metrics = Metrics()
@@ -0,0 +1,250 @@
+"""
+Очередь исходящих сообщений. Обработчики ставят ответ в очередь и сразу возвращаются, а отправку выполняют
+потоки очереди с учётом ограничений Telegram: не чаще chat_rate сообщений в секунду в один чат (group_rate -- в
+группу, у групп chat_id отрицательный) и global_rate сообщений в секунду всего (token bucket, кратковременно допускаются пачки до burst сообщений). Ответы, накопившиеся
+для чата за время ожидания, отправляются одним сообщением (не длиннее MAX_LENGTH). Если API всё же отвечает 429
+(ошибка с атрибутом retry_after, как telegram.error.RetryAfter), сообщение отправляется повторно после паузы.
+Сообщения одного чата отправляются по порядку: в каждый момент для чата выполняется не больше одной отправки.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from src.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+"""Наибольшая длина сообщения Telegram"""
+MAX_LENGTH = 4096
+
+
+class TokenBucket(object):
+    """Ограничение частоты: rate событий в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.time = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+
+    def wait(self, now):
+        """Время до появления свободного токена (0, если он уже есть)"""
+        self.refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+    def full(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class Outbox(object):
+    """Очередь отправки send(chat_id, text) с ограничениями частоты, объединением ответов и повторами после 429"""
+
+    def __init__(self, send, workers=4, chat_rate=1.0, group_rate=1 / 3, chat_burst=3, global_rate=30.0,
+                 global_burst=30, max_retries=5, backoff=1.0, clock=time.monotonic):
+        self.send = send
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+        self.bucket = TokenBucket(global_rate, global_burst, clock())
+        self.buckets = dict()
+        self.pruned = clock()
+
+        # chat_id -> очередь текстов; чат, для которого есть тексты и не выполняется отправка, -- в куче ready
+        # вместе со временем, раньше которого отправлять ему нельзя
+        self.queues = dict()
+        self.ready = []
+        self.busy = set()
+        self.retries = dict()
+        self.order = itertools.count()
+
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.dropped = 0
+
+        self.closed = False
+        self.cancelled = False
+        self.threads = [threading.Thread(target=self.__run, name='outbox', daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, chat_id, text):
+        """Постановка сообщения в очередь чата (без ожидания отправки)"""
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Outbox is closed")
+
+            queue = self.queues.get(chat_id)
+
+            if queue is not None:
+                queue.append(text)
+                return
+
+            self.queues[chat_id] = deque([text])
+            self.__schedule(chat_id, self.clock())
+
+    def __schedule(self, chat_id, when):
+        heapq.heappush(self.ready, (when, next(self.order), chat_id))
+        self.changed.notify_all()
+
+    def __next(self):
+        """Ожидание чата, которому можно отправить сообщение; (chat_id, текст) или None после закрытия очереди"""
+        with self.lock:
+            while True:
+                if not self.ready:
+                    if self.closed and not self.queues:
+                        return None
+                    self.changed.wait()
+                    continue
+
+                now = self.clock()
+                (when, _, chat_id) = self.ready[0]
+
+                if when > now:
+                    self.changed.wait(when - now)
+                    continue
+
+                bucket = self.buckets.get(chat_id)
+                if bucket is None:
+                    rate = self.group_rate if chat_id < 0 else self.chat_rate
+                    bucket = self.buckets[chat_id] = TokenBucket(rate, self.chat_burst, now)
+
+                delay = bucket.wait(now)
+                if delay > 0:
+                    heapq.heapreplace(self.ready, (now + delay, next(self.order), chat_id))
+                    continue
+
+                delay = self.bucket.wait(now)
+                if delay > 0:
+                    self.changed.wait(delay)
+                    continue
+
+                heapq.heappop(self.ready)
+                bucket.take(now)
+                self.bucket.take(now)
+                self.busy.add(chat_id)
+
+                return chat_id, self.__coalesce(self.queues[chat_id])
+
+    def __coalesce(self, queue):
+        """Первый текст очереди вместе со следующими, пока общая длина не больше MAX_LENGTH"""
+        parts = [queue.popleft()]
+        length = len(parts[0])
+
+        while queue and length + 1 + len(queue[0]) <= MAX_LENGTH:
+            length += 1 + len(queue[0])
+            parts.append(queue.popleft())
+
+        self.coalesced += len(parts) - 1
+        return '\n'.join(parts)
+
+    def __run(self):
+        while True:
+            task = self.__next()
+            if task is None:
+                return
+
+            (chat_id, text) = task
+            (ok, retry) = (True, None)
+
+            try:
+                if metrics.enabled:
+                    metrics.timed('send', self.send, chat_id, text)
+                else:
+                    self.send(chat_id, text)
+            except Exception as e:
+                ok = False
+                retry = getattr(e, 'retry_after', None)
+                if retry is None:
+                    logger.exception("Error while sending message to chat %s", chat_id)
+
+            self.__done(chat_id, text, ok, retry)
+
+    def __done(self, chat_id, text, ok, retry):
+        """Завершение отправки: при ответе 429 (retry -- пауза, которую просит API) текст возвращается
+        в начало очереди чата, повторы идут с паузой не меньше backoff * 2 ** (попытка - 1)"""
+        with self.lock:
+            now = self.clock()
+            self.busy.discard(chat_id)
+            queue = self.queues[chat_id]
+
+            if retry is not None and not self.cancelled:
+                attempt = self.retries.get(chat_id, 0) + 1
+
+                if attempt <= self.max_retries:
+                    # В новых версиях python-telegram-bot retry_after -- timedelta
+                    retry = retry.total_seconds() if hasattr(retry, 'total_seconds') else float(retry)
+
+                    self.retries[chat_id] = attempt
+                    self.retried += 1
+                    queue.appendleft(text)
+                    self.__schedule(chat_id, now + max(retry, self.backoff * 2 ** (attempt - 1)))
+                    return
+
+                logger.warning("Dropped message to chat %s after %s attempts", chat_id, attempt)
+
+            if ok:
+                self.sent += 1
+            else:
+                self.dropped += 1
+
+            self.retries.pop(chat_id, None)
+
+            if queue:
+                self.__schedule(chat_id, now)
+            else:
+                del self.queues[chat_id]
+                self.changed.notify_all()
+
+            if now - self.pruned > 60:
+                self.__prune(now)
+
+    def __prune(self, now):
+        """Удаление ограничителей чатов, которым нечего отправлять и которые могут отправить пачку целиком"""
+        self.pruned = now
+        for chat_id in [c for (c, b) in self.buckets.items() if c not in self.queues and b.full(now)]:
+            del self.buckets[chat_id]
+
+    def pending(self):
+        """Число чатов с неотправленными сообщениями"""
+        with self.lock:
+            return len(self.queues)
+
+    def join(self):
+        """Ожидание отправки всех поставленных сообщений"""
+        with self.lock:
+            while self.queues:
+                self.changed.wait()
+
+    def shutdown(self, wait=True):
+        """Остановка (по умолчанию после отправки всех поставленных сообщений)"""
+        with self.lock:
+            self.closed = True
+            if not wait:
+                # Неотправленные сообщения отбрасываются, ждать нужно только уже начатые отправки
+                self.cancelled = True
+                self.ready.clear()
+                self.queues = {chat_id: deque() for chat_id in self.busy}
+            self.changed.notify_all()
+
+        for thread in self.threads:
+            thread.join()
@@ -4,23 +4,171 @@
 который в конечном результате преобразовывается во вложенную структуру, удобную для вычисления в модуле calc.py. Парсинг 
 осуществляется посредством контекстно-свободной грамматики с использованием Lark.
 """
+import os
+import re
+import sys
+
 from lark import Lark, Transformer
 
+from src.cache import LRUCache
+
+
+class FrozenAST(list):
+    """Неизменяемый узел дерева разбора. Сравнивается с обычными списками как список, но не допускает
+    изменения, поэтому один и тот же экземпляр можно безопасно отдавать из кэша разных вычислений"""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("AST is immutable")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = extend = insert = pop = remove = clear = sort = reverse = _immutable
+
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            self._hash = hash(tuple(self))
+            return self._hash
+
+    def __reduce__(self):
+        # pickle обходит вложенные списки рекурсивно, поэтому глубокое дерево сохраняется плоским (см. flatten)
+        if height(self) > DEEP:
+            return thaw, flatten(self)
+        return FrozenAST, (list(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+"""Высота дерева, начиная с которой оно обрабатывается без рекурсии (длинная сумма 1 + 1 + ... + 1 -- дерево,
+высота которого равна числу слагаемых, а глубина стека интерпретатора ограничена)"""
+DEEP = 100
+
+
+def freeze(expr):
+    """Labeled-value -> FrozenAST
+    Преобразование вложенных списков в неизменяемые (обход с явным стеком)"""
+    if not isinstance(expr, list) or isinstance(expr, FrozenAST):
+        return expr
+
+    done = dict()
+    stack = [(expr, False)]
+
+    while stack:
+        (x, visited) = stack.pop()
+
+        if visited:
+            done[id(x)] = FrozenAST(done.get(id(y), y) for y in x)
+        elif id(x) not in done:
+            stack.append((x, True))
+            stack.extend((y, False) for y in x if isinstance(y, list) and not isinstance(y, FrozenAST))
+
+    return done[id(expr)]
+
+
+def height(expr):
+    """Labeled-value -> Int
+    Число уровней вложенных списков в дереве (обход с явным стеком; для неизменяемых деревьев высота
+    сохраняется в узлах)"""
+    if not isinstance(expr, list):
+        return 0
+
+    res = getattr(expr, 'height', None)
+    if res is not None:
+        return res
+
+    heights = dict()
+    stack = [(expr, False)]
+
+    while stack:
+        (x, visited) = stack.pop()
+
+        if visited:
+            res = heights[id(x)] = 1 + max([heights[id(y)] for y in x if isinstance(y, list)], default=0)
+            if isinstance(x, FrozenAST):
+                x.height = res
+            continue
+
+        res = getattr(x, 'height', None)
+        if res is not None:
+            heights[id(x)] = res
+        elif id(x) not in heights:
+            stack.append((x, True))
+            stack.extend((y, False) for y in x if isinstance(y, list))
+
+    return heights[id(expr)]
+
+
+def node(*items):
+    """Неизменяемый узел из элементов items (дети-списки -- тоже неизменяемые узлы); высота узла вычисляется
+    по высотам детей сразу, поэтому для дерева разбора height не обходит его"""
+    res = FrozenAST(items)
+
+    height = 0
+    for y in items:
+        if type(y) is FrozenAST and y.height > height:
+            height = y.height
+
+    res.height = height + 1
+    return res
+
+
+def flatten(expr):
+    """FrozenAST -> (List, List(Int))
+    Дерево в виде двух плоских списков: листья и число детей каждого узла (-1 у листа) при обходе в прямом порядке"""
+    leaves = []
+    shape = []
+    stack = [expr]
+
+    while stack:
+        x = stack.pop()
+
+        if isinstance(x, list):
+            shape.append(len(x))
+            stack.extend(reversed(x))
+        else:
+            shape.append(-1)
+            leaves.append(x)
+
+    return leaves, shape
+
+
+def thaw(leaves, shape):
+    """Восстановление дерева, сохранённого flatten"""
+    leaves = list(leaves)
+    stack = []
+    push = stack.append
+
+    for n in reversed(shape):
+        if n < 0:
+            push(leaves.pop())
+        elif n:
+            # Дети узла лежат на вершине стека в обратном порядке
+            node = stack[-n:]
+            del stack[-n:]
+            node.reverse()
+            push(FrozenAST(node))
+        else:
+            push(FrozenAST())
+
+    return stack.pop()
+
 
 class TreeTransformer(Transformer):
-    """Класс-трансформер для преобразования AST"""
+    """Класс-трансформер для преобразования AST. Узлы создаются сразу неизменяемыми, поэтому результат разбора
+    не нужно копировать в неизменяемое дерево (freeze)"""
 
     def unset(self, x):
-        return ["unset", str(x[0])]
+        return node("unset", str(x[0]))
 
     def undef(self, func):
-        return ["undef", str(func[0])]
+        return node("undef", str(func[0]))
 
     def num(self, x):
-        try:
-            return int(x[0])
-        except:
-            return float(x[0])
+        return num(x[0])
 
     def complex_num(self, x):
         return complex(0, float(x[0]))
@@ -31,27 +179,27 @@ class TreeTransformer(Transformer):
     def sub(self, x):
         a = x[0]
         b = x[1]
-        return ["apply", "-", [a, b]]
+        return node("apply", "-", node(a, b))
 
     def add(self, x):
         a = x[0]
         b = x[1]
-        return ["apply", "+", [a, b]]
+        return node("apply", "+", node(a, b))
 
     def mul(self, x):
         a = x[0]
         b = x[1]
-        return ["apply", "*", [a, b]]
+        return node("apply", "*", node(a, b))
 
     def div(self, x):
         a = x[0]
         b = x[1]
-        return ["apply", "/", [a, b]]
+        return node("apply", "/", node(a, b))
 
     def pow(self, x):
         a = x[0]
         b = x[1]
-        return ["apply", "pow", [a, b]]
+        return node("apply", "pow", node(a, b))
 
     def var(self, x):
         return str(x[0])
@@ -59,26 +207,26 @@ class TreeTransformer(Transformer):
     def assign(self, x):
         a = str(x[0])
         b = x[1]
-        return ["set", a, b]
+        return node("set", a, b)
 
     def func_call(self, x):
         a = str(x[0])
         b = x[1]
-        return ["apply", a, b]
+        return node("apply", a, b)
 
     def var_args(self, x):
-        return [str(a) for a in x]
+        return node(*[str(a) for a in x])
 
     def def_func(self, x):
         a = str(x[0])
         b = x[1]
         c = x[2]
-        return ["def", a, b, c]
+        return node("def", a, b, c)
 
     def atom_units(self, x):
         a = x[0]
         b = x[1]
-        return ['with_units', a, b]
+        return node('with_units', a, b)
 
     def unit(self, x):
         return str(x[0])
@@ -86,25 +234,35 @@ class TreeTransformer(Transformer):
     def unit_mul(self, x):
         a = x[0]
         b = x[1]
-        return ["unit_mul", a, str(b)]
+        return node("unit_mul", a, str(b))
 
     def unit_div(self, x):
         a = x[0]
         b = x[1]
-        return ["unit_div", a, str(b)]
+        return node("unit_div", a, str(b))
 
     def units(self, x):
         return x[0]
 
     def matrix(self, x):
-        return ['matrix', x]
+        return node('matrix', node(*x))
+
+    def numeric_matrix(self, x):
+        """Литерал матрицы из одних чисел, разобранный лексером одним токеном; результат тот же, что дал бы
+        разбор по элементам (в том числе литерал из одного элемента -- сам элемент)"""
+        rows = [[num(item) for item in row.split(',')] for row in _rows.findall(str(x[0]))]
+        rows = [row[0] if len(row) == 1 else node('matrix', node(*row)) for row in rows]
+
+        if str(x[0]).count('[') == 1 or len(rows) == 1:
+            return rows[0]
+        return node('matrix', node(*rows))
 
     def args(self, x):
-        return x
+        return node(*x)
 
     def convert(self, x):
         val, to = x
-        return ["convert", val, to]
+        return node("convert", val, to)
 
     def number_base(self, x):
         digits = x[:-1]
@@ -125,8 +283,20 @@ class TreeTransformer(Transformer):
 
         return res
 
-"""Описание грамматики"""
-parser = Lark(r"""
+
+_rows = re.compile(r'\[([^\[\]]*)\]')
+
+
+def num(s):
+    """Число из записи NUMBER: целое, если это возможно"""
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
+
+
+"""Описание грамматики (LALR(1)-совместимая)"""
+GRAMMAR = r"""
     ?toplevel : expr
               | expr "->" units -> convert
               | assign
@@ -138,7 +308,7 @@ parser = Lark(r"""
 
     ?unset : "unset" NAME
 
-    ?var_args : NAME ("," NAME)*
+    var_args : NAME ("," NAME)*
 
     ?def_func : "def" NAME "(" var_args? ")" "=" expr
 
@@ -158,6 +328,13 @@ parser = Lark(r"""
     args : expr ("," expr)*
 
     ?matrix : "[" expr ("," expr)* "]"
+            | NUMERIC_MATRIX -> numeric_matrix
+
+    // Литерал матрицы (вектора) из одних чисел разбирается как один токен: у больших матриц разбор каждого
+    // элемента как выражения занимает основное время
+    _NUM : /-?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?/
+    _ROW : "[" WS_INLINE? _NUM (WS_INLINE? "," WS_INLINE? _NUM)* WS_INLINE? "]"
+    NUMERIC_MATRIX.2 : _ROW | "[" WS_INLINE? _ROW (WS_INLINE? "," WS_INLINE? _ROW)* WS_INLINE? "]"
 
     ?units_inner: NAME -> unit
                 | units_inner "*" NAME -> unit_mul
@@ -186,11 +363,93 @@ parser = Lark(r"""
     %import common.WS_INLINE
 
     %ignore WS_INLINE
-    """, start='toplevel')
-transformer = TreeTransformer()
+    """
+
+"""Заранее построенный парсер (таблицы LALR), создаётся при сборке командой python -m src.parser build.
+Lark загружает его, только если файл построен по текущему тексту грамматики (и той же версией lark и python),
+иначе строит парсер заново и перезаписывает файл"""
+ARTIFACT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grammar.lark.cache')
+
+
+def make_parser(artifact=ARTIFACT):
+    """Парсер, загружаемый из файла artifact; трансформер применяется во время разбора,
+    поэтому промежуточное дерево не создаётся"""
+    return Lark(GRAMMAR, start='toplevel', parser='lalr', transformer=TreeTransformer(), cache=artifact)
+
+
+def build(artifact=ARTIFACT):
+    """Построение файла с парсером заново"""
+    if os.path.exists(artifact):
+        os.remove(artifact)
+
+    make_parser(artifact)
+    return artifact
+
+
+parser = make_parser()
+
+
+_separators = re.compile(r'[;\n]')
+
+
+def split(s):
+    """Непустые выражения программы: выражения разделяются переводом строки или точкой с запятой"""
+    return [x.strip() for x in _separators.split(s) if x.strip()]
 
 
 def parse(s):
-    """String -> Labeled-value
-    Парсинг строки в удобный для вычислений вид"""
-    return transformer.transform(parser.parse(s))
+    """String -> FrozenAST
+    Парсинг строки в удобный для вычислений неизменяемый вид. Программа из нескольких выражений --
+    ["program", [выражения]]"""
+    statements = split(s)
+
+    if len(statements) > 1:
+        return node("program", node(*[parser.parse(x) for x in statements]))
+
+    return parser.parse(statements[0] if statements else s)
+
+
+"""Кэш разобранных выражений: нормализованная строка -> неизменяемое дерево"""
+parse_cache = LRUCache(1024)
+
+_spaces = re.compile(r'[ \t]+')
+
+
+def normalize(s):
+    """Приведение строки к каноническому виду: пробельные символы внутри строки схлопываются,
+    по краям -- отбрасываются (на результат разбора это не влияет)"""
+    return _spaces.sub(' ', s.strip())
+
+
+def cached_parse(s):
+    """String -> FrozenAST
+    Парсинг строки с использованием кэша, результат изменять нельзя. На выражения строка делится только при
+    промахе кэша и только если в ней есть разделители"""
+    key = normalize(s)
+
+    expr = parse_cache.get(key)
+    if expr is None:
+        statements = split(key) if ';' in key or '\n' in key else [key]
+        canonical = '; '.join(statements)
+
+        if canonical != key:
+            # Та же программа, записанная по-другому (или одно выражение с разделителем в конце)
+            expr = cached_parse(canonical)
+        elif len(statements) > 1:
+            # Выражения программы кэшируются и по отдельности: одинаковые строки разных программ
+            # разбираются и компилируются один раз
+            expr = node("program", node(*[cached_parse(x) for x in statements]))
+        else:
+            # Разделителей нет: строка разбирается целиком, без повторного деления в parse
+            expr = parser.parse(key)
+        parse_cache.put(key, expr)
+
+    return expr
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['build']:
+        print("Usage: python -m src.parser build")
+        sys.exit(2)
+
+    print("Built {}".format(build()))
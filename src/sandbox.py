@@ -0,0 +1,192 @@
+"""
+Изолированное вычисление выражений в отдельных процессах. Пул заранее запущенных процессов-вычислителей
+(numpy, pint и парсер в них уже импортированы) принимает выражение вместе с данными окружения чата и
+возвращает текст результата и изменившиеся данные. Для каждого запроса действует ограничение по времени,
+для процесса -- ограничение памяти; процесс, превысивший время, уничтожается и заменяется новым, а
+пользователь получает сообщение об ошибке.
+
+Окружение создаётся в процессе заново для каждого запроса, поэтому результаты мемоизации функций (calc.Memo)
+между запросами не сохраняются; они сохраняются, если чаты закреплены за процессами (см. shard.py).
+"""
+import multiprocessing
+import pickle
+import queue
+import threading
+
+from src.codec import decode, encode
+from src.metrics import metrics
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+"""Модули, импортируемые процессами пула заранее"""
+PRELOAD = ['numpy', 'pint', 'src.parser', 'src.calc']
+
+
+def context():
+    """Контекст multiprocessing: forkserver (процессы порождаются из чистого процесса с уже загруженными модулями,
+    а не из многопоточного процесса бота), если он недоступен -- spawn"""
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload(PRELOAD)
+        return ctx
+    return multiprocessing.get_context('spawn')
+
+
+def serve(conn, memory):
+    """Цикл процесса-вычислителя: (выражение, данные, ограничения, собирать ли метрики) ->
+    ('ok', (результат, новые данные или None), метрики) | ('error', args, метрики) | ('exception', e, метрики),
+    где метрики -- Metrics.export() этого запроса или None. Данные передаются в формате codec.py: pickle
+    величин pint создаёт их в другом реестре единиц, и с величинами калькулятора они бы не складывались"""
+    if memory is not None and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+    from src.calc import BUILTINS, Environment, calculate, get_ureg
+
+    # Реестр единиц создаётся заранее, чтобы не тратить на это время первого запроса
+    get_ureg()
+
+    while True:
+        try:
+            (text, data, limits, collect) = conn.recv()
+        except EOFError:
+            return
+
+        metrics.enabled = collect
+        if collect:
+            metrics.reset()
+
+        try:
+            env = Environment(root=BUILTINS)
+            env.set_data(decode(data))
+
+            res = str(calculate(text, env, limits))
+
+            reply = ('ok', (res, encode(env.get_data()) if env.changed else None))
+        except RuntimeError as e:
+            reply = ('error', e.args)
+        except MemoryError:
+            reply = ('error', ("Memory limit exceeded",))
+        except Exception as e:
+            reply = portable(e)
+
+        stats = metrics.export() if collect else None
+
+        try:
+            conn.send(reply + (stats,))
+        except Exception as e:
+            conn.send(('error', (repr(e),), stats))
+
+
+def portable(e):
+    """Ответ с исключением e: само исключение, если его можно передать в другой процесс, иначе -- его текст
+    (исключения lark, например, ссылаются на локальные функции парсера и не сериализуются)"""
+    try:
+        pickle.dumps(e)
+    except Exception:
+        return 'error', (str(e),)
+    return 'exception', e
+
+
+class Worker(object):
+    """Процесс-вычислитель и канал связи с ним"""
+
+    def __init__(self, ctx, memory):
+        (self.conn, child) = ctx.Pipe()
+        self.process = ctx.Process(target=serve, args=(child, memory), daemon=True)
+        self.process.start()
+        child.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class ProcessPool(object):
+    """Пул процессов для вычислений с ограничениями по времени (секунды) и памяти (байты)"""
+
+    def __init__(self, workers=2, timeout=5.0, memory=1 << 30):
+        self.ctx = context()
+        self.timeout = timeout
+        self.memory = memory
+        self.lock = threading.Lock()
+        self.workers = []
+        self.idle = queue.Queue()
+        self.restarts = 0
+
+        for _ in range(workers):
+            self.__spawn()
+
+    def __spawn(self):
+        worker = Worker(self.ctx, self.memory)
+
+        with self.lock:
+            self.workers.append(worker)
+
+        self.idle.put(worker)
+
+    def __replace(self, worker):
+        """Уничтожение процесса и запуск нового вместо него"""
+        worker.kill()
+
+        with self.lock:
+            self.workers.remove(worker)
+            self.restarts += 1
+
+        self.__spawn()
+
+    def calculate(self, text, data, timeout=None, limits=None):
+        """String, Data -> (String, Data or None)
+        Вычисление выражения в окружении с данными data; возвращает текст результата и новые данные окружения
+        (None, если окружение не изменилось). Ошибки вычисления и превышение ограничений -- RuntimeError"""
+        if timeout is None:
+            timeout = self.timeout
+
+        worker = self.idle.get()
+
+        try:
+            worker.conn.send((text, encode(data), limits, metrics.enabled))
+
+            if not worker.conn.poll(timeout):
+                self.__replace(worker)
+                raise RuntimeError("Evaluation timed out after {} s".format(timeout))
+
+            reply = worker.conn.recv()
+        except (EOFError, OSError):
+            # Процесс завершился аварийно (например, из-за ограничения памяти)
+            self.__replace(worker)
+            raise RuntimeError("Evaluation failed: worker process died")
+
+        self.idle.put(worker)
+
+        (kind, value, stats) = reply
+
+        if stats is not None:
+            metrics.merge(stats)
+
+        if kind == 'error':
+            raise RuntimeError(*value)
+
+        if kind == 'exception':
+            raise value
+
+        (res, data) = value
+        return res, (decode(data) if data is not None else None)
+
+    def close(self):
+        """Остановка всех процессов"""
+        with self.lock:
+            workers = list(self.workers)
+            self.workers.clear()
+
+        for worker in workers:
+            worker.kill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
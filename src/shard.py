@@ -0,0 +1,347 @@
+"""
+Распределение чатов между процессами. Супервизор запускает несколько процессов-обработчиков и направляет каждое
+сообщение процессу, которому принадлежит чат (rendezvous hashing по chat_id среди работающих процессов), так что
+вычисления разных чатов идут на разных ядрах. Окружение чата используется только процессом-владельцем, поэтому
+блокировки между процессами не нужны: после каждого сообщения изменения сохраняются в общее хранилище SQLite
+(режим WAL допускает несколько процессов), откуда новый владелец загружает окружение сам.
+
+Если процесс завершился аварийно или вычисляет одно сообщение дольше timeout секунд (тогда супервизор завершает
+его сам), сообщение, которое он обрабатывал, получает ответ об ошибке, его чаты переходят к остальным процессам
+вместе с ещё не обработанными сообщениями, а через restart_delay секунд он запускается заново и чаты
+возвращаются к нему.
+Смена владельцев проходит через барьер: супервизор рассылает новое распределение, каждый процесс, обработав уже
+полученные сообщения, сохраняет и выгружает окружения чатов, которые ему больше не принадлежат, и подтверждает это;
+до подтверждения всеми процессами новые сообщения задерживаются.
+"""
+import hashlib
+import itertools
+import logging
+import threading
+import time
+from multiprocessing.connection import wait
+
+from src.sandbox import context
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+"""Ответ на сообщение, при обработке которого процесс завершился аварийно"""
+WORKER_DIED = str(("Evaluation failed: worker process died",))
+
+"""Ответ на сообщение, вычисление которого превысило ограничение времени"""
+TIMED_OUT = "Evaluation timed out after {} s"
+
+
+def score(shard, chat_id):
+    return hashlib.blake2b(b'%d:%d' % (shard, chat_id), digest_size=8).digest()
+
+
+def owner(chat_id, live):
+    """Номер процесса-владельца чата среди работающих live: при выходе процесса из строя
+    переходят к другим только его чаты, остальные остаются на месте"""
+    return max(live, key=lambda shard: score(shard, chat_id))
+
+
+def work(shard, path, inbox, conn, memory, limits):
+    """Цикл процесса-обработчика: ('eval', seq, chat_id, text) -> ('reply', seq, chat_id, ответ или None),
+    ('rebalance', epoch, live) -> ('ready', epoch); None -- завершение"""
+    if memory is not None and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+    from src.dispatch import evaluate
+    from src.storage import EnvironmentCache, open_store
+
+    with open_store(path) as store:
+        envs = EnvironmentCache(store)
+
+        while True:
+            task = inbox.get()
+            if task is None:
+                break
+
+            if task[0] == 'rebalance':
+                (_, epoch, live) = task
+                envs.release(lambda chat_id: owner(chat_id, live) == shard)
+                conn.send(('ready', epoch))
+                continue
+
+            (_, seq, chat_id, text) = task
+
+            try:
+                res = evaluate(envs, chat_id, text, limits=limits)
+            except Exception:
+                logger.exception("Error while processing message from chat %s", chat_id)
+                res = None
+
+            conn.send(('reply', seq, chat_id, res))
+
+        envs.flush()
+
+
+class Shard(object):
+    """Процесс-обработчик, очередь его сообщений и канал ответов"""
+
+    def __init__(self, ctx, shard, path, memory, limits):
+        self.inbox = ctx.Queue()
+        (self.conn, child) = ctx.Pipe(duplex=False)
+        self.process = ctx.Process(target=work, args=(shard, path, self.inbox, child, memory, limits), daemon=True)
+        self.process.start()
+        child.close()
+
+
+class Supervisor(object):
+    """Пул процессов, каждый из которых обрабатывает сообщения своих чатов; ответ -- reply(chat_id, text).
+    Данные чатов -- в хранилище SQLite path; limits -- ограничения вычислений по чатам (dispatch.ChatLimits,
+    передаются процессам при запуске; по умолчанию calc.DEFAULT_LIMITS для всех), timeout -- ограничение времени его обработки (секунды)"""
+
+    def __init__(self, path, reply, workers=4, memory=1 << 30, limits=None, timeout=5.0, restart_delay=1.0):
+        self.ctx = context()
+        self.path = path
+        self.reply = reply
+        self.memory = memory
+        self.limits = limits
+        self.timeout = timeout
+        self.restart_delay = restart_delay
+
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+
+        self.shards = dict()
+        self.restart_at = dict()
+        self.live = frozenset()
+        self.epoch = 0
+        self.waiting = set()
+        self.held = []
+        self.outstanding = dict()
+        # Число сообщений в очереди процесса и время, с которого он обрабатывает первое из них
+        self.load = dict()
+        self.busy = dict()
+        self.expired = dict()
+        self.seq = itertools.count()
+        self.restarts = 0
+        self.rebalances = 0
+        self.closed = False
+
+        for shard in range(workers):
+            self.shards[shard] = Shard(self.ctx, shard, path, memory, self.limits)
+        self.live = frozenset(self.shards)
+
+        self.thread = threading.Thread(target=self.__loop, name='supervisor', daemon=True)
+        self.thread.start()
+
+    def submit(self, chat_id, text):
+        """Передача сообщения процессу-владельцу чата (без ожидания ответа)"""
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Supervisor is closed")
+
+            seq = next(self.seq)
+
+            if self.waiting or not self.live:
+                self.held.append((seq, chat_id, text))
+            else:
+                self.__route(seq, chat_id, text)
+
+    def __route(self, seq, chat_id, text):
+        shard = owner(chat_id, self.live)
+        self.outstanding[seq] = (shard, chat_id, text)
+        self.shards[shard].inbox.put(('eval', seq, chat_id, text))
+
+        self.load[shard] = self.load.get(shard, 0) + 1
+        self.busy.setdefault(shard, time.monotonic())
+
+    def __rebalance(self):
+        """Рассылка нового распределения чатов; сообщения задерживаются до подтверждения всеми процессами"""
+        self.epoch += 1
+        self.rebalances += 1
+        self.waiting = set(self.live)
+
+        for shard in self.live:
+            self.shards[shard].inbox.put(('rebalance', self.epoch, self.live))
+
+    def __loop(self):
+        """Приём ответов, обнаружение аварийно завершившихся и зависших процессов и их перезапуск"""
+        while True:
+            with self.lock:
+                if self.closed and not self.live:
+                    return
+
+                now = time.monotonic()
+                for shard in [s for (s, when) in self.restart_at.items() if when <= now and not self.closed]:
+                    self.__restart(shard)
+
+                for shard in [s for (s, since) in self.busy.items() if now - since > self.timeout]:
+                    self.__expire(shard)
+
+                shards = {self.shards[s].conn: s for s in self.live}
+                sentinels = {self.shards[s].process.sentinel: s for s in self.live}
+                timeout = min([when - now for when in self.restart_at.values()] + [0.1])
+
+            replies = []
+            ready = wait(list(shards) + list(sentinels), max(timeout, 0.0))
+
+            # Сначала принимаются ответы: завершившийся процесс мог успеть отправить часть из них
+            for conn in [c for c in ready if c in shards]:
+                replies.extend(self.__receive(shards[conn], conn))
+
+            for sentinel in [s for s in ready if s in sentinels]:
+                shard = sentinels[sentinel]
+                replies.extend(self.__receive(shard, self.shards[shard].conn))
+                replies.extend(self.__died(shard))
+
+            for (chat_id, text) in replies:
+                try:
+                    self.reply(chat_id, text)
+                except Exception:
+                    logger.exception("Error while replying to chat %s", chat_id)
+
+    def __receive(self, shard, conn):
+        """Обработка сообщений процесса; результат -- ответы, которые нужно отправить"""
+        replies = []
+
+        while True:
+            try:
+                if not conn.poll():
+                    break
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+
+            with self.lock:
+                if shard in self.busy:
+                    self.busy[shard] = time.monotonic()
+
+                if message[0] == 'ready':
+                    if message[1] == self.epoch:
+                        self.waiting.discard(shard)
+                        if not self.waiting:
+                            self.__release()
+                    continue
+
+                (_, seq, chat_id, text) = message
+                if self.outstanding.pop(seq, None) is not None:
+                    self.__done(shard)
+                    if text is not None:
+                        replies.append((chat_id, text))
+
+                if not self.outstanding and not self.held:
+                    self.idle.notify_all()
+
+        return replies
+
+    def __done(self, shard):
+        """Процесс закончил обработку одного сообщения"""
+        self.load[shard] -= 1
+        if not self.load[shard]:
+            del self.load[shard]
+            del self.busy[shard]
+
+    def __expire(self, shard):
+        """Процесс обрабатывает сообщение дольше timeout: он завершается (и будет перезапущен, см. __died)"""
+        if shard in self.expired:
+            return
+
+        seq = next(seq for (seq, (s, _, _)) in self.outstanding.items() if s == shard)
+        logger.warning("Shard %s timed out on message from chat %s", shard, self.outstanding[seq][1])
+
+        self.expired[shard] = seq
+        self.shards[shard].process.kill()
+
+    def __release(self):
+        """Передача задержанных сообщений владельцам по новому распределению"""
+        (held, self.held) = (self.held, [])
+
+        for (seq, chat_id, text) in held:
+            self.__route(seq, chat_id, text)
+
+    def __died(self, shard):
+        """Процесс завершился: сообщение, которое он обрабатывал, получает ответ об ошибке, остальные
+        его сообщения вместе с чатами переходят к другим процессам"""
+        with self.lock:
+            expired = self.expired.pop(shard, None)
+            self.load.pop(shard, None)
+            self.busy.pop(shard, None)
+
+            if self.closed:
+                self.live = self.live - {shard}
+                return []
+
+            if expired is None:
+                logger.warning("Shard %s died with exit code %s", shard, self.shards[shard].process.exitcode)
+
+            # Очередь процесса больше никто не читает, её данные не нужно дописывать при выходе
+            self.shards[shard].inbox.cancel_join_thread()
+
+            lost = [(seq, chat_id, text) for (seq, (s, chat_id, text)) in self.outstanding.items() if s == shard]
+            for (seq, _, _) in lost:
+                del self.outstanding[seq]
+
+            # Сообщения обрабатываются по порядку: первое -- то, на котором процесс завершился. Остальные
+            # отправлены раньше задержанных и передаются новым владельцам первыми
+            replies = []
+            if lost:
+                (_, chat_id, _) = lost.pop(0)
+                replies.append((chat_id, WORKER_DIED if expired is None else str((TIMED_OUT.format(self.timeout),))))
+            self.held = lost + self.held
+
+            self.live = self.live - {shard}
+            self.restart_at[shard] = time.monotonic() + self.restart_delay
+            self.__rebalance()
+
+            if not self.outstanding and not self.held:
+                self.idle.notify_all()
+
+        return replies
+
+    def __restart(self, shard):
+        """Запуск процесса вместо завершившегося; его чаты возвращаются к нему"""
+        del self.restart_at[shard]
+        self.shards[shard].conn.close()
+        self.shards[shard] = Shard(self.ctx, shard, self.path, self.memory, self.limits)
+        self.restarts += 1
+
+        self.live = self.live | {shard}
+        self.__rebalance()
+
+    def pending(self):
+        """Число сообщений без ответа"""
+        with self.lock:
+            return len(self.outstanding) + len(self.held)
+
+    def join(self):
+        """Ожидание ответов на все переданные сообщения"""
+        with self.lock:
+            while self.outstanding or self.held:
+                self.idle.wait()
+
+    def shutdown(self, wait=True):
+        """Остановка процессов (по умолчанию после ответа на все сообщения); окружения сохраняются в хранилище"""
+        if wait:
+            self.join()
+
+        with self.lock:
+            self.closed = True
+            self.restart_at.clear()
+            shards = [self.shards[s] for s in self.live]
+
+        for shard in shards:
+            shard.inbox.put(None)
+
+        for shard in shards:
+            shard.process.join()
+
+        self.thread.join()
+
+        for shard in self.shards.values():
+            shard.conn.close()
+            shard.inbox.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
@@ -0,0 +1,327 @@
+"""
+Хранилища состояний чатов. Состояние чата -- данные пользовательского окружения (Environment.get_data),
+которые сохраняются между сообщениями. Интерфейс StateStore позволяет подменять способ хранения; основная
+реализация -- SQLite в режиме WAL, где каждому чату соответствует одна строка, перезаписываемая только если
+окружение чата действительно изменилось. Данные хранятся в формате codec.py, записи старого формата (pickle)
+читаются и переписываются в новом формате при следующем сохранении чата или все сразу командой upgrade.
+Для перехода со старой базы shelve есть одноразовая миграция:
+
+    python -m src.storage migrate MySuperCoolDataBase MySuperCoolDataBase.sqlite
+    python -m src.storage upgrade MySuperCoolDataBase.sqlite
+"""
+import shelve
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from src.calc import BUILTINS, Environment
+from src.codec import HEADER, decode, encode, upgrade
+
+
+class StateStore(object):
+    """Интерфейс хранилища: отображение идентификатора чата в данные его окружения"""
+
+    def load(self, chat_id):
+        """Данные окружения чата или None, если чат ещё не сохранялся"""
+        raise NotImplementedError
+
+    def save(self, chat_id, data):
+        """Сохранение данных окружения чата"""
+        raise NotImplementedError
+
+    def chats(self):
+        """Идентификаторы всех сохранённых чатов"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def environment(self, chat_id):
+        """Пользовательское окружение чата поверх общего корня"""
+        env = Environment(root=BUILTINS)
+
+        data = self.load(chat_id)
+        if data is not None:
+            env.set_data(data)
+
+        return env
+
+    def commit(self, chat_id, env):
+        """Сохранение окружения, только если оно изменилось после загрузки"""
+        if not env.changed:
+            return False
+
+        self.save(chat_id, env.get_data())
+        env.changed = False
+        return True
+
+    def __contains__(self, chat_id):
+        return self.load(chat_id) is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ShelveStore(StateStore):
+    """Хранилище на основе shelve (без writeback: запись происходит только при сохранении). Данные записываются
+    в формате codec.py, старые записи (сами объекты) читаются как есть"""
+
+    def __init__(self, path):
+        self.db = shelve.open(path)
+
+    def load(self, chat_id):
+        return unshelve(self.db.get(str(chat_id)))
+
+    def save(self, chat_id, data):
+        self.db[str(chat_id)] = encode(data)
+
+    def chats(self):
+        return [int(key) for key in self.db.keys()]
+
+    def close(self):
+        self.db.close()
+
+
+def unshelve(value):
+    """Данные окружения из значения shelve: записи codec.py или объекты старого формата"""
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return decode(value)
+    return upgrade(value)
+
+
+class SQLiteStore(StateStore):
+    """Хранилище в SQLite (режим WAL): одна строка на чат"""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+
+    def load(self, chat_id):
+        row = self.db.execute("SELECT data FROM chats WHERE chat_id = ?", (int(chat_id),)).fetchone()
+        if row is None:
+            return None
+        return decode(row[0])
+
+    def save(self, chat_id, data):
+        self.db.execute("INSERT INTO chats (chat_id, data) VALUES (?, ?) "
+                        "ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data", (int(chat_id), encode(data)))
+
+    def save_many(self, items):
+        """Сохранение нескольких чатов одной транзакцией"""
+        with self.db:
+            self.db.execute("BEGIN")
+            for (chat_id, data) in items:
+                self.save(chat_id, data)
+
+    def chats(self):
+        return [row[0] for row in self.db.execute("SELECT chat_id FROM chats")]
+
+    def upgrade(self):
+        """Перезапись всех записей старого формата в текущем; возвращает число переписанных чатов"""
+        rows = self.db.execute("SELECT chat_id, data FROM chats WHERE substr(data, 1, ?) != ?",
+                               (len(HEADER), HEADER)).fetchall()
+        self.save_many((chat_id, decode(blob)) for (chat_id, blob) in rows)
+        return len(rows)
+
+    def close(self):
+        self.db.close()
+
+
+class EnvironmentCache(object):
+    """Ограниченное множество окружений недавно активных чатов, хранящихся в памяти. При превышении бюджета
+    (число окружений и/или суммарный размер сериализованных данных) давно не активные чаты вытесняются:
+    несохранённые изменения записываются в хранилище, а при следующем сообщении окружение загружается заново.
+    Окружения чатов, сообщения которых сейчас обрабатываются (pin), не вытесняются: их вытеснение откладывается
+    до unpin, иначе в хранилище записалось бы окружение, которое в этот момент изменяет другой поток.
+    Методы можно вызывать из разных потоков (доступ к хранилищу сериализуется)"""
+
+    def __init__(self, store, max_entries=10000, max_bytes=None):
+        self.lock = threading.RLock()
+        self.store = store
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.envs = OrderedDict()
+        self.sizes = dict()
+        self.in_use = dict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.evictions = 0
+        self.reloads = 0
+        self.reload_time = 0.0
+        self.max_reload_time = 0.0
+
+    def get(self, chat_id):
+        """Окружение чата (из памяти или из хранилища)"""
+        with self.lock:
+            return self.__get(chat_id)
+
+    def __get(self, chat_id):
+        env = self.envs.get(chat_id)
+
+        if env is not None:
+            self.envs.move_to_end(chat_id)
+            self.hits += 1
+            return env
+
+        start = time.perf_counter()
+        env = self.store.environment(chat_id)
+        elapsed = time.perf_counter() - start
+
+        self.reloads += 1
+        self.reload_time += elapsed
+        self.max_reload_time = max(self.max_reload_time, elapsed)
+
+        self.envs[chat_id] = env
+        self.__resize(chat_id, env)
+        self.__evict()
+
+        return env
+
+    def pin(self, chat_id):
+        """Начало обработки сообщения чата: пока она не закончена, окружение чата не вытесняется"""
+        with self.lock:
+            self.in_use[chat_id] = self.in_use.get(chat_id, 0) + 1
+
+    def unpin(self, chat_id):
+        """Конец обработки сообщения чата; отложенные вытеснения выполняются"""
+        with self.lock:
+            count = self.in_use.pop(chat_id) - 1
+            if count:
+                self.in_use[chat_id] = count
+            else:
+                self.__evict()
+
+    def commit(self, chat_id, env):
+        """Сохранение изменившегося окружения в хранилище (окружение остаётся в памяти)"""
+        with self.lock:
+            if not self.store.commit(chat_id, env):
+                return False
+
+            if chat_id in self.envs:
+                self.__resize(chat_id, env)
+                self.__evict()
+
+            return True
+
+    def flush(self):
+        """Сохранение всех несохранённых окружений"""
+        with self.lock:
+            for (chat_id, env) in self.envs.items():
+                self.store.commit(chat_id, env)
+
+    def release(self, keep):
+        """Сохранение и удаление из памяти окружений чатов, для которых keep(chat_id) ложно"""
+        with self.lock:
+            for chat_id in [c for c in self.envs if not keep(c)]:
+                self.store.commit(chat_id, self.envs.pop(chat_id))
+                self.total_bytes -= self.sizes.pop(chat_id, 0)
+
+    def drop(self):
+        """Сохранение и удаление из памяти всех окружений"""
+        with self.lock:
+            self.flush()
+            self.envs.clear()
+            self.sizes.clear()
+            self.total_bytes = 0
+
+    def __resize(self, chat_id, env):
+        """Учёт размера окружения (только если задан бюджет по памяти)"""
+        if self.max_bytes is None:
+            return
+
+        size = len(encode(env.get_data()))
+        self.total_bytes += size - self.sizes.get(chat_id, 0)
+        self.sizes[chat_id] = size
+
+    def __over_budget(self):
+        if len(self.envs) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self.total_bytes > self.max_bytes and len(self.envs) > 1
+
+    def __evict(self):
+        while self.__over_budget():
+            chat_id = next((c for c in self.envs if c not in self.in_use), None)
+            if chat_id is None:
+                # Все окружения используются, бюджет превышен до окончания обработки их сообщений
+                return
+
+            env = self.envs.pop(chat_id)
+            self.store.commit(chat_id, env)
+            self.total_bytes -= self.sizes.pop(chat_id, 0)
+            self.evictions += 1
+
+    def stats(self):
+        """Статистика: число окружений в памяти, вытеснения и время загрузки"""
+        return {'resident': len(self.envs),
+                'resident_bytes': self.total_bytes if self.max_bytes is not None else None,
+                'hits': self.hits,
+                'evictions': self.evictions,
+                'reloads': self.reloads,
+                'avg_reload_ms': self.reload_time / self.reloads * 1e3 if self.reloads else 0.0,
+                'max_reload_ms': self.max_reload_time * 1e3}
+
+    def __contains__(self, chat_id):
+        return chat_id in self.envs
+
+    def __len__(self):
+        return len(self.envs)
+
+
+def open_store(path):
+    """Открытие хранилища: файлы .sqlite/.db -- SQLite, остальные -- shelve"""
+    if path.endswith('.sqlite') or path.endswith('.db'):
+        return SQLiteStore(path)
+    return ShelveStore(path)
+
+
+def migrate(source, target):
+    """Перенос всех чатов из базы shelve в хранилище target. Старые записи (с полной таблицей встроенных
+    функций) при переносе сокращаются до пользовательских определений. Возвращает число перенесённых чатов"""
+    items = []
+
+    with shelve.open(source, flag='r') as db:
+        for key in db.keys():
+            env = Environment(root=BUILTINS)
+            env.set_data(unshelve(db[key]))
+            items.append((int(key), env.get_data()))
+
+    if isinstance(target, SQLiteStore):
+        target.save_many(items)
+    else:
+        for (chat_id, data) in items:
+            target.save(chat_id, data)
+
+    return len(items)
+
+
+def main(args):
+    if len(args) == 2 and args[0] == 'upgrade':
+        with SQLiteStore(args[1]) as store:
+            count = store.upgrade()
+
+        print("Upgraded {} chats in {}".format(count, args[1]))
+        return 0
+
+    if len(args) != 3 or args[0] != 'migrate':
+        print("Usage: python -m src.storage migrate SHELVE_PATH TARGET_PATH\n"
+              "       python -m src.storage upgrade SQLITE_PATH")
+        return 2
+
+    with open_store(args[2]) as target:
+        count = migrate(args[1], target)
+
+    print("Migrated {} chats from {} to {}".format(count, args[1], args[2]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,210 @@
+"""
+Приём обновлений Telegram через webhook. HTTP-сервер на asyncio принимает POST-запросы с JSON обновления,
+проверяет секретный токен (заголовок X-Telegram-Bot-Api-Secret-Token, задаётся при setWebhook) и сразу отвечает
+200 OK, а обновление передаётся обработчику в отдельном потоке в порядке поступления. Поэтому ответ Telegram не
+ждёт вычислений, а медленный обработчик не задерживает приём запросов.
+
+Сервер работает в своём потоке со своим циклом событий (остальной бот -- потоки), TLS обычно завершает
+обратный прокси перед ним, но можно передать и ssl.SSLContext.
+"""
+import asyncio
+import hmac
+import json
+import logging
+import queue
+import threading
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+           411: 'Length Required', 413: 'Payload Too Large'}
+
+"""Метка остановки потока-обработчика"""
+STOP = object()
+
+
+class BadRequest(Exception):
+    """Запрос, на который отвечается кодом status (соединение после этого закрывается)"""
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+def response(status, keep_alive):
+    """Ответ HTTP без тела"""
+    return ("HTTP/1.1 {} {}\r\nContent-Length: 0\r\nConnection: {}\r\n\r\n".format(
+        status, REASONS[status], 'keep-alive' if keep_alive else 'close')).encode('latin-1')
+
+
+class WebhookServer(object):
+    """Сервер webhook: обновления (словари из JSON) передаются handle(update) в потоке-обработчике.
+    port=0 -- свободный порт, выбранный системой (после start доступен как self.port)"""
+
+    def __init__(self, handle, secret, host='127.0.0.1', port=8443, path='/', ssl=None, max_body=1 << 20):
+        self.handle = handle
+        self.secret = secret.encode('utf-8')
+        self.host = host
+        self.port = port
+        self.path = path
+        self.ssl = ssl
+        self.max_body = max_body
+
+        self.updates = queue.Queue()
+        self.received = 0
+        self.rejected = 0
+
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.worker = None
+
+    def start(self):
+        """Запуск сервера и обработчика; возвращается после того, как сервер начал принимать соединения"""
+        ready = threading.Event()
+        errors = []
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+
+            try:
+                self.server = self.loop.run_until_complete(
+                    asyncio.start_server(self.serve, self.host, self.port, ssl=self.ssl))
+            except Exception as e:
+                errors.append(e)
+                ready.set()
+                self.loop.close()
+                return
+
+            self.port = self.server.sockets[0].getsockname()[1]
+            ready.set()
+
+            try:
+                self.loop.run_forever()
+            finally:
+                self.server.close()
+                self.loop.run_until_complete(self.server.wait_closed())
+                self.loop.close()
+
+        self.worker = threading.Thread(target=self.process, name='webhook-handler', daemon=True)
+        self.worker.start()
+
+        self.thread = threading.Thread(target=run, name='webhook', daemon=True)
+        self.thread.start()
+        ready.wait()
+
+        if errors:
+            self.updates.put(STOP)
+            self.worker.join()
+            raise errors[0]
+
+        return self
+
+    def stop(self):
+        """Остановка: новые запросы не принимаются, уже принятые обновления обрабатываются до конца"""
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+
+        if self.worker is not None:
+            self.updates.put(STOP)
+            self.worker.join()
+            self.worker = None
+
+    def process(self):
+        """Поток-обработчик: обновления передаются handle по одному в порядке поступления"""
+        while True:
+            update = self.updates.get()
+            if update is STOP:
+                return
+
+            try:
+                self.handle(update)
+            except Exception:
+                logger.exception("Error while handling update %s", update.get('update_id'))
+
+    async def serve(self, reader, writer):
+        """Соединение с Telegram (их может быть несколько, в каждом запросы идут один за другим)"""
+        try:
+            while True:
+                try:
+                    keep_alive = await self.request(reader)
+                    status = 200
+                except BadRequest as e:
+                    (status, keep_alive) = (e.status, False)
+                    self.rejected += 1
+
+                writer.write(response(status, keep_alive))
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def request(self, reader):
+        """Чтение и проверка одного запроса; принятое обновление ставится в очередь обработчика.
+        Результат -- оставлять ли соединение открытым (если клиент закрыл его -- IncompleteReadError)"""
+        line = await reader.readline()
+        if not line:
+            raise asyncio.IncompleteReadError(line, None)
+
+        try:
+            (method, target, version) = line.decode('latin-1').split()
+        except ValueError:
+            raise BadRequest(400)
+
+        headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            (name, _, value) = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'transfer-encoding' in headers:
+            raise BadRequest(411)
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise BadRequest(400)
+
+        if length < 0:
+            raise BadRequest(400)
+        if length > self.max_body:
+            raise BadRequest(413)
+
+        body = await reader.readexactly(length)
+
+        if urlsplit(target).path != self.path:
+            raise BadRequest(404)
+        if method != 'POST':
+            raise BadRequest(405)
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, '').encode('utf-8'), self.secret):
+            raise BadRequest(403)
+
+        try:
+            update = json.loads(body)
+        except ValueError:
+            raise BadRequest(400)
+
+        if not isinstance(update, dict) or 'update_id' not in update:
+            raise BadRequest(400)
+
+        self.received += 1
+        self.updates.put(update)
+
+        return version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
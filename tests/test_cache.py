@@ -0,0 +1,64 @@
+import os
+import sys
+import threading
+
+import pytest
+
+import src.cache
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+
+class TestUM:
+    def test_get_put(self):
+        cache = src.cache.LRUCache(2)
+        cache.put('a', 1)
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert cache.stats()['hits'] == 1
+        assert cache.stats()['misses'] == 1
+
+    def test_eviction(self):
+        cache = src.cache.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        assert 'b' not in cache
+        assert 'a' in cache
+        assert cache.evictions == 1
+
+    def test_resize(self):
+        cache = src.cache.LRUCache(3)
+        for i in range(3):
+            cache.put(i, i)
+        cache.resize(1)
+        assert len(cache) == 1
+        assert cache.get(2) == 2
+        assert cache.evictions == 2
+
+    def test_negative_size(self):
+        with pytest.raises(ValueError):
+            src.cache.LRUCache(-1)
+
+    def test_threads(self):
+        cache = src.cache.LRUCache(8)
+        errors = []
+
+        def work(offset):
+            try:
+                for i in range(20000):
+                    cache.put((offset + i) % 16, i)
+                    cache.get((offset + i + 1) % 16)
+                    cache.pop((offset + i + 2) % 16)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(k,)) for k in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+        assert len(cache) <= 8
@@ -0,0 +1,102 @@
+import os
+import pickle
+import sys
+from fractions import Fraction
+
+import numpy as np
+import pytest
+
+import src.calc
+import src.codec
+import src.storage
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+
+def environment(*lines):
+    env = src.calc.Environment(root=src.calc.BUILTINS)
+    for line in lines:
+        src.calc.calculate(line, env)
+    return env
+
+
+def same(a, b):
+    """Равенство значений вместе с типом (у массивов -- и типом элементов)"""
+    if isinstance(a, np.ndarray):
+        return type(a) is type(b) and a.dtype == b.dtype and a.shape == b.shape and np.array_equal(a, b)
+    return type(a) is type(b) and a == b
+
+
+class TestUM:
+    def test_values(self):
+        ureg = src.calc.get_ureg()
+        values = {'i': 3, 'big': 7 ** 300, 'f': 2.5, 'c': 1 - 2j, 'b': True, 'fr': Fraction(1, 3),
+                  'a': np.arange(6).reshape(2, 3), 'z': np.array([1j, 2.5]), 'e': np.zeros((0, 4)),
+                  'm': np.matrix([[1.5, 2], [3, 4]]), 'g': np.float64(0.1), 'n': np.int32(-7),
+                  'q': 3 * ureg('m/s'), 'qa': np.array([1.0, 2.0]) * ureg('kg'), 'pi': src.calc.DELETED}
+        (variables, functions) = src.codec.decode(src.codec.encode([values, {}]))
+        assert functions == {}
+        for (name, value) in values.items():
+            if hasattr(value, 'magnitude'):
+                assert same(variables[name].magnitude, value.magnitude) and variables[name].units == value.units
+            elif isinstance(value, np.matrix):
+                # np.matrix больше не используется, загружается обычный массив
+                assert same(variables[name], np.asarray(value)), name
+            else:
+                assert same(variables[name], value), name
+        assert variables['pi'] is src.calc.DELETED
+        assert variables['a'].flags.writeable
+
+    def test_environment(self):
+        env = environment('x = 2', 'v = 3 {m}', 'def f(a, b) = a * b + sin(1) * x', 'def g(y) = 5',
+                          'undef T', 'M = [[1, 2], [3, 4]]')
+        blob = src.codec.encode(env.get_data())
+        assert blob.startswith(src.codec.HEADER)
+
+        copy = src.calc.Environment(root=src.calc.BUILTINS)
+        copy.set_data(src.codec.decode(blob))
+        assert copy.functions == env.functions
+        assert src.calc.calculate('f(3, 4) + g(0)', copy) == src.calc.calculate('f(3, 4) + g(0)', env)
+        assert str(src.calc.calculate('v + 2 {m}', copy)) == '5 meter'
+        assert src.calc.calculate('D(M)', copy) == pytest.approx(-2)
+        with pytest.raises(RuntimeError):
+            src.calc.calculate('T(M)', copy)
+        # Формат компактнее pickle самих объектов
+        assert len(blob) < len(pickle.dumps(env.get_data(), protocol=pickle.HIGHEST_PROTOCOL))
+
+    def test_deep_function(self):
+        env = environment('def f(x) = ' + ' + '.join(['x'] * 10000))
+        copy = src.calc.Environment(root=src.calc.BUILTINS)
+        copy.set_data(src.codec.decode(src.codec.encode(env.get_data())))
+        assert src.calc.calculate('f(2)', copy) == 20000
+
+    def test_legacy(self):
+        ureg = src.calc.get_ureg()
+        env = environment('def f(a) = a * 2')
+        # Старые записи: pickle самих объектов, тела функций -- обычные списки
+        data = [{'v': 3 * ureg('m'), 'M': np.matrix([[1, 2], [3, 4]])},
+                {'f': (False, (1, (['a'], ['apply', '*', ['a', 2]])))}]
+        (variables, functions) = src.codec.decode(pickle.dumps(data))
+        assert variables['v'] + 2 * ureg('m') == 5 * ureg('m')
+        assert type(variables['M']) is np.ndarray
+        assert variables['M'].tolist() == [[1, 2], [3, 4]]
+        old = src.codec.decode_value(('m', '<i8', (1, 2), np.array([[5, 6]]).tobytes()))
+        assert same(old, np.array([[5, 6]]))
+        assert functions == env.functions
+        assert isinstance(functions['f'][1][1][1], src.parser.FrozenAST)
+
+        with pytest.raises(ValueError):
+            src.codec.decode(src.codec.MAGIC + bytes([src.codec.VERSION + 1]))
+
+    def test_storage_upgrade(self, tmp_path):
+        with src.storage.SQLiteStore(str(tmp_path / 'state.sqlite')) as store:
+            data = environment('x = 2', 'def f(a) = a + x').get_data()
+            store.db.execute("INSERT INTO chats (chat_id, data) VALUES (1, ?)", (pickle.dumps(data),))
+            store.save(2, data)
+            assert store.load(1) == store.load(2)
+            assert store.upgrade() == 1
+            assert store.upgrade() == 0
+            assert store.db.execute("SELECT data FROM chats WHERE chat_id = 1").fetchone()[0].startswith(
+                src.codec.HEADER)
+            assert store.load(1) == data
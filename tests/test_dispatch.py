@@ -0,0 +1,111 @@
+import os
+import sys
+import threading
+
+import src.calc
+import src.dispatch
+import src.storage
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+
+class TestUM:
+    def test_chat_order(self):
+        dispatcher = src.dispatch.ChatDispatcher(workers=4)
+        res = {1: [], 2: []}
+        for i in range(50):
+            for chat_id in res:
+                dispatcher.submit(chat_id, res[chat_id].append, i)
+        dispatcher.shutdown()
+        assert res[1] == list(range(50))
+        assert res[2] == list(range(50))
+
+    def test_chats_in_parallel(self):
+        dispatcher = src.dispatch.ChatDispatcher(workers=2)
+        started = threading.Event()
+        done = threading.Event()
+
+        def slow():
+            started.set()
+            assert done.wait(5)
+
+        dispatcher.submit(1, slow)
+        assert started.wait(5)
+        dispatcher.submit(2, done.set)
+        dispatcher.shutdown()
+        assert done.is_set()
+
+    def test_error_does_not_stop_chat(self):
+        dispatcher = src.dispatch.ChatDispatcher(workers=1)
+        res = []
+        dispatcher.submit(1, lambda: 1 / 0)
+        dispatcher.submit(1, res.append, 1)
+        dispatcher.shutdown()
+        assert res == [1]
+
+    def test_evaluate(self, tmp_path):
+        with src.storage.SQLiteStore(str(tmp_path / 'state.sqlite')) as store:
+            envs = src.storage.EnvironmentCache(store)
+            dispatcher = src.dispatch.ChatDispatcher(workers=4)
+            res = []
+            for chat_id in range(10):
+                for text in ['x = {}'.format(chat_id), 'x * 2', 'y']:
+                    dispatcher.submit(chat_id, lambda c, t: res.append((c, src.dispatch.evaluate(envs, c, t))),
+                                      chat_id, text)
+            dispatcher.shutdown()
+            assert sorted(r for r in res if r[1] not in ('None', "('Variable y not found',)")) == \
+                [(chat_id, str(chat_id * 2)) for chat_id in range(10)]
+            assert store.load(3) == [{'x': 3}, {}]
+
+    def test_evaluate_program(self, tmp_path):
+        with src.storage.SQLiteStore(str(tmp_path / 'state.sqlite')) as store:
+            saves = []
+            save = store.save
+            store.save = lambda chat_id, data: saves.append(chat_id) or save(chat_id, data)
+            envs = src.storage.EnvironmentCache(store)
+            assert src.dispatch.evaluate(envs, 1, 'def f(x) = x + 1\nx = f(1); f(x)\nx * 10') == '3\n20'
+            assert saves == [1]
+            assert src.dispatch.evaluate(envs, 1, 'x = 5; y') == "('Variable y not found',)"
+            assert saves == [1]
+            assert store.load(1)[0] == {'x': 2}
+
+    def test_evaluate_chat_limits(self, tmp_path):
+        with src.storage.SQLiteStore(str(tmp_path / 'state.sqlite')) as store:
+            envs = src.storage.EnvironmentCache(store)
+            limits = src.dispatch.ChatLimits({1: src.calc.Limits(steps=10)}, default=src.calc.Limits(steps=1000))
+            text = ' + '.join(['sin(x)'] * 20)
+            for chat_id in (1, 2):
+                src.dispatch.evaluate(envs, chat_id, 'x = 0', limits=limits)
+            assert src.dispatch.evaluate(envs, 1, text, limits=limits) == \
+                "('Evaluation budget exceeded: steps limit is 10',)"
+            assert src.dispatch.evaluate(envs, 2, text, limits=limits) == '0.0'
+            assert limits.get(3).steps == 1000
+
+    def test_pinned_environments(self, tmp_path):
+        with src.storage.SQLiteStore(str(tmp_path / 'state.sqlite')) as store:
+            envs = src.storage.EnvironmentCache(store, max_entries=1)
+            dispatcher = src.dispatch.ChatDispatcher(workers=2, envs=envs)
+            started = threading.Event()
+            done = threading.Event()
+            resident = []
+
+            def slow():
+                src.dispatch.evaluate(envs, 1, 'x = 1')
+                started.set()
+                assert done.wait(5)
+
+            def other():
+                src.dispatch.evaluate(envs, 2, 'x = 2')
+                resident.append(1 in envs)
+                done.set()
+
+            dispatcher.submit(1, slow)
+            assert started.wait(5)
+            dispatcher.submit(2, other)
+            dispatcher.shutdown()
+            # Окружение чата 1 не вытесняется, пока его сообщение обрабатывается
+            assert resident == [True]
+            assert envs.in_use == {}
+            assert len(envs) == 1
+            assert store.load(1) == [{'x': 1}, {}]
@@ -0,0 +1,67 @@
+import os
+import sys
+
+import src.helpdoc
+import src.outbox
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+DEMO = myPath + '/../demo.xml'
+
+DOC = """<doc>
+<title>Contents</title>
+<help id="1.1" keywords="matrix">Transpose: T([1, 2])</help>
+<help id="1.2">Rank of a matrix: rk([[1, 2], [3, 4]])</help>
+</doc>
+"""
+
+
+class TestUM:
+    def test_sections(self):
+        index = src.helpdoc.HelpIndex(DEMO)
+        assert index.title().strip().startswith('Данный бот')
+        assert 'Обратная матрица' in index.section('5.5')
+        assert index.answer(['5.5']) == [index.section('5.5')]
+        assert index.answer([]) == [index.title()]
+        assert index.section('9.9') is None
+
+    def test_search(self):
+        index = src.helpdoc.HelpIndex(DEMO)
+        snapshot = index.get()
+        assert snapshot.search('matrix') == ['5.1', '5.2', '5.3', '5.4', '5.5', '5.6', '5.7', '5.8']
+        assert snapshot.search('matrix rank') == ['5.8']
+        assert snapshot.search('Логарифм') == ['3.1', '3.2', '3.3']
+        assert snapshot.search('sin') == ['2.1']
+        assert snapshot.search('') == []
+        assert index.answer(['matrix', 'inverse']) == [index.section('5.5')]
+        assert 'ничего не найдено' in index.answer(['nothing'])[0]
+        assert index.loads == 1
+
+    def test_reload(self, tmp_path):
+        path = tmp_path / 'help.xml'
+        path.write_text(DOC, encoding='utf-8')
+        index = src.helpdoc.HelpIndex(str(path))
+        assert index.get().search('matrix') == ['1.1', '1.2']
+        assert index.get().search('matrix') == ['1.1', '1.2']
+        assert index.loads == 1
+
+        path.write_text(DOC.replace('Rank of a matrix', 'Rank'), encoding='utf-8')
+        os.utime(str(path), ns=(0, os.stat(str(path)).st_mtime_ns + 10 ** 9))
+        assert index.get().search('matrix') == ['1.1']
+        assert index.section('1.2') == 'Rank: rk([[1, 2], [3, 4]])'
+        assert index.loads == 2
+
+    def test_message_length(self):
+        # Каждое сообщение ответа помещается в одно сообщение Telegram
+        index = src.helpdoc.HelpIndex(DEMO)
+        for args in [['пример'], ['matrix'], [], ['5.5'], ['x']]:
+            found = index.search(' '.join(args))
+            res = index.answer(args)
+            assert all(len(text) <= src.outbox.MAX_LENGTH for text in res), args
+            if found and not (len(args) == 1 and index.section(args[0]) is not None):
+                assert '\n'.join(res) == '\n'.join(found)
+        assert len(index.answer(['пример'])) > 1
+
+        assert src.helpdoc.pack(['a' * 10, 'b' * 3, 'c' * 20 + '\n' + 'd' * 5], 15) == ['a' * 10 + '\n' + 'b' * 3,
+                                                                                         'c' * 15, 'c' * 5 + '\n' + 'd' * 5]
@@ -0,0 +1,99 @@
+import os
+import sys
+
+import pytest
+
+import src.calc
+import src.dispatch
+import src.metrics
+import src.sandbox
+import src.storage
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+metrics = src.metrics.metrics
+
+
+@pytest.fixture
+def enabled():
+    metrics.reset()
+    metrics.enabled = True
+    yield metrics
+    metrics.enabled = False
+    metrics.slow_threshold = 1.0
+    metrics.reset()
+
+
+class TestUM:
+    def test_histogram(self):
+        h = src.metrics.Histogram()
+        for ms in [0.05, 0.2, 0.2, 3, 40]:
+            h.add(ms / 1e3)
+        assert h.count == 5
+        assert h.quantile(0.5) == 0.00025
+        assert h.quantile(1) == 0.04
+        other = src.metrics.Histogram()
+        other.add(10.0)
+        h.merge(other)
+        assert (h.count, h.max, h.quantile(1)) == (6, 10.0, 10.0)
+
+    def test_disabled(self):
+        metrics.reset()
+        env = src.calc.Environment()
+        assert src.calc.calculate('sin(0) + 1', env) == 1
+        assert metrics.stages == {}
+        assert not metrics.nodes
+
+    def test_calculate(self, enabled):
+        env = src.calc.Environment()
+        src.calc.calculate('x = 2', env)
+        src.calc.calculate('inv([[1, 2], [3, 4]]) * x', env)
+        src.calc.calculate('10{km/h} -> {m/s}', env)
+        assert enabled.stages['parse'].count == 3
+        assert enabled.stages['eval'].count == 3
+        assert enabled.stages['linalg'].count == 1
+        assert enabled.stages['units'].count == 2
+        assert enabled.nodes == {'set': 1, 'number': 2, 'apply': 2, 'matrix': 1, 'name': 1, 'convert': 1,
+                                 'with_units': 1}
+        assert 'evaluated node types: ' in enabled.report()
+
+    def test_evaluated_nodes(self, enabled):
+        # Учитываются вычисления узлов, а не их число в сообщении: тела функций -- при каждом вызове
+        env = src.calc.Environment(root=src.calc.BUILTINS)
+        src.calc.calculate('def f(y) = y * 2', env)
+        enabled.reset()
+        src.calc.calculate('f(1) + f(2) + sin(pi)', env)
+        assert enabled.nodes == {'apply': 6, 'number': 4, 'name': 2, 'folded': 1}
+        enabled.reset()
+        src.calc.calculate('map(f, [[1, 2], [3, 4]])', env)
+        assert enabled.nodes == {'apply': 2, 'name': 1, 'matrix': 1, 'number': 1}
+        enabled.reset()
+        # Высокое дерево вычисляется стековой машиной
+        src.calc.calculate(' + '.join(['f(3)'] * 150), env)
+        assert enabled.nodes == {'apply': 299 + 1, 'number': 150 + 1, 'name': 1}
+
+    def test_slow_log(self, enabled, tmp_path):
+        with src.storage.SQLiteStore(str(tmp_path / 'state.sqlite')) as store:
+            envs = src.storage.EnvironmentCache(store)
+            enabled.slow_threshold = 0
+            assert src.dispatch.evaluate(envs, 7, 'x = 3') == 'None'
+            assert src.dispatch.evaluate(envs, 7, 'y') == "('Variable y not found',)"
+        assert [(chat_id, text) for (_, chat_id, text, _) in enabled.slow] == [(7, 'x = 3'), (7, 'y')]
+        assert enabled.stages['total'].count == 2
+        assert enabled.stages['storage'].count == 3
+
+        path = str(tmp_path / 'metrics.txt')
+        enabled.dump(path)
+        with open(path, encoding='utf-8') as f:
+            report = f.read()
+        assert 'chat 7' in report and 'storage' in report
+
+    def test_sandbox(self, enabled):
+        with src.sandbox.ProcessPool(workers=1) as pool:
+            assert pool.calculate('D([[1, 2], [3, 4]]) + 1', [{}, {}])[0] == str(-2.0000000000000004 + 1)
+            with pytest.raises(RuntimeError):
+                pool.calculate('y', [{}, {}])
+        assert enabled.stages['eval'].count == 2
+        assert enabled.stages['linalg'].count == 1
+        assert enabled.nodes['matrix'] == 1
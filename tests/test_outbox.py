@@ -0,0 +1,137 @@
+import os
+import sys
+import threading
+import time
+
+import src.outbox
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+
+class RetryAfter(Exception):
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class FakeBotAPI(object):
+    """sendMessage с ограничениями частоты (как у Telegram, но в масштабе теста): сообщения сверх ограничения
+    отклоняются ошибкой 429"""
+
+    def __init__(self, chat_rate, global_rate, burst, retry_after=0.05):
+        self.chat_rate = chat_rate
+        self.burst = burst
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.bucket = src.outbox.TokenBucket(global_rate, burst, time.monotonic())
+        self.buckets = dict()
+        self.messages = dict()
+        self.calls = 0
+        self.rejected = 0
+
+    def __call__(self, chat_id, text):
+        with self.lock:
+            now = time.monotonic()
+            self.calls += 1
+            bucket = self.buckets.setdefault(chat_id, src.outbox.TokenBucket(self.chat_rate, self.burst, now))
+
+            # Небольшой допуск: токен, который появится через миллисекунду, считается появившимся
+            if bucket.wait(now) > 1e-3 or self.bucket.wait(now) > 1e-3:
+                self.rejected += 1
+                raise RetryAfter(self.retry_after)
+
+            bucket.take(now)
+            self.bucket.take(now)
+            self.messages.setdefault(chat_id, []).append(text)
+
+    def texts(self, chat_id):
+        return '\n'.join(self.messages.get(chat_id, [])).split('\n')
+
+
+class TestUM:
+    def test_token_bucket(self):
+        bucket = src.outbox.TokenBucket(2.0, 3, 0.0)
+        for _ in range(3):
+            assert bucket.wait(0.0) == 0
+            bucket.take(0.0)
+        assert bucket.wait(0.0) == 0.5
+        assert bucket.wait(0.25) == 0.25
+        assert bucket.wait(0.5) == 0
+        assert bucket.full(10.0)
+
+    def test_limits(self):
+        api = FakeBotAPI(chat_rate=100.0, global_rate=400.0, burst=3)
+        outbox = src.outbox.Outbox(api, workers=4, chat_rate=100.0, group_rate=100.0, chat_burst=3,
+                                   global_rate=400.0, global_burst=3, backoff=0.01)
+        chats = list(range(-10, 10))
+        for i in range(20):
+            for chat_id in chats:
+                outbox.submit(chat_id, str(i))
+        outbox.shutdown()
+        # Ограничения соблюдаются, ответы не теряются и приходят по порядку
+        assert api.rejected == 0
+        for chat_id in chats:
+            assert api.texts(chat_id) == [str(i) for i in range(20)]
+        assert outbox.sent + outbox.coalesced == 400
+        assert outbox.sent == api.calls
+
+    def test_coalesce(self):
+        started = threading.Event()
+        release = threading.Event()
+        sent = []
+
+        def send(chat_id, text):
+            started.set()
+            assert release.wait(5)
+            sent.append(text)
+
+        outbox = src.outbox.Outbox(send, workers=1)
+        start = time.monotonic()
+        outbox.submit(1, '0')
+        assert started.wait(5)
+        for i in range(1, 5):
+            outbox.submit(1, str(i))
+        outbox.submit(1, 'x' * src.outbox.MAX_LENGTH)
+        # Постановка в очередь не ждёт отправки
+        assert time.monotonic() - start < 1
+        release.set()
+        outbox.shutdown()
+        # Первый ответ уже отправлялся, пока копились остальные; длинный ответ в то же сообщение не помещается
+        assert sent == ['0', '1\n2\n3\n4', 'x' * src.outbox.MAX_LENGTH]
+        assert outbox.coalesced == 3
+
+    def test_retry_after(self):
+        # Ограничения API строже, чем у очереди: часть сообщений получает 429 и отправляется повторно
+        api = FakeBotAPI(chat_rate=20.0, global_rate=50.0, burst=1, retry_after=0.02)
+        outbox = src.outbox.Outbox(api, workers=4, chat_rate=1000.0, chat_burst=1, global_rate=1000.0,
+                                   global_burst=1, max_retries=100, backoff=0.001)
+        for i in range(5):
+            for chat_id in range(5):
+                outbox.submit(chat_id, str(i))
+                time.sleep(0.005)
+        outbox.shutdown()
+        assert outbox.retried > 0
+        assert outbox.dropped == 0
+        for chat_id in range(5):
+            assert api.texts(chat_id) == [str(i) for i in range(5)]
+
+    def test_errors(self):
+        attempts = []
+
+        def send(chat_id, text):
+            attempts.append(text)
+            if text == 'flood':
+                raise RetryAfter(0)
+            if text == 'bad':
+                raise ValueError(text)
+
+        outbox = src.outbox.Outbox(send, workers=1, max_retries=2, backoff=0.001)
+        outbox.submit(1, 'flood')
+        outbox.join()
+        outbox.submit(1, 'bad')
+        outbox.join()
+        outbox.submit(1, 'ok')
+        outbox.shutdown()
+        assert attempts == ['flood'] * 3 + ['bad', 'ok']
+        assert (outbox.sent, outbox.dropped, outbox.retried) == (1, 2, 2)
@@ -1,6 +1,9 @@
 import os
+import pickle
 import sys
 
+import pytest
+
 import src.parser
 
 myPath = os.path.dirname(os.path.abspath(__file__))
@@ -47,3 +50,71 @@ class TestUM:
 
     def test_number_base(self):
         assert src.parser.parse('<ff>16 + <101>2') == ['apply', '+', [255, 5]]
+
+    def test_cached_parse(self):
+        src.parser.parse_cache.clear()
+        a = src.parser.cached_parse('sin(2)**2 + cos(3)^3')
+        b = src.parser.cached_parse('  sin(2)**2   +  cos(3)^3')
+        assert a is b
+        assert a == src.parser.parse('sin(2)**2 + cos(3)^3')
+        assert src.parser.parse_cache.stats()['hits'] == 1
+
+    def test_cached_parse_immutable(self):
+        expr = src.parser.cached_parse('f(x, 2, 1)')
+        with pytest.raises(TypeError):
+            expr[2].append(3)
+        with pytest.raises(TypeError):
+            expr[0] = 'set'
+        assert src.parser.cached_parse('f(x, 2, 1)') == ['apply', 'f', ['x', 2, 1]]
+
+    def test_artifact(self, tmp_path):
+        path = str(tmp_path / 'grammar.lark.cache')
+
+        def header():
+            # Первая строка файла -- хэш грамматики, по которому Lark проверяет, не устарел ли файл
+            with open(path, 'rb') as f:
+                return f.readline()
+
+        src.parser.build(path)
+        built = header()
+        mtime = os.path.getmtime(path)
+        assert src.parser.make_parser(path).parse('f(x, 2) + 1') == src.parser.parse('f(x, 2) + 1')
+        assert os.path.getmtime(path) == mtime
+
+        # Файл, построенный по другой грамматике, не используется и перестраивается
+        src.parser.Lark(src.parser.GRAMMAR + '\n// old\n', start='toplevel', parser='lalr', cache=path)
+        assert header() != built
+        assert src.parser.make_parser(path).parse('x = 2 ^ 3') == ['set', 'x', ['apply', 'pow', [2, 3]]]
+        assert header() == built
+
+    def test_numeric_matrix(self):
+        grammar = src.parser.GRAMMAR.replace("| NUMERIC_MATRIX -> numeric_matrix", "")
+        elementwise = src.parser.Lark(grammar, start='toplevel', parser='lalr',
+                                      transformer=src.parser.TreeTransformer())
+        for s in ['[1, 2]', '[[1, 2], [3, 4]]', '[ [ 1.5 , -2 ] , [ 3e2 , .5 ] ]', '[5]', '[[5]]', '[[1], [2, 3]]',
+                  '[[1, 2], [x, 3]]', 'T([1, 2]) * [[1, 2]]', '[1j, 2]', '[[-1, 2]] - 1']:
+            assert src.parser.parse(s) == elementwise.parse(s), s
+
+    def test_program(self):
+        assert src.parser.parse('x = 1; def f(y) = y * x\nf(2);') == \
+            ['program', [['set', 'x', 1], ['def', 'f', ['y'], ['apply', '*', ['y', 'x']]], ['apply', 'f', [2]]]]
+        assert src.parser.parse('x = 1;') == ['set', 'x', 1]
+        a = src.parser.cached_parse('x = 1\n  f(x,  2)')
+        assert a is src.parser.cached_parse('x = 1; f(x, 2);')
+        assert a[1][1] is src.parser.cached_parse('f(x, 2)')
+
+    def test_deep(self):
+        n = 10 ** 4
+        a = src.parser.cached_parse(' + '.join(['x'] * n))
+        assert src.parser.height(a) == 2 * n - 2
+        b = pickle.loads(pickle.dumps(a))
+        assert isinstance(b[2][0], src.parser.FrozenAST)
+        assert src.parser.flatten(b) == src.parser.flatten(a)
+
+        a = src.parser.cached_parse('sin(' * n + 'x' + ')' * n)
+        assert src.parser.height(a) == 2 * n
+        assert src.parser.thaw(*src.parser.flatten(a))[2][0][0] == 'apply'
+
+        small = src.parser.cached_parse('f(x, [1, 2]) + 1')
+        assert src.parser.thaw(*src.parser.flatten(small)) == small
+        assert pickle.loads(pickle.dumps(small)) == small
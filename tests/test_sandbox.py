@@ -0,0 +1,53 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+import src.calc
+import src.sandbox
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+
+class TestUM:
+    def test_calculate(self):
+        with src.sandbox.ProcessPool(workers=1) as pool:
+            env = src.calc.Environment(root=src.calc.BUILTINS)
+            assert pool.calculate('2 * 3', env.get_data()) == ('6', None)
+            (res, data) = pool.calculate('def f(x, y) = x * y', env.get_data())
+            assert res == 'None'
+            env.set_data(data)
+            assert pool.calculate('f(2, 4)', env.get_data()) == ('8', None)
+
+    def test_errors(self):
+        with src.sandbox.ProcessPool(workers=1) as pool:
+            with pytest.raises(RuntimeError) as e:
+                pool.calculate('x', [{}, {}])
+            assert e.value.args == ('Variable x not found',)
+            with pytest.raises(ZeroDivisionError):
+                pool.calculate('1 / 0', [{}, {}])
+
+    def test_syntax_error(self):
+        with src.sandbox.ProcessPool(workers=1) as pool:
+            with pytest.raises(RuntimeError) as e:
+                pool.calculate('x = 1 +', [{}, {}])
+            assert e.value.args[0].startswith('Unexpected token')
+            assert pool.restarts == 0
+            assert pool.calculate('1 + 1', [{}, {}]) == ('2', None)
+
+    def test_timeout_replaces_worker(self):
+        with src.sandbox.ProcessPool(workers=1) as pool:
+            data = [{'M': np.matrix(np.ones((800, 800)))}, {}]
+            with pytest.raises(RuntimeError):
+                pool.calculate('M * M * M * M * M * M', data, timeout=0.001)
+            assert pool.restarts == 1
+            assert pool.calculate('1 + 1', [{}, {}]) == ('2', None)
+
+    def test_limits(self):
+        with src.sandbox.ProcessPool(workers=1) as pool:
+            (_, data) = pool.calculate('def f(x, y) = f(x, y)', [{}, {}])
+            with pytest.raises(RuntimeError) as e:
+                pool.calculate('f(1, 2)', data, limits=src.calc.Limits(depth=5))
+            assert e.value.args == ('Evaluation budget exceeded: depth limit is 5',)
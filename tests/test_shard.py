@@ -0,0 +1,97 @@
+import os
+import sys
+import threading
+
+import src.calc
+import src.dispatch
+import src.shard
+import src.storage
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+
+class Replies(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chats = dict()
+
+    def __call__(self, chat_id, text):
+        with self.lock:
+            self.chats.setdefault(chat_id, []).append(text)
+
+
+class TestUM:
+    def test_owner(self):
+        chats = range(1000)
+        owners = {chat_id: src.shard.owner(chat_id, frozenset(range(4))) for chat_id in chats}
+        assert all(400 // 4 < list(owners.values()).count(shard) < 1600 // 4 for shard in range(4))
+        # Без процесса 3 переходят только его чаты
+        for chat_id in chats:
+            shard = src.shard.owner(chat_id, frozenset(range(3)))
+            assert shard == owners[chat_id] or owners[chat_id] == 3
+
+    def test_chats(self, tmp_path):
+        path = str(tmp_path / 'state.sqlite')
+        replies = Replies()
+        with src.shard.Supervisor(path, replies, workers=2) as supervisor:
+            for chat_id in range(10):
+                supervisor.submit(chat_id, 'x = {}'.format(chat_id))
+            for i in range(5):
+                for chat_id in range(10):
+                    supervisor.submit(chat_id, 'x = x + 1; x')
+        assert replies.chats == {chat_id: ['None'] + [str(chat_id + i) for i in range(1, 6)] for chat_id in range(10)}
+        with src.storage.SQLiteStore(path) as store:
+            assert store.load(3) == [{'x': 8}, {}]
+
+    def test_restart(self, tmp_path):
+        path = str(tmp_path / 'state.sqlite')
+        replies = Replies()
+        with src.shard.Supervisor(path, replies, workers=2, restart_delay=0.5) as supervisor:
+            chats = [c for c in range(20) if src.shard.owner(c, frozenset([0, 1])) == 0][:3]
+            for chat_id in chats:
+                supervisor.submit(chat_id, 'x = {}'.format(chat_id))
+            supervisor.join()
+
+            supervisor.shards[0].process.kill()
+            while 0 in supervisor.live:
+                threading.Event().wait(0.01)
+            # Пока процесс 0 не запущен заново, его чаты обрабатывает процесс 1, загружая окружения из хранилища
+            for chat_id in chats:
+                supervisor.submit(chat_id, 'x = x * 10; x')
+            supervisor.join()
+            assert supervisor.restarts == 0
+
+            while supervisor.restarts == 0:
+                supervisor.join()
+                threading.Event().wait(0.05)
+
+            for chat_id in chats:
+                supervisor.submit(chat_id, 'x + 1')
+            supervisor.join()
+            assert supervisor.rebalances == 2
+        assert replies.chats == {chat_id: ['None', str(chat_id * 10), str(chat_id * 10 + 1)] for chat_id in chats}
+
+    def test_timeout(self, tmp_path):
+        path = str(tmp_path / 'state.sqlite')
+        replies = Replies()
+        limits = src.dispatch.ChatLimits(default=src.calc.Limits(bits=10 ** 9))
+        with src.shard.Supervisor(path, replies, workers=1, limits=limits, timeout=0.5,
+                                  restart_delay=0.1) as supervisor:
+            supervisor.submit(1, 'x = 1')
+            supervisor.submit(1, 'pow(100000000000000000000, 300000)')
+            supervisor.submit(2, 'y = 2')
+            supervisor.submit(1, 'x + 1')
+            supervisor.join()
+            assert supervisor.restarts == 1
+        assert replies.chats == {1: ['None', str(('Evaluation timed out after 0.5 s',)), '2'], 2: ['None']}
+
+    def test_chat_limits(self, tmp_path):
+        path = str(tmp_path / 'state.sqlite')
+        replies = Replies()
+        limits = src.dispatch.ChatLimits({1: src.calc.Limits(steps=10)})
+        text = ' + '.join(['sin(0)'] * 20)
+        with src.shard.Supervisor(path, replies, workers=2, limits=limits) as supervisor:
+            for chat_id in (1, 2):
+                supervisor.submit(chat_id, text)
+        assert replies.chats == {1: [str(('Evaluation budget exceeded: steps limit is 10',))], 2: ['0.0']}
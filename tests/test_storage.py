@@ -0,0 +1,129 @@
+import os
+import shelve
+import sys
+
+import src.calc
+import src.storage
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+
+class TestUM:
+    def test_sqlite_round_trip(self, tmp_path):
+        with src.storage.SQLiteStore(str(tmp_path / 'state.sqlite')) as store:
+            env = store.environment(42)
+            src.calc.calculate('def f(x, y) = x * y', env)
+            src.calc.calculate('x = 3', env)
+            assert store.commit(42, env)
+
+            env = store.environment(42)
+            assert src.calc.calculate('f(x, 2)', env) == 6
+            assert store.chats() == [42]
+            assert 42 in store
+            assert 7 not in store
+
+    def test_sqlite_wal(self, tmp_path):
+        with src.storage.SQLiteStore(str(tmp_path / 'state.sqlite')) as store:
+            assert store.db.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+
+    def test_commit_only_changed(self, tmp_path):
+        with src.storage.SQLiteStore(str(tmp_path / 'state.sqlite')) as store:
+            env = store.environment(1)
+            src.calc.calculate('x = 1', env)
+            assert store.commit(1, env)
+
+            env = store.environment(1)
+            src.calc.calculate('x + 1', env)
+            assert not store.commit(1, env)
+            src.calc.calculate('unset x', env)
+            assert store.commit(1, env)
+
+    def test_migrate(self, tmp_path):
+        old = src.calc.Environment()
+        src.calc.calculate('y = 5', old)
+        with shelve.open(str(tmp_path / 'old')) as db:
+            db['10'] = old.get_data()
+            db['20'] = src.calc.Environment().get_data()
+
+        with src.storage.SQLiteStore(str(tmp_path / 'state.sqlite')) as store:
+            assert src.storage.migrate(str(tmp_path / 'old'), store) == 2
+            assert sorted(store.chats()) == [10, 20]
+            assert store.load(10) == [{'y': 5}, {}]
+            assert src.calc.calculate('y * pi', store.environment(10)) == 5 * src.calc.math.pi
+
+    def test_migrate_new_builtins(self, tmp_path):
+        # В записях старого формата нет встроенных функций, добавленных позже; удалёнными они не считаются
+        old = src.calc.Environment()
+        src.calc.calculate('def f(x) = x * 2', old)
+        src.calc.calculate('undef sin', old)
+        (variables, functions) = old.get_data()
+        functions = {key: val for (key, val) in functions.items() if key not in ('range', 'map')}
+        with shelve.open(str(tmp_path / 'old')) as db:
+            db['10'] = [variables, functions]
+
+        with src.storage.SQLiteStore(str(tmp_path / 'state.sqlite')) as store:
+            assert src.storage.migrate(str(tmp_path / 'old'), store) == 1
+            env = store.environment(10)
+            assert list(src.calc.calculate('range(0, 3, 1)', env)) == [0, 1, 2]
+            assert src.calc.calculate('map(f, [1, 2])', env).tolist() == [[2, 4]]
+            assert store.load(10)[1]['sin'] is src.calc.DELETED
+
+    def test_cache_eviction(self, tmp_path):
+        with src.storage.SQLiteStore(str(tmp_path / 'state.sqlite')) as store:
+            cache = src.storage.EnvironmentCache(store, max_entries=2)
+            for chat_id in range(3):
+                src.calc.calculate('x = {}'.format(chat_id), cache.get(chat_id))
+            assert len(cache) == 2
+            assert 0 not in cache
+            assert cache.stats()['evictions'] == 1
+            assert store.load(0) == [{'x': 0}, {}]
+
+            env = cache.get(0)
+            assert src.calc.calculate('x', env) == 0
+            assert cache.stats()['reloads'] == 4
+            assert cache.get(0) is env
+            assert cache.stats()['hits'] == 1
+
+    def test_cache_bytes_budget(self, tmp_path):
+        with src.storage.SQLiteStore(str(tmp_path / 'state.sqlite')) as store:
+            cache = src.storage.EnvironmentCache(store, max_bytes=1)
+            env = cache.get(1)
+            src.calc.calculate('x = 1', env)
+            cache.commit(1, env)
+            cache.get(2)
+            assert len(cache) == 1
+            assert 2 in cache
+            cache.drop()
+            assert len(cache) == 0
+
+    def test_cache_pinned(self, tmp_path):
+        with src.storage.SQLiteStore(str(tmp_path / 'state.sqlite')) as store:
+            cache = src.storage.EnvironmentCache(store, max_entries=2)
+            cache.pin(0)
+            for chat_id in range(3):
+                src.calc.calculate('x = {}'.format(chat_id), cache.get(chat_id))
+            # Окружение чата 0 используется, вытесняется следующее по давности
+            assert sorted(cache.envs) == [0, 2]
+            assert store.load(1) == [{'x': 1}, {}]
+
+            # Все окружения используются: вытеснение откладывается до окончания обработки
+            cache.pin(2)
+            cache.pin(3)
+            src.calc.calculate('x = 3', cache.get(3))
+            assert sorted(cache.envs) == [0, 2, 3]
+            assert store.load(0) is None
+            cache.unpin(0)
+            assert sorted(cache.envs) == [2, 3]
+            assert store.load(0) == [{'x': 0}, {}]
+            assert cache.stats()['evictions'] == 2
+
+    def test_cache_release(self, tmp_path):
+        with src.storage.SQLiteStore(str(tmp_path / 'state.sqlite')) as store:
+            cache = src.storage.EnvironmentCache(store)
+            for chat_id in range(4):
+                src.calc.calculate('x = {}'.format(chat_id), cache.get(chat_id))
+            cache.release(lambda chat_id: chat_id % 2 == 0)
+            assert sorted(cache.envs) == [0, 2]
+            assert store.load(1) == [{'x': 1}, {}]
+            assert store.load(0) is None
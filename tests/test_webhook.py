@@ -0,0 +1,94 @@
+import http.client
+import json
+import os
+import queue
+import sys
+import threading
+
+import src.dispatch
+import src.storage
+import src.webhook
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+with open(os.path.join(myPath, 'updates.json')) as f:
+    UPDATES = json.load(f)
+
+SECRET = 'test-secret'
+
+
+def post(conn, body, secret=SECRET, path='/hook', method='POST'):
+    headers = {'Content-Type': 'application/json'}
+    if secret is not None:
+        headers[src.webhook.SECRET_HEADER] = secret
+    conn.request(method, path, body=body, headers=headers)
+    res = conn.getresponse()
+    res.read()
+    return res.status
+
+
+class TestUM:
+    def test_recorded_updates(self):
+        received = queue.Queue()
+        with src.webhook.WebhookServer(received.put, SECRET, port=0, path='/hook') as server:
+            conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+            # Все обновления передаются по одному соединению
+            for update in UPDATES:
+                assert post(conn, json.dumps(update)) == 200
+            conn.close()
+            assert [received.get(timeout=5) for _ in UPDATES] == UPDATES
+            assert server.received == len(UPDATES)
+
+    def test_rejected(self):
+        received = []
+        with src.webhook.WebhookServer(received.append, SECRET, port=0, path='/hook') as server:
+            body = json.dumps(UPDATES[0])
+            for (status, kwargs) in [(403, dict(secret='wrong')), (403, dict(secret=None)), (404, dict(path='/')),
+                                     (405, dict(method='PUT')), (400, dict(body='{"update_id": ')),
+                                     (400, dict(body='[1, 2]'))]:
+                conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+                assert post(conn, **dict(dict(body=body), **kwargs)) == status
+                conn.close()
+            assert server.rejected == 6
+        assert received == []
+
+    def test_ack_before_processing(self):
+        release = threading.Event()
+        done = []
+
+        def slow(update):
+            assert release.wait(5)
+            done.append(update['update_id'])
+
+        with src.webhook.WebhookServer(slow, SECRET, port=0, path='/hook') as server:
+            conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+            # Ответ приходит, пока обработка первого обновления ещё не закончилась
+            for update in UPDATES:
+                assert post(conn, json.dumps(update)) == 200
+            conn.close()
+            assert done == []
+            release.set()
+        # Остановка дожидается обработки уже принятых обновлений
+        assert done == [update['update_id'] for update in UPDATES]
+
+    def test_evaluate(self, tmp_path):
+        with src.storage.SQLiteStore(str(tmp_path / 'state.sqlite')) as store:
+            envs = src.storage.EnvironmentCache(store)
+            dispatcher = src.dispatch.ChatDispatcher(workers=2)
+            replies = []
+
+            def handle(update):
+                message = update.get('message')
+                if message is not None and not message['text'].startswith('/'):
+                    chat_id = message['chat']['id']
+                    dispatcher.submit(chat_id, lambda: replies.append(
+                        (chat_id, src.dispatch.evaluate(envs, chat_id, message['text']))))
+
+            with src.webhook.WebhookServer(handle, SECRET, port=0, path='/hook') as server:
+                conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+                for update in UPDATES:
+                    assert post(conn, json.dumps(update)) == 200
+                conn.close()
+            dispatcher.shutdown()
+            assert sorted(replies) == [(-100200300, '6'), (1001, '6')]